@@ -8,9 +8,10 @@ Usage: python complete_tree.py input_tree.ply
 import argparse
 import os
 import glob
+import json
+import time
 import numpy as np
 import open3d as o3d
-import subprocess
 import sys
 from datetime import datetime
 import shutil
@@ -24,225 +25,379 @@ try:
 except ImportError:
     print("Error: tree2cubes module not found in tree_workflow/")
     sys.exit(1)
+from tools.inference import TreeCompletionEngine, BackgroundWriter, save_outputs, prefetch
+from utils.cube_shard import CubeShard, find_shards
+from cube_merge import CubeMerger
+from cube_cache import CubeResultCache, model_fingerprint, lookup_cached, complete_with_cache
+from las_tiling import tile_las, is_las_file, LAS_EXTENSIONS
+
+# separates the tree name from the cube name in the cube stream
+TREE_SEPARATOR = "/"
+TREE_EXTENSIONS = ('.ply',) + LAS_EXTENSIONS
+CUBE_TABLE_NAME = "cube_table.npy"
 
 def create_run_folder():
-    """Create timestamped run folder structure"""
+    """Create timestamped run folder structure (cubes/ is only created when cubes are saved)"""
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     run_folder = f"inference_runs/{timestamp}_run"
     cubes_folder = os.path.join(run_folder, "cubes")
     
-    os.makedirs(cubes_folder, exist_ok=True)
+    os.makedirs(run_folder, exist_ok=True)
     return run_folder, cubes_folder
 
-def cut_point_cloud_to_cubes(point_cloud, cubes_folder, cube_sizes, enable_flipping=True, 
-                           use_improved=True, min_points=100, max_points=8192, 
-                           target_points=3000, debug_analysis=True):
-    """Cut point cloud into cubes and save as .txt files"""
+def iter_cubes(cubes_folder):
+    """Yield (name, points) for every cube in the folder, from cube shards or legacy .txt files"""
+    shard_paths = find_shards(cubes_folder)
+    if shard_paths:
+        for shard_path in shard_paths:
+            yield from CubeShard(shard_path).items()
+    else:
+        for txt_file in sorted(glob.glob(os.path.join(cubes_folder, "*.txt"))):
+            yield os.path.splitext(os.path.basename(txt_file))[0], np.loadtxt(txt_file)
+
+def print_input_analysis(point_cloud, cube_sizes):
+    print(f"📊 Input tree analysis:")
+    print(f"   Total points: {point_cloud.shape[0]:,}")
+    print(f"   X range: {np.min(point_cloud[:, 0]):.2f} to {np.max(point_cloud[:, 0]):.2f} ({np.max(point_cloud[:, 0]) - np.min(point_cloud[:, 0]):.2f}m)")
+    print(f"   Y range: {np.min(point_cloud[:, 1]):.2f} to {np.max(point_cloud[:, 1]):.2f} ({np.max(point_cloud[:, 1]) - np.min(point_cloud[:, 1]):.2f}m)")
+    print(f"   Z range: {np.min(point_cloud[:, 2]):.2f} to {np.max(point_cloud[:, 2]):.2f} ({np.max(point_cloud[:, 2]) - np.min(point_cloud[:, 2]):.2f}m)")
+    print(f"   Cube sizes: {cube_sizes}")
+
+def print_cube_analysis(point_cloud, table):
+    print(f"📈 Cube generation analysis:")
+    print(f"   Generated {len(table)} cubes")
+    
+    if len(table) > 0:
+        cubes = table.array()
+        point_counts = cubes['count']
+        z_positions = cubes['centroid'][:, 2]  # Average Z position of every cube
+        print(f"   Points per cube - Min: {point_counts.min()}, Max: {point_counts.max()}, Avg: {np.mean(point_counts):.0f}")
+        print(f"   Z coverage - Min: {z_positions.min():.2f}m, Max: {z_positions.max():.2f}m")
+        
+        # Check for missing coverage
+        coverage_ratio = table.vertical_coverage(point_cloud)
+        print(f"   Vertical coverage: {coverage_ratio:.1%} of tree height")
+        
+        if coverage_ratio < 0.8:
+            print("   ⚠️  WARNING: Low vertical coverage - many tree parts may be missing!")
+            print("   💡 Suggestion: Reduce point count thresholds in tree2cubes.py")
+
+def stream_cubes(point_cloud, cube_sizes, use_improved=True, 
+                 min_points=100, max_points=8192, target_points=3000, debug_analysis=True, 
+                 cubes_folder="cubes", save_cubes=False, cube_format="shard", seed=None, workers=1,
+                 cut_method="grid", octree_settings=None, table=None, pool=None):
+    """
+    Cut the point cloud into cubes and yield (name, points) as soon as each cube is cut.
+    Cubes are only written to cubes_folder when save_cubes is set (debug output),
+    the original cutter always goes through cubes_folder.
+    With workers > 1 the improved cutter spreads the cube grids over a process pool
+    (`pool`, a cutting_pool shared by the trees, or one per tree)
+    cut_method "octree" replaces the cube grids by density-adaptive octree leaves
+    (octree_settings: leaf_points, min_leaf_points, overlap, min_size, see iter_octree_cubes).
+    The metadata of every cube (count, bounds, centroid, version) is collected in `table`
+    (a CubeTable) as the cubes pass, and written next to the cubes when they are saved.
+    """
     print("🔪 Cutting point cloud into cubes...")
     
     if debug_analysis:
-        print(f"📊 Input tree analysis:")
-        print(f"   Total points: {point_cloud.shape[0]:,}")
-        print(f"   X range: {np.min(point_cloud[:, 0]):.2f} to {np.max(point_cloud[:, 0]):.2f} ({np.max(point_cloud[:, 0]) - np.min(point_cloud[:, 0]):.2f}m)")
-        print(f"   Y range: {np.min(point_cloud[:, 1]):.2f} to {np.max(point_cloud[:, 1]):.2f} ({np.max(point_cloud[:, 1]) - np.min(point_cloud[:, 1]):.2f}m)")
-        print(f"   Z range: {np.min(point_cloud[:, 2]):.2f} to {np.max(point_cloud[:, 2]):.2f} ({np.max(point_cloud[:, 2]) - np.min(point_cloud[:, 2]):.2f}m)")
-        print(f"   Cube sizes: {cube_sizes}")
+        print_input_analysis(point_cloud, cube_sizes)
     
     # Cut into different cube sizes using configured method
-    if use_improved and hasattr(tree2cubes_improved, 'cut_point_cloud_improved'):
+    stats = None
+    if cut_method == "octree":
+        print("🌲 Using density-adaptive octree cubes")
+        stats = {}
+        cut_cubes = tree2cubes_improved.iter_octree_cubes(point_cloud, min_points=min_points, 
+                                                          max_points=max_points, target_points=target_points, 
+                                                          stats=stats, seed=seed, **(octree_settings or {}))
+    elif use_improved and hasattr(tree2cubes_improved, 'iter_cut_cubes'):
         # Use improved cutting method
         print("🔧 Using improved cube cutting for better coverage")
-        tree2cubes_improved.cut_point_cloud_improved(point_cloud, cubes_folder, 
-                                                     size1=cube_sizes[0], size2=cube_sizes[1], 
-                                                     size3=cube_sizes[2], size4=cube_sizes[3],
-                                                     min_points=min_points, max_points=max_points, 
-                                                     target_points=target_points)
+        stats = {}
+        cut_cubes = tree2cubes_improved.iter_cut_cubes(point_cloud, cube_sizes, 
+                                                       min_points=min_points, max_points=max_points, 
+                                                       target_points=target_points, stats=stats, seed=seed,
+                                                       workers=workers, pool=pool)
+    
+    if stats is not None:
+        if save_cubes:
+            # floor of the minimum keeps the float32 coordinates of the shard small
+            cut_cubes = tree2cubes_improved.save_cubes(cut_cubes, cubes_folder, 
+                                                       origin=np.floor(np.min(point_cloud[:, 0:3], axis=0)), 
+                                                       cube_format=cube_format)
+        cubes = cut_cubes
     else:
         # Fall back to original method
         print("⚠️  Using original cube cutting method")
+        os.makedirs(cubes_folder, exist_ok=True)
         tree2cubes.cut_point_cloud(point_cloud, cubes_folder, 
                                    size1=cube_sizes[0], size2=cube_sizes[1], 
                                    size3=cube_sizes[2], size4=cube_sizes[3])
-    
-    txt_files = glob.glob(os.path.join(cubes_folder, "*.txt"))
-    
+        cubes = ((name, data, 0, (-1, -1, -1)) for name, data in iter_cubes(cubes_folder))
+    
+    # Record the cubes while they pass through
+    if table is None:
+        table = tree2cubes_improved.CubeTable()
+    for name, data, version, cell in cubes:
+        table.add(name, data, version, cell)
+        yield name, data
+    
+    if save_cubes:
+        table.save(os.path.join(cubes_folder, CUBE_TABLE_NAME))
+    if stats is not None:
+        tree2cubes_improved.print_cut_summary(stats, len(point_cloud), min_points)
     if debug_analysis:
-        print(f"📈 Cube generation analysis:")
-        print(f"   Generated {len(txt_files)} cube files")
-        
-        # Analyze point distribution in cubes
-        point_counts = []
-        z_positions = []
-        
-        for txt_file in txt_files:
-            data = np.loadtxt(txt_file)
-            point_counts.append(data.shape[0])
-            z_positions.append(np.mean(data[:, 2]))  # Average Z position of cube
-        
-        if point_counts:
-            print(f"   Points per cube - Min: {min(point_counts)}, Max: {max(point_counts)}, Avg: {np.mean(point_counts):.0f}")
-            print(f"   Z coverage - Min: {min(z_positions):.2f}m, Max: {max(z_positions):.2f}m")
-            
-            # Check for missing coverage
-            tree_z_range = np.max(point_cloud[:, 2]) - np.min(point_cloud[:, 2])
-            cube_z_range = max(z_positions) - min(z_positions)
-            coverage_ratio = cube_z_range / tree_z_range if tree_z_range > 0 else 0
-            print(f"   Vertical coverage: {coverage_ratio:.1%} of tree height")
-            
-            if coverage_ratio < 0.8:
-                print("   ⚠️  WARNING: Low vertical coverage - many tree parts may be missing!")
-                print("   💡 Suggestion: Reduce point count thresholds in tree2cubes.py")
+        print_cube_analysis(point_cloud, table)
+
+def load_completion_engine(model_config, model_checkpoint, gpu_device="cuda:0", batch_size=1, prefetch_batches=2,
+                           compile_mode="eager", onnx_threads=0, quantize=False, precision="fp32", ragged=False,
+                           coarse_only=False):
+    """Build the TreePoinTr model once so it can be reused for every cube (and every tree)"""
+    print("🧠 Loading TreePoinTr model...")
+    return TreeCompletionEngine(model_config, model_checkpoint, device=gpu_device, batch_size=batch_size,
+                                prefetch_batches=prefetch_batches, compile_mode=compile_mode,
+                                num_threads=onnx_threads, quantize=quantize, precision=precision, ragged=ragged,
+                                coarse_only=coarse_only)
+
+def load_result_cache(cache_folder, model_config, model_checkpoint, engine, max_gb):
+    """Open the persistent cube result cache for this model and inference settings"""
+    print(f"🗄️  Opening cube result cache: {cache_folder}")
+    fingerprint = model_fingerprint(model_config, model_checkpoint, **engine.result_settings())
+    return CubeResultCache(cache_folder, fingerprint, max_bytes=int(max_gb * 1024 ** 3))
+
+def run_inference(engine, cubes, run_folder, enable_flipping=True, save_npy=False, save_ply=False, save_xyz=False,
+                  cache=None):
+    """
+    Run TreePoinTr inference on the cube stream, yielding completed cubes batch by batch.
+    The cubes are cut and looked up in the result cache in a background thread (a few batches ahead) and the
+    cache entries and per-cube outputs are written by a background writer, so the model does not wait on the
+    cutter or the disk.
+    """
+    print("🤖 Running TreePoinTr inference...")
     
-    # Create flipped versions (data augmentation) if enabled
     if enable_flipping:
-        print("🔄 Creating flipped versions for data augmentation...")
-        for txt_file in txt_files:
-            data = np.loadtxt(txt_file)
-            filename = os.path.basename(txt_file)
-            
-            # Swap x and z coordinates
-            flipfile = np.column_stack((data[:, 2], data[:, 1], data[:, 0]))
-            flip_path = os.path.join(cubes_folder, filename + "_flip.txt")
-            np.savetxt(flip_path, flipfile)
+        # Flipped versions (x and z swapped) run in the same batch and come back swapped back
+        print("🔄 Completing flipped versions in the same batches for data augmentation")
     else:
         print("⏭️  Skipping data augmentation (flipping disabled)")
     
-    return len(txt_files)
-
-def run_inference(cubes_folder, run_folder, model_config, model_checkpoint, 
-                 save_npy=True, save_ply=False, save_xyz=False, gpu_device="cuda:0"):
-    """Run TreePoinTr inference on all cube files"""
-    print("🤖 Running TreePoinTr inference...")
-    
-    inference_output = os.path.join(run_folder, "inference_results")
-    
-    # Build inference command with configurable parameters
-    cmd = [
-        "python", "tools/inference.py",
-        model_config,
-        model_checkpoint,
-        "--pc_root", cubes_folder,
-        "--out_pc_root", inference_output,
-        "--device", gpu_device
-    ]
-    
-    # Add output format flags based on configuration
-    if save_npy:
-        cmd.append("--save_npy")
-    if save_ply:
-        cmd.append("--save_ply")
-    if save_xyz:
-        cmd.append("--save_xyz")
-    
-    print(f"Running: {' '.join(cmd)}")
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    
-    if result.returncode != 0:
-        print(f"❌ Inference failed:")
-        print(result.stderr)
-        return False
-    
-    print("✅ Inference completed successfully!")
-    return True
-
-def concatenate_results(run_folder, original_name, separate_flipped=True, combine_all=False):
-    """Concatenate all inference results into final tree"""
-    print("🔗 Concatenating cube results into complete tree...")
-    
     inference_output = os.path.join(run_folder, "inference_results")
     
-    # Initialize arrays properly (empty lists, not fixed-size arrays)
-    all_points = []
-    all_flip_points = []
-    
-    # Process all inference result directories
-    result_dirs = [d for d in os.listdir(inference_output) 
-                   if os.path.isdir(os.path.join(inference_output, d))]
-    
-    processed_count = 0
-    
-    for result_dir in result_dirs:
-        npy_path = os.path.join(inference_output, result_dir, "fine.npy")
-        
-        if not os.path.exists(npy_path):
-            continue
-            
-        # Load the completed cube
-        cube_points = np.load(npy_path)
-        
-        # Check if this is a flipped version
-        if "flip" in result_dir:
-            # Swap x and z back for flipped versions
-            cube_points_corrected = np.column_stack((cube_points[:, 2], 
-                                                   cube_points[:, 1], 
-                                                   cube_points[:, 0]))
-            all_flip_points.append(cube_points_corrected)
+    if cache is not None:
+        # the cubes are hashed and looked up in the cache by the prefetch thread too
+        cubes = lookup_cached(cubes, cache, flip=enable_flipping)
+    cubes = prefetch(cubes, depth=engine.prefetch_batches * engine.batch_size)
+    with BackgroundWriter() as writer:
+        if cache is not None:
+            completed_cubes = complete_with_cache(engine, cubes, cache, flip=enable_flipping, writer=writer)
         else:
-            all_points.append(cube_points)
+            completed_cubes = engine.complete_stream(cubes, flip=enable_flipping)
         
-        processed_count += 1
-    
-    print(f"📊 Processed {processed_count} cube results")
-    
-    # Concatenate and save results based on configuration
+        for name, dense_points in completed_cubes:
+            # Per-cube outputs are only written when explicitly requested
+            if save_npy or save_ply or save_xyz:
+                writer.submit(save_outputs, dense_points, inference_output, name,
+                              save_npy=save_npy, save_xyz=save_xyz, save_ply=save_ply)
+            yield name, dense_points
+    
+    if cache is not None:
+        print(f"🗄️  Result cache: {cache.hits} results reused, {cache.misses} missing")
+
+def save_point_cloud(points, output_path):
+    cloud = o3d.geometry.PointCloud()
+    cloud.points = o3d.utility.Vector3dVector(points)
+    o3d.io.write_point_cloud(output_path, cloud)
+
+def save_results(merger, run_folder, original_name, separate_flipped=True, combine_all=False):
+    """Write the merged tree(s) of one CubeMerger, returns the saved files"""
     saved_files = []
+    final_points = merger.points()
+    final_flip_points = merger.flip_points()
     
-    if all_points:
-        final_points = np.vstack(all_points)
+    if final_points is not None:
         print(f"🌳 Main completion: {final_points.shape[0]} points")
-        
+    
         # Save main completion
-        cloud_main = o3d.geometry.PointCloud()
-        cloud_main.points = o3d.utility.Vector3dVector(final_points)
         main_output = os.path.join(run_folder, f"{original_name}_completed.ply")
-        o3d.io.write_point_cloud(main_output, cloud_main)
+        save_point_cloud(final_points, main_output)
         print(f"✅ Saved main completion: {main_output}")
         saved_files.append(main_output)
     
     # Save flipped version separately if enabled and exists
-    if separate_flipped and all_flip_points:
-        final_flip_points = np.vstack(all_flip_points)
+    if separate_flipped and final_flip_points is not None:
         print(f"🔄 Flipped completion: {final_flip_points.shape[0]} points")
-        
-        cloud_flip = o3d.geometry.PointCloud()
-        cloud_flip.points = o3d.utility.Vector3dVector(final_flip_points)
+    
         flip_output = os.path.join(run_folder, f"{original_name}_completed_withflips.ply")
-        o3d.io.write_point_cloud(flip_output, cloud_flip)
+        save_point_cloud(final_flip_points, flip_output)
         print(f"✅ Saved flipped completion: {flip_output}")
         saved_files.append(flip_output)
     
     # Save combined version if enabled
-    if combine_all and all_points and all_flip_points:
-        combined_points = np.vstack([np.vstack(all_points), np.vstack(all_flip_points)])
+    if combine_all and final_points is not None and final_flip_points is not None:
+        combined_points = merger.combined_points()
         print(f"🔗 Combined completion: {combined_points.shape[0]} points")
-        
-        cloud_combined = o3d.geometry.PointCloud()
-        cloud_combined.points = o3d.utility.Vector3dVector(combined_points)
+    
         combined_output = os.path.join(run_folder, f"{original_name}_completed_combined.ply")
-        o3d.io.write_point_cloud(combined_output, cloud_combined)
+        save_point_cloud(combined_points, combined_output)
         print(f"✅ Saved combined completion: {combined_output}")
         saved_files.append(combined_output)
     
-    return len(saved_files) > 0
+    return saved_files
+
+def concatenate_results(run_folder, completed_cubes, summary, separate_flipped=True, combine_all=False,
+                        voxel_size=None, merge_mode="centroid", min_count=1):
+    """
+    Split the completed cube stream back per tree and merge every tree while its cubes come out of inference.
+    The stream keeps the order of the trees, so a tree is saved as soon as the first cube of the next one arrives.
+    Returns the number of trees that were saved.
+    """
+    def finish(tree_name, merger):
+        print(f"🔗 Concatenating {len(merger)} cube results of {tree_name} ({merger.num_points():,} points)...")
+        if voxel_size is not None:
+            print(f"🧊 Fusing overlapping cubes on a {voxel_size}m voxel grid ({merge_mode})")
+        saved_files = save_results(merger, run_folder, tree_name, separate_flipped, combine_all)
+        summary[tree_name].update(cubes=len(merger), outputs=saved_files,
+                                  status="completed" if saved_files else "failed",
+                                  seconds=round(time.time() - summary[tree_name]["_started"], 1))
+    
+    tree_name, merger = None, None
+    for name, cube_points in completed_cubes:
+        cube_tree, cube_name = name.split(TREE_SEPARATOR, 1)
+        if cube_tree != tree_name:
+            if merger is not None:
+                finish(tree_name, merger)
+            tree_name = cube_tree
+            merger = CubeMerger(voxel_size=voxel_size, mode=merge_mode, min_count=min_count,
+                                core_bounds=summary[tree_name].get("_core_bounds"))
+        merger.add(cube_name, cube_points)
+    if merger is not None:
+        finish(tree_name, merger)
+    
+    return sum(tree["status"] == "completed" for tree in summary.values())
+
+def collect_tree_files(inputs):
+    """
+    Expand the command line inputs into a list of PLY/LAS/LAZ files. An input is a file, a folder
+    (every PLY/LAS/LAZ file in it) or a manifest (text/csv file with one path in the first column per line,
+    relative paths are relative to the manifest)
+    """
+    tree_files = []
+    for path in inputs:
+        if os.path.isdir(path):
+            tree_files.extend(sorted(f for f in glob.glob(os.path.join(path, "*")) 
+                                     if f.lower().endswith(TREE_EXTENSIONS)))
+        elif path.lower().endswith(TREE_EXTENSIONS):
+            tree_files.append(path)
+        else:
+            with open(path) as manifest:
+                for line in manifest:
+                    entry = line.split(',')[0].strip()
+                    if entry.lower().endswith(TREE_EXTENSIONS):
+                        tree_files.append(os.path.join(os.path.dirname(path), entry))
+    return tree_files
+
+def unique_tree_names(tree_files):
+    """Output name per tree (file name without extension), numbered when several trees share a file name"""
+    names = []
+    for tree_file in tree_files:
+        name = os.path.splitext(os.path.basename(tree_file))[0].replace(TREE_SEPARATOR, "_")
+        unique_name, count = name, 1
+        while unique_name in names:
+            count += 1
+            unique_name = f"{name}_{count}"
+        names.append(unique_name)
+    return names
+
+def load_point_cloud(tree_file):
+    ply_cloud = o3d.io.read_point_cloud(tree_file)
+    return np.asarray(ply_cloud.points)
+
+def tree_units(trees, tiles_folder, tile_size=20.0, tile_halo=2.0, chunk_points=5000000):
+    """
+    (name, input file, loader, core bounds) of every unit to complete. PLY trees are one unit,
+    LAS/LAZ scans are read in chunks and split into tiles on disk first, every tile is one unit
+    """
+    for tree_name, tree_file in trees:
+        if not is_las_file(tree_file):
+            yield tree_name, tree_file, lambda tree_file=tree_file: load_point_cloud(tree_file), None
+            continue
+        
+        print(f"🧱 Tiling {tree_file} into {tile_size}m tiles (+{tile_halo}m halo)...")
+        tiles = tile_las(tree_file, os.path.join(tiles_folder, tree_name), tile_size=tile_size, 
+                         halo=tile_halo, chunk_points=chunk_points)
+        print(f"🧱 {len(tiles)} non-empty tiles")
+        for tile in tiles.names():
+            yield (f"{tree_name}_{tile}", tree_file, lambda tile=tile: tiles.points(tile), 
+                   tiles.core_bounds(tile))
+
+def stream_trees(trees, cube_sizes, summary, cubes_folder="cubes", tiles_folder="tiles", tile_settings=None,
+                 **cube_settings):
+    """
+    Chain the cube streams of several trees into one stream (cube names are prefixed with the tree name),
+    so inference batches run across tree boundaries and small trees still fill batches.
+    Only the trees (or tiles of large scans) whose cubes are in flight are held in memory.
+    """
+    for tree_name, tree_file, load, core_bounds in tree_units(trees, tiles_folder, **(tile_settings or {})):
+        print(f"🌲 Processing tree: {tree_name}")
+        print("📖 Loading point cloud...")
+        summary[tree_name] = {"input": tree_file, "_started": time.time(), "status": "failed", "outputs": []}
+        if core_bounds is not None:
+            summary[tree_name]["_core_bounds"] = core_bounds
+        try:
+            point_cloud = load()
+        except Exception as e:
+            print(f"❌ Could not read {tree_file}: {e}")
+            summary[tree_name]["error"] = str(e)
+            continue
+        print(f"📊 Loaded {point_cloud.shape[0]} points")
+        summary[tree_name]["points"] = int(point_cloud.shape[0])
+        if point_cloud.shape[0] == 0:
+            continue
+        
+        tree_cubes_folder = cubes_folder if len(trees) == 1 and core_bounds is None else os.path.join(cubes_folder, tree_name)
+        table = tree2cubes_improved.CubeTable()
+        for name, points in stream_cubes(point_cloud, cube_sizes, cubes_folder=tree_cubes_folder, table=table,
+                                         **cube_settings):
+            yield tree_name + TREE_SEPARATOR + name, points
+        # cube statistics of the tree straight from the cube table
+        counts = table.array()['count']
+        summary[tree_name].update(cut_cubes=len(table), 
+                                  points_per_cube=round(float(counts.mean()), 1) if len(counts) else 0.0,
+                                  vertical_coverage=round(table.vertical_coverage(point_cloud), 3))
+
+def write_summary(run_folder, summary, settings):
+    """Write <run_folder>/summary.json with the settings of the run and one entry per tree"""
+    trees = []
+    for tree_name, tree in summary.items():
+        tree = {key: value for key, value in tree.items() if not key.startswith("_")}
+        trees.append(dict(name=tree_name, **tree))
+    summary_path = os.path.join(run_folder, "summary.json")
+    with open(summary_path, "w") as f:
+        json.dump({"settings": settings, "trees": trees}, f, indent=2)
+    return summary_path
 
 def main():
     parser = argparse.ArgumentParser(description="Complete tree processing with TreePoinTr")
-    parser.add_argument("input_file", help="Input PLY file path")
+    parser.add_argument("inputs", nargs="+", 
+                        help="Input PLY/LAS/LAZ file(s), folder(s) of such files, or manifest(s) listing one path per line")
     args = parser.parse_args()
     
-    if not os.path.exists(args.input_file):
-        print(f"❌ Input file not found: {args.input_file}")
-        sys.exit(1)
+    for path in args.inputs:
+        if not os.path.exists(path):
+            print(f"❌ Input file not found: {path}")
+            sys.exit(1)
     
-    if not args.input_file.lower().endswith('.ply'):
-        print("❌ Input file must be a PLY file")
+    tree_files = collect_tree_files(args.inputs)
+    if not tree_files:
+        print("❌ Input must be a PLY/LAS/LAZ file, a folder of such files or a manifest listing them")
         sys.exit(1)
     
-    # Extract original name
-    original_name = os.path.splitext(os.path.basename(args.input_file))[0]
+    # Extract original names
+    trees = list(zip(unique_tree_names(tree_files), tree_files))
     
-    print(f"🌲 Processing tree: {original_name}")
-    print(f"📁 Input file: {args.input_file}")
+    print(f"🌲 Trees to process: {len(trees)}")
+    for tree_name, tree_file in trees:
+        print(f"📁 Input file: {tree_file}")
     
     # =================== RESTORATION CONFIGURATION ===================
     # Modify these parameters to customize the tree completion process
@@ -265,12 +420,12 @@ def main():
     CUBE_SIZE_3 = 1.25   # Third cube size in meters
     CUBE_SIZE_4 = 1.8    # Fourth cube size in meters
     
-    # DATA AUGMENTATION - Create flipped versions of cubes for better completion
-    # Flipping can help with completion quality but doubles processing time
+    # DATA AUGMENTATION - Also complete every cube with x and z swapped (in memory, same batch)
+    # Flipping can help with completion quality but doubles the compute per batch
     ENABLE_FLIPPING = True
     
     # OUTPUT FORMATS - Choose what file formats to save
-    SAVE_NPY = True      # Save raw numpy arrays (required for concatenation)
+    SAVE_NPY = False     # Save raw numpy arrays per cube (not needed for concatenation)
     SAVE_PLY = False     # Save individual cube completions as PLY files
     SAVE_XYZ = False     # Save individual cube completions as XYZ files
     
@@ -282,14 +437,67 @@ def main():
     SEPARATE_FLIPPED = True  # Save flipped results separately
     COMBINE_ALL = False      # Combine flipped and normal results into one file
     
+    # Merging - the four shifted cube grids overlap, so the same regions are completed several times.
+    # Overlapping points are fused into one point per voxel (None = keep every completed point)
+    MERGE_VOXEL_SIZE = 0.01  # Voxel size in meters
+    MERGE_MODE = "centroid"  # "centroid" (count-weighted mean of the points in a voxel) or "center" (voxel center)
+    MERGE_MIN_COUNT = 1      # Drop voxels with fewer completed points (e.g. 2 removes isolated noise)
+    
+    # RESULT CACHE - completed cubes are kept across runs, keyed by a hash of the cube points,
+    # the checkpoint, the config and the normalization. Re-running a tree (after a crash, or with
+    # other merge settings) only completes the cubes that are not cached yet.
+    USE_CACHE = True
+    CACHE_FOLDER = "inference_runs/cube_cache"
+    CACHE_MAX_GB = 20        # Least recently used results are evicted above this size
+    CUT_SEED = 0             # Fixed seed for downsampling dense cubes, so re-runs produce the same cubes
+    CUT_WORKERS = min(os.cpu_count() or 1, 16)  # Processes cutting cubes in parallel (1 = no process pool)
+    
+    # ADAPTIVE CUBES - "octree" replaces the four fixed cube grids by an octree that is split until
+    # every cube holds at most OCTREE_LEAF_POINTS points: dense crowns get small cubes, sparse parts
+    # large ones, so few cubes are dropped as sparse or thinned out. "grid" = the CUBE_SIZE_* grids
+    CUT_METHOD = "grid"
+    OCTREE_LEAF_POINTS = 4000    # Split cubes with more points (the 2000-4000 sweet spot of the model)
+    OCTREE_MIN_LEAF_POINTS = 1000  # ... unless their children would get fewer points on average (sparse leaves)
+    OCTREE_OVERLAP = 0.15        # Context margin around each cube, fraction of its size per side
+    OCTREE_MIN_SIZE = 0.25       # Smallest cube edge in meters (denser cubes are downsampled)
+    
+    # LARGE PLOT SCANS (.las/.laz input) - the scan is read in chunks and split into tiles on disk
+    # (float32 relative to a stored origin), then completed tile by tile with bounded RAM.
+    # Every tile keeps only the completed points of its core, the halo gives border cubes their context.
+    LAS_TILE_SIZE = 20.0         # Tile edge in meters (x/y)
+    LAS_TILE_HALO = 2.0          # Margin around each tile, at least the largest cube size
+    LAS_CHUNK_POINTS = 5000000   # Points decoded per read
+    
     # INFERENCE SETTINGS
     GPU_DEVICE = "cuda:0"    # GPU device to use for inference
     BATCH_PROCESSING = True  # Process multiple cubes in batch (faster)
+    INFERENCE_BATCH_SIZE = 16  # Cubes per forward pass when batching, x2 clouds with ENABLE_FLIPPING (lower it if the GPU runs out of memory)
+    PREFETCH_BATCHES = 2     # Batches cut and prepared in the background while the model runs (0 = serial)
+    COMPILE_MODE = "eager"   # "script": frozen TorchScript graph, traced once and cached next to the checkpoint
+                             # (less Python overhead per forward), "compile": torch.compile (slow first batch),
+                             # "onnx": exported ONNX graph run by onnxruntime on CPU (no CUDA extensions needed)
+    ONNX_THREADS = 0         # onnxruntime intra-op threads with COMPILE_MODE = "onnx" (0 = all cores)
+    QUANTIZE_INT8 = False    # int8 dynamic quantized linear layers, runs on CPU (faster, small drift:
+                             # check it with tools/quantize_model.py on a few cubes first)
+    PRECISION = "fp32"       # "bf16": autocast forward (CPU and recent GPUs), "fp16": GPUs only; about half
+                             # the activation memory, so larger INFERENCE_BATCH_SIZE fit (drift: tools/quantize_model.py)
+    RAGGED_BATCHES = False   # cubes under 2048 points keep their own points (padded batches with a mask) instead of
+                             # being upsampled by duplication (eager model). Cubes are kept from MIN_POINTS_IN_CUBE
+                             # points on, so this applies to most cubes of the sparse parts of a tree
+    PREVIEW_COARSE_ONLY = False  # fast preview (e.g. to check the coverage of a plot first): 512 coarse points per cube
+                                 # straight from the transformer, no dense decoding, about 3x faster per forward
     
     # QUALITY SETTINGS
     TARGET_POINTS_PER_CUBE = 8192  # Target number of points per completed cube
     MIN_POINTS_PER_CUBE = 2730     # Minimum points needed in input cube
     
+    # DEBUG OUTPUT - cubes are streamed from the cutter straight into inference,
+    # set SAVE_CUBES to also write them to <run_folder>/cubes for inspection.
+    # "shard" keeps all cubes in one binary memory-mapped file,
+    # "txt" writes one text file per cube (slow, only for inspecting cubes by hand)
+    SAVE_CUBES = False
+    CUBE_FORMAT = "shard"
+    
     # IMPROVED CUBE CUTTING PARAMETERS - Fix coverage issues
     # These parameters control which cubes are saved and processed
     # Lower values = more complete tree coverage, but more processing time
@@ -310,55 +518,88 @@ def main():
     
     print("🔧 Configuration:")
     print(f"   Model: {MODEL_CHECKPOINT}")
-    print(f"   Cube sizes: {CUBE_SIZE_1}m, {CUBE_SIZE_2}m, {CUBE_SIZE_3}m, {CUBE_SIZE_4}m")
+    if CUT_METHOD == "octree":
+        print(f"   Cubes: octree, up to {OCTREE_LEAF_POINTS} points per cube")
+    else:
+        print(f"   Cube sizes: {CUBE_SIZE_1}m, {CUBE_SIZE_2}m, {CUBE_SIZE_3}m, {CUBE_SIZE_4}m")
     print(f"   Data augmentation: {'Enabled' if ENABLE_FLIPPING else 'Disabled'}")
     print(f"   GPU device: {GPU_DEVICE}")
+    print(f"   Inference batch size: {INFERENCE_BATCH_SIZE if BATCH_PROCESSING else 1}")
+    print(f"   Model graph: {COMPILE_MODE}{' (int8)' if QUANTIZE_INT8 else ''}, precision {PRECISION}"
+          f"{', ragged batches' if RAGGED_BATCHES else ''}{', coarse preview' if PREVIEW_COARSE_ONLY else ''}")
     print(f"   Target points per cube: {TARGET_POINTS_PER_CUBE}")
+    print(f"   Result cache: {f'{CACHE_FOLDER} (max {CACHE_MAX_GB} GB)' if USE_CACHE else 'Disabled'}")
+    print(f"   Merge voxel size: {f'{MERGE_VOXEL_SIZE}m ({MERGE_MODE})' if MERGE_VOXEL_SIZE else 'off (keep all points)'}")
     print(f"   Improved cutting: {'Enabled' if USE_IMPROVED_CUTTING else 'Disabled'}")
     if USE_IMPROVED_CUTTING:
         print(f"   Min points per cube: {MIN_POINTS_IN_CUBE} (original: 500-1000)")
         print(f"   Max points per cube: {MAX_POINTS_IN_CUBE}")
         print(f"   Downsample target: {TARGET_POINTS_DOWNSAMPLE}")
+        print(f"   Cutting workers: {CUT_WORKERS}")
     
     # Create run folder structure
     run_folder, cubes_folder = create_run_folder()
     print(f"📂 Created run folder: {run_folder}")
     
+    cube_sizes = [CUBE_SIZE_1, CUBE_SIZE_2, CUBE_SIZE_3, CUBE_SIZE_4]
+    summary = {}
+    cut_pool = None
     try:
-        # Load point cloud
-        print("📖 Loading point cloud...")
-        ply_cloud = o3d.io.read_point_cloud(args.input_file)
-        point_cloud = np.asarray(ply_cloud.points)
-        print(f"📊 Loaded {point_cloud.shape[0]} points")
-        
-        # Cut into cubes using configured parameters
-        cube_sizes = [CUBE_SIZE_1, CUBE_SIZE_2, CUBE_SIZE_3, CUBE_SIZE_4]
-        num_cubes = cut_point_cloud_to_cubes(point_cloud, cubes_folder, cube_sizes, 
-                                           ENABLE_FLIPPING, USE_IMPROVED_CUTTING,
-                                           MIN_POINTS_IN_CUBE, MAX_POINTS_IN_CUBE, 
-                                           TARGET_POINTS_DOWNSAMPLE)
-        flip_info = f" (+ flipped versions)" if ENABLE_FLIPPING else ""
-        print(f"✂️ Created {num_cubes} cube files{flip_info}")
+        if CUT_WORKERS > 1 and USE_IMPROVED_CUTTING and CUT_METHOD == "grid":
+            # one set of cutting processes for all trees and tiles
+            cut_pool = tree2cubes_improved.cutting_pool(CUT_WORKERS)
+
+        # Load the model first, the cubes are cut and completed as they stream through
+        engine = load_completion_engine(MODEL_CONFIG, MODEL_CHECKPOINT, gpu_device=GPU_DEVICE,
+                                        batch_size=INFERENCE_BATCH_SIZE if BATCH_PROCESSING else 1,
+                                        prefetch_batches=PREFETCH_BATCHES, compile_mode=COMPILE_MODE,
+                                        onnx_threads=ONNX_THREADS, quantize=QUANTIZE_INT8, precision=PRECISION,
+                                        ragged=RAGGED_BATCHES, coarse_only=PREVIEW_COARSE_ONLY)
+        cache = None
+        if USE_CACHE:
+            cache = load_result_cache(CACHE_FOLDER, MODEL_CONFIG, MODEL_CHECKPOINT, engine, CACHE_MAX_GB)
         
-        # Run inference using configured model and parameters
-        if not run_inference(cubes_folder, run_folder, MODEL_CONFIG, MODEL_CHECKPOINT,
-                           save_npy=SAVE_NPY, save_ply=SAVE_PLY, save_xyz=SAVE_XYZ, 
-                           gpu_device=GPU_DEVICE):
-            print("❌ Inference failed, stopping...")
-            return
+        # cut -> normalize/upsample -> batched inference -> merge, one batch of cubes at a time,
+        # the cubes of consecutive trees share batches
+        cubes = stream_trees(trees, cube_sizes, summary, cubes_folder=cubes_folder,
+                             tiles_folder=os.path.join(run_folder, "tiles"),
+                             tile_settings=dict(tile_size=LAS_TILE_SIZE, tile_halo=LAS_TILE_HALO, 
+                                                chunk_points=LAS_CHUNK_POINTS),
+                             use_improved=USE_IMPROVED_CUTTING, min_points=MIN_POINTS_IN_CUBE,
+                             max_points=MAX_POINTS_IN_CUBE, target_points=TARGET_POINTS_DOWNSAMPLE,
+                             save_cubes=SAVE_CUBES, cube_format=CUBE_FORMAT, seed=CUT_SEED, workers=CUT_WORKERS,
+                             cut_method=CUT_METHOD, pool=cut_pool,
+                             octree_settings=dict(leaf_points=OCTREE_LEAF_POINTS, overlap=OCTREE_OVERLAP, 
+                                                  min_size=OCTREE_MIN_SIZE, min_leaf_points=OCTREE_MIN_LEAF_POINTS))
+        completed_cubes = run_inference(engine, cubes, run_folder, enable_flipping=ENABLE_FLIPPING,
+                                        save_npy=SAVE_NPY, save_ply=SAVE_PLY, save_xyz=SAVE_XYZ, cache=cache)
         
         # Concatenate results using configured strategy
-        if concatenate_results(run_folder, original_name, 
-                             separate_flipped=SEPARATE_FLIPPED, combine_all=COMBINE_ALL):
-            print(f"🎉 Tree completion successful!")
-            print(f"📂 Results saved in: {run_folder}")
+        num_completed = concatenate_results(run_folder, completed_cubes, summary,
+                                            separate_flipped=SEPARATE_FLIPPED, combine_all=COMBINE_ALL,
+                                            voxel_size=MERGE_VOXEL_SIZE, merge_mode=MERGE_MODE, 
+                                            min_count=MERGE_MIN_COUNT)
+        if num_completed == len(summary):
+            print(f"🎉 Tree completion successful! ({num_completed} trees)")
+        elif num_completed > 0:
+            print(f"⚠️  Completed {num_completed} of {len(summary)} trees")
         else:
-            print("❌ Failed to concatenate results")
+            print("❌ Inference produced no completed cubes, nothing to concatenate")
+        print(f"📂 Results saved in: {run_folder}")
             
     except Exception as e:
         print(f"❌ Error during processing: {e}")
         import traceback
         traceback.print_exc()
+    finally:
+        if cut_pool is not None:
+            cut_pool.terminate()
+    
+    settings = dict(model_config=MODEL_CONFIG, model_checkpoint=MODEL_CHECKPOINT, cube_sizes=cube_sizes,
+                    cut_method=CUT_METHOD, quantize_int8=QUANTIZE_INT8, precision=PRECISION, ragged_batches=RAGGED_BATCHES,
+                    preview_coarse_only=PREVIEW_COARSE_ONLY,
+                    enable_flipping=ENABLE_FLIPPING, merge_voxel_size=MERGE_VOXEL_SIZE, merge_mode=MERGE_MODE)
+    print(f"📝 Summary: {write_summary(run_folder, summary, settings)}")
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -2,6 +2,7 @@ import h5py
 import numpy as np
 import open3d
 import os
+from utils.cube_shard import CubeShard
 
 class IO:
     @classmethod
@@ -16,6 +17,8 @@ class IO:
             return cls._read_h5(file_path)
         elif file_extension in ['.txt']:
             return cls._read_txt(file_path)
+        elif file_extension in ['.shard']:
+            return cls._read_shard(file_path)
         else:
             raise Exception('Unsupported file extension: %s' % file_extension)
 
@@ -36,6 +39,11 @@ class IO:
     def _read_txt(cls, file_path):
         return np.loadtxt(file_path)
 
+    # A shard holds many cubes, the returned CubeShard maps cube name -> points (memory-mapped)
+    @classmethod
+    def _read_shard(cls, file_path):
+        return CubeShard(file_path)
+
     @classmethod
     def _read_h5(cls, file_path):
         f = h5py.File(file_path, 'r')
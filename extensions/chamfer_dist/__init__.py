@@ -5,15 +5,85 @@
 # @Last Modified time: 2019-12-18 15:06:25
 # @Email:  cshzxie@gmail.com
 
+import numpy as np
 import torch
 
-import chamfer
+try:
+    import chamfer
+except ImportError:
+    # CPU-only machines: the PyTorch implementation below is used
+    chamfer = None
+
+# CPU nearest neighbour search: at most this many point pairs per distance block (~128MB in float32)
+MAX_BLOCK_PAIRS = 2 ** 25
+# clouds with more point pairs per sample than this are searched with a KD-tree (scipy) instead of blocks
+KDTREE_MIN_PAIRS = 2 ** 22
+
+
+def _nearest_blocks(xyz1, xyz2):
+    # |a|^2 - 2ab + |b|^2 on blocks of queries, only the argmin is taken from it
+    chunk_size = max(1, MAX_BLOCK_PAIRS // (xyz1.size(0) * xyz2.size(1)))
+    sq2 = (xyz2 ** 2).sum(-1).unsqueeze(1)
+    idxs = []
+    for start in range(0, xyz1.size(1), chunk_size):
+        query = xyz1[:, start:start + chunk_size]
+        d2 = torch.baddbmm(sq2, query, xyz2.transpose(1, 2), alpha=-2)
+        idxs.append(d2.argmin(-1))
+    return torch.cat(idxs, dim=1)
+
+
+def _nearest_kdtree(xyz1, xyz2):
+    from scipy.spatial import cKDTree
+    idx = np.stack([cKDTree(b.detach().cpu().double().numpy()).query(a.detach().cpu().double().numpy(), workers=-1)[1]
+                    for a, b in zip(xyz1, xyz2)])
+    return torch.as_tensor(idx, dtype=torch.long, device=xyz1.device)
+
+
+def nearest_neighbours(xyz1, xyz2):
+    '''
+        xyz1 : B N 3, xyz2 : B M 3
+        ----------------------
+        dist : B N squared distance to the nearest point of xyz2, idx : B N int32 index of that point
+        Memory-bounded: blocks of queries, or a KD-tree for large clouds. The distances are
+        computed exactly for the selected pairs.
+    '''
+    if xyz1.size(1) * xyz2.size(1) >= KDTREE_MIN_PAIRS:
+        try:
+            idx = _nearest_kdtree(xyz1, xyz2)
+        except ImportError:
+            idx = _nearest_blocks(xyz1, xyz2)
+    else:
+        idx = _nearest_blocks(xyz1, xyz2)
+    nearest = torch.gather(xyz2, 1, idx.unsqueeze(-1).expand(-1, -1, 3))
+    return ((xyz1 - nearest) ** 2).sum(-1), idx.int()
+
+
+def chamfer_forward_cpu(xyz1, xyz2):
+    dist1, idx1 = nearest_neighbours(xyz1, xyz2)
+    dist2, idx2 = nearest_neighbours(xyz2, xyz1)
+    return dist1, dist2, idx1, idx2
+
+
+def chamfer_backward_cpu(xyz1, xyz2, idx1, idx2, grad_dist1, grad_dist2):
+    # same as the CUDA kernel: d/da |a - b|^2 = 2 (a - b), the nearest point gets the opposite
+    grad1 = 2 * grad_dist1.unsqueeze(-1) * (xyz1 - torch.gather(xyz2, 1, idx1.long().unsqueeze(-1).expand(-1, -1, 3)))
+    grad2 = 2 * grad_dist2.unsqueeze(-1) * (xyz2 - torch.gather(xyz1, 1, idx2.long().unsqueeze(-1).expand(-1, -1, 3)))
+    grad_xyz1 = grad1.scatter_add(1, idx2.long().unsqueeze(-1).expand(-1, -1, 3), -grad2)
+    grad_xyz2 = grad2.scatter_add(1, idx1.long().unsqueeze(-1).expand(-1, -1, 3), -grad1)
+    return grad_xyz1, grad_xyz2
 
 
 class ChamferFunction(torch.autograd.Function):
     @staticmethod
     def forward(ctx, xyz1, xyz2):
-        dist1, dist2, idx1, idx2 = chamfer.forward(xyz1, xyz2)
+        # distances in (at least) fp32 also for bf16 / fp16 points (autocast), autograd casts the gradients back
+        dtype = torch.promote_types(torch.promote_types(xyz1.dtype, xyz2.dtype), torch.float32)
+        xyz1, xyz2 = xyz1.to(dtype), xyz2.to(dtype)
+        with torch.autocast(xyz1.device.type, enabled=False):
+            if chamfer is not None and xyz1.is_cuda:
+                dist1, dist2, idx1, idx2 = chamfer.forward(xyz1, xyz2)
+            else:
+                dist1, dist2, idx1, idx2 = chamfer_forward_cpu(xyz1, xyz2)
         ctx.save_for_backward(xyz1, xyz2, idx1, idx2)
 
         return dist1, dist2
@@ -21,7 +91,11 @@ class ChamferFunction(torch.autograd.Function):
     @staticmethod
     def backward(ctx, grad_dist1, grad_dist2):
         xyz1, xyz2, idx1, idx2 = ctx.saved_tensors
-        grad_xyz1, grad_xyz2 = chamfer.backward(xyz1, xyz2, idx1, idx2, grad_dist1, grad_dist2)
+        if chamfer is not None and xyz1.is_cuda:
+            grad_xyz1, grad_xyz2 = chamfer.backward(xyz1, xyz2, idx1, idx2, grad_dist1, grad_dist2)
+        else:
+            grad_xyz1, grad_xyz2 = chamfer_backward_cpu(xyz1, xyz2, idx1, idx2,
+                                                        grad_dist1.contiguous(), grad_dist2.contiguous())
         return grad_xyz1, grad_xyz2
 
 
@@ -17,10 +17,17 @@ import unittest
 from torch.autograd import gradcheck
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir)))
+import extensions.chamfer_dist as chamfer_dist
 from extensions.chamfer_dist import ChamferFunction
 
 
+def brute_force(xyz1, xyz2):
+    d = ((xyz1.unsqueeze(2) - xyz2.unsqueeze(1)) ** 2).sum(-1)
+    return d.min(2).values, d.min(1).values
+
+
 class ChamferDistanceTestCase(unittest.TestCase):
+    @unittest.skipUnless(torch.cuda.is_available() and chamfer_dist.chamfer is not None, 'needs the CUDA extension')
     def test_chamfer_dist(self):
         x = torch.rand(4, 64, 3).double()
         y = torch.rand(4, 128, 3).double()
@@ -28,6 +35,48 @@ class ChamferDistanceTestCase(unittest.TestCase):
         y.requires_grad = True
         print(gradcheck(ChamferFunction.apply, [x.cuda(), y.cuda()]))
 
+    def test_chamfer_dist_cpu(self):
+        x = torch.rand(4, 64, 3).double()
+        y = torch.rand(4, 128, 3).double()
+        x.requires_grad = True
+        y.requires_grad = True
+        self.assertTrue(gradcheck(ChamferFunction.apply, [x, y]))
+
+    def test_cpu_matches_brute_force(self):
+        x = torch.rand(2, 500, 3)
+        y = torch.rand(2, 700, 3)
+        dist1, dist2 = ChamferFunction.apply(x, y)
+        ref1, ref2 = brute_force(x, y)
+        self.assertTrue(torch.allclose(dist1, ref1, atol=1e-6))
+        self.assertTrue(torch.allclose(dist2, ref2, atol=1e-6))
+
+    def test_cpu_chunks_and_kdtree(self):
+        x = torch.rand(2, 300, 3)
+        y = torch.rand(2, 400, 3)
+        ref1, ref2 = brute_force(x, y)
+        limits = chamfer_dist.MAX_BLOCK_PAIRS, chamfer_dist.KDTREE_MIN_PAIRS
+        try:
+            # tiny blocks, then every cloud through the KD-tree
+            for max_block_pairs, kdtree_min_pairs in [(1000, limits[1]), (limits[0], 1)]:
+                chamfer_dist.MAX_BLOCK_PAIRS, chamfer_dist.KDTREE_MIN_PAIRS = max_block_pairs, kdtree_min_pairs
+                dist1, dist2 = ChamferFunction.apply(x, y)
+                self.assertTrue(torch.allclose(dist1, ref1, atol=1e-6))
+                self.assertTrue(torch.allclose(dist2, ref2, atol=1e-6))
+        finally:
+            chamfer_dist.MAX_BLOCK_PAIRS, chamfer_dist.KDTREE_MIN_PAIRS = limits
+
+    def test_autocast_stays_fp32(self):
+        x = torch.rand(2, 300, 3).bfloat16().requires_grad_()
+        y = torch.rand(2, 400, 3)
+        ref1, ref2 = brute_force(x.float(), y)
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            dist1, dist2 = ChamferFunction.apply(x, y)
+        self.assertEqual(dist1.dtype, torch.float32)
+        self.assertTrue(torch.allclose(dist1, ref1, atol=1e-6))
+        self.assertTrue(torch.allclose(dist2, ref2, atol=1e-6))
+        (dist1.mean() + dist2.mean()).backward()
+        self.assertEqual(x.grad.dtype, torch.bfloat16)
+
 
 
 if __name__ == '__main__':
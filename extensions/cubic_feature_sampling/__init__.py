@@ -7,13 +7,18 @@
 
 import torch
 
-import cubic_feature_sampling
+try:
+    import cubic_feature_sampling
+except ImportError:
+    # CUDA-only extension, not needed to import the models on CPU-only machines
+    cubic_feature_sampling = None
 
 
 class CubicFeatureSamplingFunction(torch.autograd.Function):
     @staticmethod
     def forward(ctx, ptcloud, cubic_features, neighborhood_size=1):
         scale = cubic_features.size(2)
+        assert cubic_feature_sampling is not None, 'the cubic_feature_sampling CUDA extension is not installed'
         point_features, grid_pt_indexes = cubic_feature_sampling.forward(scale, neighborhood_size, ptcloud,
                                                                          cubic_features)
         ctx.save_for_backward(torch.Tensor([scale]), torch.Tensor([neighborhood_size]), grid_pt_indexes)
@@ -23,7 +23,11 @@ import numpy as np
 import torch
 from torch import nn
 from torch.autograd import Function
-import emd
+try:
+    import emd
+except ImportError:
+    # CUDA-only extension, not needed to import the models on CPU-only machines
+    emd = None
 
 
 
@@ -32,6 +36,7 @@ class emdFunction(Function):
     @staticmethod
     def forward(ctx, xyz1, xyz2, eps, iters):
 
+        assert emd is not None, 'the emd CUDA extension is not installed'
         batchsize, n, _ = xyz1.size()
         _, m, _ = xyz2.size()
 
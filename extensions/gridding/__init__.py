@@ -7,12 +7,17 @@
 
 import torch
 
-import gridding
+try:
+    import gridding
+except ImportError:
+    # CUDA-only extension, not needed to import the models on CPU-only machines
+    gridding = None
 
 
 class GriddingFunction(torch.autograd.Function):
     @staticmethod
     def forward(ctx, scale, ptcloud):
+        assert gridding is not None, 'the gridding CUDA extension is not installed'
         grid, grid_pt_weights, grid_pt_indexes = gridding.forward(-scale, scale - 1, -scale, scale - 1, -scale,
                                                                   scale - 1, ptcloud)
         # print(grid.size())             # torch.Size(batch_size, n_grid_vertices)
@@ -7,12 +7,17 @@
 
 import torch
 
-import gridding_distance
+try:
+    import gridding_distance
+except ImportError:
+    # CUDA-only extension, not needed to import the models on CPU-only machines
+    gridding_distance = None
 
 
 class GriddingDistanceFunction(torch.autograd.Function):
     @staticmethod
     def forward(ctx, min_x, max_x, min_y, max_y, min_z, max_z, pred_cloud, gt_cloud):
+        assert gridding_distance is not None, 'the gridding_distance CUDA extension is not installed'
         pred_grid, pred_grid_pt_weights, pred_grid_pt_indexes = gridding_distance.forward(
             min_x, max_x, min_y, max_y, min_z, max_z, pred_cloud)
         # print(pred_grid.size())               # torch.Size(batch_size, n_grid_vertices, 8)
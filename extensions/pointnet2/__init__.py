@@ -0,0 +1,2 @@
+# pointnet2_ops with a pure PyTorch fallback, see pointnet2_utils.py
+from . import pointnet2_utils
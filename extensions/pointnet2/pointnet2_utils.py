@@ -0,0 +1,169 @@
+# Drop-in replacement for pointnet2_ops.pointnet2_utils.
+#
+# CUDA tensors go to the compiled pointnet2_ops kernels (when they are installed),
+# everything else to the vectorized PyTorch implementations below, so the models
+# also run on CPU-only machines. The *_torch functions follow the semantics of the
+# kernels (index dtypes, tie breaking, FPS skipping points at the origin) and are
+# differentiable through autograd where the kernels define a backward.
+
+import warnings
+import torch
+
+try:
+    from pointnet2_ops import pointnet2_utils as _cuda_ops
+except ImportError:
+    _cuda_ops = None
+
+# number of query points per block in the chunked neighbour searches
+CHUNK_SIZE = 4096
+
+# TorchScript version of furthest_point_sample_torch, see _furthest_point_sample_scripted
+_fps_scripted = None
+
+
+def _use_cuda_ops(*tensors):
+    # the kernels are invisible to the tracer, a traced graph would keep their output as a constant
+    return _cuda_ops is not None and not torch.jit.is_tracing() and all(t.is_cuda for t in tensors)
+
+
+def furthest_point_sample_torch(xyz: torch.Tensor, npoint: int) -> torch.Tensor:
+    '''
+        xyz : B N 3 tensor, npoint : number of samples
+        ----------------------
+        idx : B npoint int32 tensor, starts at point 0 like the kernel,
+              points with squared norm <= 1e-3 are never picked (kernel behaviour)
+    '''
+    B, N, _ = xyz.shape
+    batch = torch.arange(B, device=xyz.device)
+    valid = (xyz ** 2).sum(-1) > 1e-3
+    dist = torch.full((B, N), 1e10, dtype=xyz.dtype, device=xyz.device).masked_fill(~valid, -1)
+    idx = torch.zeros(B, npoint, dtype=torch.long, device=xyz.device)
+    farthest = torch.zeros(B, dtype=torch.long, device=xyz.device)
+    for i in range(1, npoint):
+        d = ((xyz - xyz[batch, farthest].unsqueeze(1)) ** 2).sum(-1)
+        dist = torch.where(valid, torch.minimum(dist, d), dist)
+        farthest = dist.argmax(-1)
+        idx[:, i] = farthest
+    return idx.int()
+
+
+def _furthest_point_sample_scripted():
+    # while tracing (TorchScript / ONNX export) the sampling loop is recorded as one loop node
+    # instead of npoint unrolled steps, which keeps the exported graphs small and quick to load
+    global _fps_scripted
+    if _fps_scripted is None:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning)
+            _fps_scripted = torch.jit.script(furthest_point_sample_torch)
+    return _fps_scripted
+
+
+def gather_operation_torch(features, idx):
+    '''
+        features : B C N tensor, idx : B npoint tensor
+        ----------------------
+        B C npoint tensor
+    '''
+    idx = idx.long().unsqueeze(1).expand(-1, features.shape[1], -1)
+    return torch.gather(features, 2, idx)
+
+
+def three_nn_torch(unknown, known, chunk_size=CHUNK_SIZE):
+    '''
+        unknown : B n 3 tensor, known : B m 3 tensor (m >= 3)
+        ----------------------
+        dist : B n 3 euclidean distances to the 3 nearest known points (ascending)
+        idx : B n 3 int32 tensor
+        The n x m distance matrix is built chunk_size queries at a time.
+    '''
+    dists, idxs = [], []
+    for start in range(0, unknown.shape[1], chunk_size):
+        query = unknown[:, start:start + chunk_size]
+        d2 = ((query.unsqueeze(2) - known.unsqueeze(1)) ** 2).sum(-1)
+        d2, idx = torch.topk(d2, 3, dim=-1, largest=False, sorted=True)
+        dists.append(d2)
+        idxs.append(idx)
+    return torch.sqrt(torch.cat(dists, dim=1)), torch.cat(idxs, dim=1).int()
+
+
+def three_interpolate_torch(features, idx, weight):
+    '''
+        features : B c m tensor, idx : B n 3 tensor, weight : B n 3 tensor
+        ----------------------
+        B c n tensor, weighted sum of the features of the 3 neighbours
+    '''
+    B, c, _ = features.shape
+    n = idx.shape[1]
+    neighbours = gather_operation_torch(features, idx.reshape(B, n * 3)).view(B, c, n, 3)
+    return (neighbours * weight.unsqueeze(1)).sum(-1)
+
+
+def ball_query_torch(radius, nsample, xyz, new_xyz, chunk_size=CHUNK_SIZE):
+    '''
+        xyz : B N 3 tensor, new_xyz : B npoint 3 tensor
+        ----------------------
+        idx : B npoint nsample int32 tensor, the first nsample points (in index order) within radius,
+              padded with the first one found, 0 if there is none
+    '''
+    N = xyz.shape[1]
+    order = torch.arange(N, device=xyz.device)
+    idxs = []
+    for start in range(0, new_xyz.shape[1], chunk_size):
+        query = new_xyz[:, start:start + chunk_size]
+        d2 = ((query.unsqueeze(2) - xyz.unsqueeze(1)) ** 2).sum(-1)
+        candidates = torch.where(d2 < radius ** 2, order, N)
+        idx = torch.sort(candidates, dim=-1).values[..., :nsample]
+        if idx.shape[-1] < nsample:
+            idx = torch.cat([idx, idx.new_full(idx.shape[:-1] + (nsample - idx.shape[-1],), N)], dim=-1)
+        first = idx[..., :1]
+        idx = torch.where(idx == N, first, idx)
+        idxs.append(idx.masked_fill(idx == N, 0))
+    return torch.cat(idxs, dim=1).int()
+
+
+def grouping_operation_torch(features, idx):
+    '''
+        features : B C N tensor, idx : B npoint nsample tensor
+        ----------------------
+        B C npoint nsample tensor
+    '''
+    B, npoint, nsample = idx.shape
+    return gather_operation_torch(features, idx.reshape(B, npoint * nsample)).view(B, -1, npoint, nsample)
+
+
+def furthest_point_sample(xyz, npoint):
+    if _use_cuda_ops(xyz):
+        return _cuda_ops.furthest_point_sample(xyz, npoint)
+    if torch.jit.is_tracing():
+        return _furthest_point_sample_scripted()(xyz, npoint)
+    return furthest_point_sample_torch(xyz, npoint)
+
+
+def gather_operation(features, idx):
+    if _use_cuda_ops(features, idx):
+        return _cuda_ops.gather_operation(features, idx)
+    return gather_operation_torch(features, idx)
+
+
+def three_nn(unknown, known):
+    if _use_cuda_ops(unknown, known):
+        return _cuda_ops.three_nn(unknown, known)
+    return three_nn_torch(unknown, known)
+
+
+def three_interpolate(features, idx, weight):
+    if _use_cuda_ops(features, idx, weight):
+        return _cuda_ops.three_interpolate(features, idx, weight)
+    return three_interpolate_torch(features, idx, weight)
+
+
+def ball_query(radius, nsample, xyz, new_xyz):
+    if _use_cuda_ops(xyz, new_xyz):
+        return _cuda_ops.ball_query(radius, nsample, xyz, new_xyz)
+    return ball_query_torch(radius, nsample, xyz, new_xyz)
+
+
+def grouping_operation(features, idx):
+    if _use_cuda_ops(features, idx):
+        return _cuda_ops.grouping_operation(features, idx)
+    return grouping_operation_torch(features, idx)
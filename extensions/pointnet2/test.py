@@ -0,0 +1,123 @@
+# Parity tests of the PyTorch pointnet2 ops against straightforward loop references
+# (and against the compiled pointnet2_ops kernels when they are installed and CUDA is available)
+
+import os
+import sys
+import numpy as np
+import torch
+import unittest
+
+from torch.autograd import gradcheck
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir)))
+from extensions.pointnet2 import pointnet2_utils
+
+
+def reference_fps(xyz, npoint):
+    idx = np.zeros((xyz.shape[0], npoint), dtype=np.int64)
+    for b, points in enumerate(xyz):
+        dist = np.full(len(points), 1e10)
+        valid = (points ** 2).sum(-1) > 1e-3
+        last = 0
+        for i in range(1, npoint):
+            best, best_idx = -1, 0
+            for k in range(len(points)):
+                if not valid[k]:
+                    continue
+                dist[k] = min(dist[k], ((points[k] - points[last]) ** 2).sum())
+                if dist[k] > best:
+                    best, best_idx = dist[k], k
+            last = idx[b, i] = best_idx
+    return idx
+
+
+def reference_three_nn(unknown, known):
+    d2 = ((unknown[:, :, None] - known[:, None]) ** 2).sum(-1)
+    idx = np.argsort(d2, axis=-1, kind='stable')[..., :3]
+    return np.sqrt(np.take_along_axis(d2, idx, axis=-1)), idx
+
+
+def reference_ball_query(radius, nsample, xyz, new_xyz):
+    idx = np.zeros(new_xyz.shape[:2] + (nsample,), dtype=np.int64)
+    for b in range(xyz.shape[0]):
+        for j, query in enumerate(new_xyz[b]):
+            found = [k for k in range(xyz.shape[1]) if ((xyz[b, k] - query) ** 2).sum() < radius ** 2][:nsample]
+            if found:
+                idx[b, j] = found + [found[0]] * (nsample - len(found))
+    return idx
+
+
+class Pointnet2TorchTestCase(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def test_furthest_point_sample(self):
+        xyz = torch.rand(2, 300, 3) - 0.5
+        xyz[0, 5] = 0  # points at the origin are never sampled
+        idx = pointnet2_utils.furthest_point_sample(xyz, 64)
+        self.assertEqual(idx.dtype, torch.int32)
+        self.assertTrue(np.array_equal(idx.numpy(), reference_fps(xyz.double().numpy(), 64)))
+
+    def test_furthest_point_sample_traced(self):
+        # the traced graph keeps the sampling loop, so it follows the batch size and the input points
+        traced = torch.jit.trace(lambda xyz: pointnet2_utils.furthest_point_sample(xyz, 64), torch.rand(1, 300, 3))
+        xyz = torch.rand(3, 300, 3) - 0.5
+        self.assertTrue(torch.equal(traced(xyz), pointnet2_utils.furthest_point_sample(xyz, 64)))
+
+    def test_gather_operation(self):
+        features = torch.rand(2, 5, 100)
+        idx = torch.randint(0, 100, (2, 20), dtype=torch.int32)
+        out = pointnet2_utils.gather_operation(features, idx)
+        expected = torch.stack([features[b][:, idx[b].long()] for b in range(2)])
+        self.assertTrue(torch.equal(out, expected))
+
+    def test_three_nn(self):
+        unknown, known = torch.rand(2, 50, 3), torch.rand(2, 40, 3)
+        dist, idx = pointnet2_utils.three_nn_torch(unknown, known, chunk_size=16)
+        ref_dist, ref_idx = reference_three_nn(unknown.double().numpy(), known.double().numpy())
+        self.assertEqual(idx.dtype, torch.int32)
+        self.assertTrue(np.array_equal(idx.numpy(), ref_idx))
+        self.assertTrue(np.allclose(dist.numpy(), ref_dist, atol=1e-6))
+
+    def test_three_interpolate(self):
+        features = torch.rand(2, 4, 30, dtype=torch.double)
+        idx = torch.randint(0, 30, (2, 10, 3), dtype=torch.int32)
+        weight = torch.rand(2, 10, 3, dtype=torch.double)
+        out = pointnet2_utils.three_interpolate(features, idx, weight)
+        expected = torch.zeros(2, 4, 10, dtype=torch.double)
+        for b in range(2):
+            for j in range(10):
+                for k in range(3):
+                    expected[b, :, j] += features[b, :, idx[b, j, k]] * weight[b, j, k]
+        self.assertTrue(torch.allclose(out, expected))
+
+    def test_three_interpolate_grad(self):
+        features = torch.rand(1, 3, 8, dtype=torch.double, requires_grad=True)
+        idx = torch.randint(0, 8, (1, 5, 3), dtype=torch.int32)
+        weight = torch.rand(1, 5, 3, dtype=torch.double)
+        self.assertTrue(gradcheck(pointnet2_utils.three_interpolate, [features, idx, weight]))
+
+    def test_ball_query_grouping(self):
+        xyz, new_xyz = torch.rand(2, 60, 3), torch.rand(2, 12, 3)
+        idx = pointnet2_utils.ball_query_torch(0.3, 8, xyz, new_xyz, chunk_size=5)
+        self.assertTrue(np.array_equal(idx.numpy(), reference_ball_query(0.3, 8, xyz.numpy(), new_xyz.numpy())))
+        features = torch.rand(2, 4, 60)
+        grouped = pointnet2_utils.grouping_operation(features, idx)
+        self.assertTrue(torch.equal(grouped[1, :, 3], features[1][:, idx[1, 3].long()]))
+
+    @unittest.skipUnless(pointnet2_utils._cuda_ops is not None and torch.cuda.is_available(), 'needs pointnet2_ops and CUDA')
+    def test_cuda_parity(self):
+        xyz, known = torch.rand(2, 512, 3).cuda(), torch.rand(2, 128, 3).cuda()
+        self.assertTrue(torch.equal(pointnet2_utils.furthest_point_sample(xyz, 128).cpu(),
+                                    pointnet2_utils.furthest_point_sample(xyz.cpu(), 128)))
+        dist, idx = pointnet2_utils.three_nn(xyz, known)
+        dist_cpu, idx_cpu = pointnet2_utils.three_nn(xyz.cpu(), known.cpu())
+        self.assertTrue(torch.equal(idx.cpu(), idx_cpu))
+        self.assertTrue(torch.allclose(dist.cpu(), dist_cpu, atol=1e-5))
+        features, weight = torch.rand(2, 16, 128).cuda(), torch.rand(2, 512, 3).cuda()
+        self.assertTrue(torch.allclose(pointnet2_utils.three_interpolate(features, idx, weight).cpu(),
+                                       pointnet2_utils.three_interpolate(features.cpu(), idx_cpu, weight.cpu()), atol=1e-5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,7 @@
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from functools import partial, reduce
 from timm.models.layers import DropPath, trunc_normal_
 from extensions.chamfer_dist import ChamferDistanceL1
@@ -507,6 +508,12 @@ class PointTransformerDecoderEntry(PointTransformerDecoder):
         super().__init__(**dict(config))
 
 ######################################## Grouper ########################################  
+# DGCNN_Grouper edge convolutions: LOW_MEMORY_GROUPER = True runs them in blocks of at most
+# GROUPER_MAX_BLOCK_EDGES (query, neighbour) pairs without the B x 2C x N x k edge tensor
+# (see DGCNN_Grouper.edge_conv), False keeps get_graph_feature + the layer on the full tensor
+LOW_MEMORY_GROUPER = True
+GROUPER_MAX_BLOCK_EDGES = 2 ** 18
+
 class DGCNN_Grouper(nn.Module):
     def __init__(self, k = 16):
         super().__init__()
@@ -556,6 +563,18 @@ class DGCNN_Grouper(nn.Module):
 
         return new_coor, new_x
 
+    def get_knn_index(self, coor_q, coor_k, mask_k=None):
+        # coor: bs, 3, np -> bs, np_q, k indices into the bs * np_k flattened points of coor_k
+        # (only its real points when mask_k: bs, np_k is given)
+        batch_size = coor_k.size(0)
+        num_points_k = coor_k.size(2)
+        with torch.no_grad():
+            # _, idx = self.knn(coor_k, coor_q)  # bs k np
+            idx = knn_point(self.k, coor_k.transpose(-1, -2).contiguous(), coor_q.transpose(-1, -2).contiguous(), mask=mask_k) # B G M
+            assert idx.shape[-1] == self.k
+            idx_base = torch.arange(0, batch_size, device=coor_q.device).view(-1, 1, 1) * num_points_k
+            return idx + idx_base
+
     def get_graph_feature(self, coor_q, x_q, coor_k, x_k):
 
         # coor: bs, 3, np, x: bs, c, np
@@ -565,14 +584,7 @@ class DGCNN_Grouper(nn.Module):
         num_points_k = x_k.size(2)
         num_points_q = x_q.size(2)
 
-        with torch.no_grad():
-            # _, idx = self.knn(coor_k, coor_q)  # bs k np
-            idx = knn_point(k, coor_k.transpose(-1, -2).contiguous(), coor_q.transpose(-1, -2).contiguous()) # B G M
-            idx = idx.transpose(-1, -2).contiguous()
-            assert idx.shape[1] == k
-            idx_base = torch.arange(0, batch_size, device=x_q.device).view(-1, 1, 1) * num_points_k
-            idx = idx + idx_base
-            idx = idx.view(-1)
+        idx = self.get_knn_index(coor_q, coor_k).transpose(-1, -2).contiguous().view(-1)
         num_dims = x_k.size(1)
         x_k = x_k.transpose(2, 1).contiguous()
         feature = x_k.view(batch_size * num_points_k, -1)[idx, :]
@@ -581,11 +593,81 @@ class DGCNN_Grouper(nn.Module):
         feature = torch.cat((feature - x_q, x_q), dim=1)
         return feature
 
-    def forward(self, x, num):
+    def edge_conv(self, layer, coor_q, x_q, coor_k, x_k, mask_q=None, mask_k=None):
+        '''
+            layer(get_graph_feature(coor_q, x_q, coor_k, x_k)).max(dim=-1)[0], for layer = 1x1 Conv2d (no bias),
+            GroupNorm, LeakyReLU, without the edge tensor:
+            - the conv is split as W1 (f_j - f_i) + W2 f_i = W1 f_j + (W2 - W1) f_i, so W1 runs once per
+              point of x_k, W2 - W1 once per point of x_q, and the edges only add gathered columns;
+            - the GroupNorm statistics are sums over the edges, accumulated block by block;
+            - GroupNorm is an affine map per channel and LeakyReLU is increasing, so the max over the
+              neighbours is the normalized max (scale >= 0) or min (scale < 0) of the conv outputs.
+            Padded clouds: only the real points (mask_k) are neighbours, and only the edges of the real
+            queries (mask_q) enter the GroupNorm statistics. The outputs of the padding queries are meaningless.
+            INPUT: coor: bs, 3, np, x: bs, c, np, mask: bs, np
+            OUTPUT: bs, c_out, np_q
+        '''
+        conv, norm, act = layer
+        batch_size, num_dims, num_points_q = x_q.shape
+        idx = self.get_knn_index(coor_q, coor_k, mask_k) # bs np_q k
+        if mask_q is None:
+            mask_q = torch.ones(batch_size, num_points_q, dtype=torch.bool, device=x_q.device)
+        weight_q = mask_q.unsqueeze(-1).float() # bs np_q 1
+
+        weight = conv.weight.view(conv.out_channels, 2 * num_dims)
+        # in fp32 like GroupNorm under autocast
+        p = F.conv1d(x_k, weight[:, :num_dims, None]).float() # bs c_out np_k
+        q = F.conv1d(x_q, (weight[:, num_dims:] - weight[:, :num_dims])[:, :, None]).float() # bs c_out np_q
+        # statistics of the edges shifted by the group means of p and q, against cancellation in E[z^2] - E[z]^2
+        group_size = conv.out_channels // norm.num_groups
+        shift_p, shift_q = [t.view(batch_size, norm.num_groups, -1).mean(-1).repeat_interleave(group_size, dim=1).unsqueeze(1)
+                            for t in (p, q)] # bs 1 c_out
+        p, q = p.transpose(1, 2), q.transpose(1, 2) # bs np c_out
+        p_shifted, q_shifted = p - shift_p, q - shift_q
+        # sums over the edges of the p terms: every point of x_k weighted by its number of queries
+        with torch.no_grad():
+            count = torch.zeros(batch_size * p.size(1), device=p.device).scatter_add(0, idx.view(-1), weight_q.expand(-1, -1, self.k).reshape(-1))
+            count = count.view(batch_size, -1, 1)
+        q_weighted = q_shifted * weight_q
+        z_sum = (count * p_shifted).sum(1) + self.k * q_weighted.sum(1)
+        z_sqsum = (count * p_shifted ** 2).sum(1) + self.k * (q_shifted * q_weighted).sum(1)
+
+        p_table = p.flatten(0, 1) # bs*np_k c_out
+        chunk_size = max(1, GROUPER_MAX_BLOCK_EDGES // (batch_size * self.k))
+        z_max, z_min = [], []
+        for start in range(0, num_points_q, chunk_size):
+            p_j = p_table[idx[:, start:start + chunk_size]] # bs n k c_out
+            z_max.append(p_j.max(2)[0])
+            z_min.append(p_j.min(2)[0])
+            # cross term 2 (p_j - shift_p) (q_i - shift_q) of the squares
+            z_sqsum = z_sqsum + 2 * ((p_j.sum(2) - self.k * shift_p) * q_weighted[:, start:start + chunk_size]).sum(1)
+        z_max = (torch.cat(z_max, dim=1) + q).transpose(1, 2) # bs c_out np_q
+        z_min = (torch.cat(z_min, dim=1) + q).transpose(1, 2)
+
+        num_edges = group_size * self.k * mask_q.sum(-1, keepdim=True) # bs 1
+        mean = z_sum.view(batch_size, norm.num_groups, group_size).sum(-1) / num_edges
+        var = (z_sqsum.view(batch_size, norm.num_groups, group_size).sum(-1) / num_edges - mean ** 2).clamp(min=0)
+        mean = mean.repeat_interleave(group_size, dim=1) + (shift_p + shift_q).squeeze(1) # bs c_out
+        scale = norm.weight / torch.sqrt(var.repeat_interleave(group_size, dim=1) + norm.eps)
+        f = torch.where((scale >= 0).unsqueeze(-1), z_max, z_min)
+        f = (f - mean.unsqueeze(-1)) * scale.unsqueeze(-1) + norm.bias.view(1, -1, 1)
+        return act(f)
+
+    def graph_layer(self, layer, coor_q, x_q, coor_k, x_k, mask_q=None, mask_k=None):
+        if LOW_MEMORY_GROUPER:
+            return self.edge_conv(layer, coor_q, x_q, coor_k, x_k, mask_q, mask_k)
+        assert mask_q is None and mask_k is None, 'padded clouds need LOW_MEMORY_GROUPER'
+        f = self.get_graph_feature(coor_q, x_q, coor_k, x_k)
+        f = layer(f)
+        return f.max(dim=-1, keepdim=False)[0]
+
+    def forward(self, x, num, mask=None):
         '''
             INPUT:
                 x : bs N 3
                 num : list e.g.[1024, 512]
+                mask : optional bs N, True for the real points of clouds padded with zeros at the end
+                       (FPS never picks the padding at the origin, so the centers are all real points)
             ----------------------
             OUTPUT:
 
@@ -597,24 +679,16 @@ class DGCNN_Grouper(nn.Module):
         coor = x
         f = self.input_trans(x)
 
-        f = self.get_graph_feature(coor, f, coor, f)
-        f = self.layer1(f)
-        f = f.max(dim=-1, keepdim=False)[0]
+        f = self.graph_layer(self.layer1, coor, f, coor, f, mask_q=mask, mask_k=mask)
 
         coor_q, f_q = self.fps_downsample(coor, f, num[0])
-        f = self.get_graph_feature(coor_q, f_q, coor, f)
-        f = self.layer2(f)
-        f = f.max(dim=-1, keepdim=False)[0]
+        f = self.graph_layer(self.layer2, coor_q, f_q, coor, f, mask_k=mask)
         coor = coor_q
 
-        f = self.get_graph_feature(coor, f, coor, f)
-        f = self.layer3(f)
-        f = f.max(dim=-1, keepdim=False)[0]
+        f = self.graph_layer(self.layer3, coor, f, coor, f)
 
         coor_q, f_q = self.fps_downsample(coor, f, num[1])
-        f = self.get_graph_feature(coor_q, f_q, coor, f)
-        f = self.layer4(f)
-        f = f.max(dim=-1, keepdim=False)[0]
+        f = self.graph_layer(self.layer4, coor_q, f_q, coor, f)
         coor = coor_q
 
         coor = coor.transpose(-1, -2).contiguous()
@@ -699,7 +773,8 @@ class Fold(nn.Module):
 
         a = torch.linspace(-1., 1., steps=step, dtype=torch.float).view(1, step).expand(step, step).reshape(1, -1)
         b = torch.linspace(-1., 1., steps=step, dtype=torch.float).view(step, 1).expand(step, step).reshape(1, -1)
-        self.folding_seed = torch.cat([a, b], dim=0).cuda()
+        # buffer so it follows the module to its device, not saved in checkpoints
+        self.register_buffer('folding_seed', torch.cat([a, b], dim=0), persistent=False)
 
         self.folding1 = nn.Sequential(
             nn.Conv1d(in_channel + 2, hidden_dim, 1),
@@ -835,9 +910,15 @@ class PCTransformer(nn.Module):
             nn.init.constant_(m.bias, 0)
             nn.init.constant_(m.weight, 1.0)
 
-    def forward(self, xyz):
+    def forward(self, xyz, mask=None, coarse_only=False):
         bs = xyz.size(0)
-        coor, f = self.grouper(xyz, self.center_num) # b n c
+        if mask is None:
+            coor, f = self.grouper(xyz, self.center_num) # b n c
+        else:
+            # padded clouds (see DGCNN_Grouper.forward), past the grouper the model only sees real points
+            assert self.encoder_type == 'graph', 'padded clouds need the graph encoder'
+            xyz = xyz.masked_fill(~mask.unsqueeze(-1), 0)
+            coor, f = self.grouper(xyz, self.center_num, mask) # b n c
         pe =  self.pos_embed(coor)
         x = self.input_proj(f)
 
@@ -853,10 +934,16 @@ class PCTransformer(nn.Module):
         mem = self.mem_link(x)
 
         # query selection
-        query_ranking = self.query_ranking(coarse) # b n 1
+        # ranked in fp32, under bf16 / fp16 autocast the sigmoid scores tie and the selected queries change
+        with torch.autocast(coarse.device.type, enabled=False):
+            query_ranking = self.query_ranking(coarse.float()) # b n 1
         idx = torch.argsort(query_ranking, dim=1, descending=True) # b n 1
         coarse = torch.gather(coarse, 1, idx[:,:self.num_query].expand(-1, -1, coarse.size(-1)))
 
+        if coarse_only:
+            # the decoder only refines the features of the selected queries, not their positions
+            return None, coarse, 0
+
         if self.training:
             # add denoise task
             # first pick some point : 64?
@@ -903,6 +990,9 @@ class AdaPoinTr(nn.Module):
 
         self.fold_step = 8
         self.base_model = PCTransformer(config)
+        # fast preview at inference: the num_query coarse points of PCTransformer are returned as the
+        # completion, without the query decoder and the dense decoding (increase_dim, reduce_map, decode_head)
+        self.coarse_only = False
         
         if self.decoder_type == 'fold':
             self.factor = self.fold_step**2
@@ -947,8 +1037,15 @@ class AdaPoinTr(nn.Module):
 
         return loss_denoised, loss_recon
 
-    def forward(self, xyz):
-        q, coarse_point_cloud, denoise_length = self.base_model(xyz) # B M C and B M 3
+    def forward(self, xyz, mask=None):
+        '''
+            xyz : B N 3, mask : optional B N, True for the real points when clouds of different sizes
+            are padded to N (at the end) instead of upsampled
+        '''
+        coarse_only = self.coarse_only and not self.training
+        q, coarse_point_cloud, denoise_length = self.base_model(xyz, mask, coarse_only) # B M C and B M 3
+        if coarse_only:
+            return (coarse_point_cloud, coarse_point_cloud)
     
         B, M ,C = q.shape
 
@@ -8,24 +8,74 @@
 ###############################################################
 
 import torch
+import numpy as np
 import torch.nn as nn
+import torch.nn.functional as F
 from timm.models.layers import DropPath
-from pointnet2_ops import pointnet2_utils
+from extensions.pointnet2 import pointnet2_utils
 from utils.logger import *
 import einops
 
-def knn_point(nsample, xyz, new_xyz):
+# kNN search (knn_point): the B x S x N distance matrix is never built at once but in blocks of queries
+# of at most KNN_MAX_BLOCK_PAIRS point pairs (~128MB in float32), so the peak memory stays flat when
+# the clouds or the batch grow. CPU searches with more point pairs per cloud than KNN_KDTREE_MIN_PAIRS
+# go through a KD-tree (scipy, when installed). KNN_BACKEND forces one of the two:
+#   auto   : blocks, KD-tree for large CPU clouds
+#   blocks : blocks only
+#   kdtree : KD-tree whenever possible (CPU, not while tracing), blocks otherwise
+KNN_BACKENDS = ['auto', 'blocks', 'kdtree']
+KNN_BACKEND = 'auto'
+KNN_MAX_BLOCK_PAIRS = 2 ** 25
+KNN_KDTREE_MIN_PAIRS = 2 ** 22
+
+def _knn_blocks(nsample, xyz, new_xyz, mask=None):
+    if torch.jit.is_tracing():
+        # a single block, the traced / exported graphs follow the batch size
+        chunk_size = new_xyz.size(1)
+    else:
+        chunk_size = max(1, KNN_MAX_BLOCK_PAIRS // (xyz.size(0) * xyz.size(1)))
+    idxs = []
+    for start in range(0, new_xyz.size(1), chunk_size):
+        sqrdists = square_distance(new_xyz[:, start:start + chunk_size], xyz)
+        if mask is not None:
+            sqrdists = sqrdists.masked_fill(~mask.unsqueeze(1), float('inf'))
+        idxs.append(torch.topk(sqrdists, nsample, dim = -1, largest=False, sorted=False)[1])
+    return idxs[0] if len(idxs) == 1 else torch.cat(idxs, dim=1)
+
+def _knn_kdtree(nsample, xyz, new_xyz, mask=None):
+    from scipy.spatial import cKDTree
+    valid = [np.arange(xyz.size(1))] * xyz.size(0) if mask is None else [np.flatnonzero(m) for m in mask.numpy()]
+    if min(len(v) for v in valid) < nsample:
+        # fewer real points than neighbours: the blocks fill the neighbourhood up with padded points
+        return _knn_blocks(nsample, xyz, new_xyz, mask)
+    xyz, new_xyz = xyz.detach().double().numpy(), new_xyz.detach().double().numpy()
+    # tree of the real points only, its indices mapped back to the padded cloud
+    idx = np.stack([v[cKDTree(points[v]).query(queries, k=nsample, workers=-1)[1].reshape(len(queries), nsample)]
+                    for points, queries, v in zip(xyz, new_xyz, valid)])
+    return torch.from_numpy(idx)
+
+def _use_kdtree(xyz, new_xyz):
+    if KNN_BACKEND == 'blocks' or xyz.is_cuda or torch.jit.is_tracing():
+        return False
+    return KNN_BACKEND == 'kdtree' or xyz.size(1) * new_xyz.size(1) >= KNN_KDTREE_MIN_PAIRS
+
+def knn_point(nsample, xyz, new_xyz, mask=None):
     """
     Input:
         nsample: max sample number in local region
         xyz: all points, [B, N, C]
         new_xyz: query points, [B, S, C]
+        mask: optional, True for the real points of xyz (padded clouds), [B, N]
     Return:
-        group_idx: grouped points index, [B, S, nsample]
+        group_idx: grouped points index, [B, S, nsample] (the neighbours are not sorted by distance)
     """
-    sqrdists = square_distance(new_xyz, xyz)
-    _, group_idx = torch.topk(sqrdists, nsample, dim = -1, largest=False, sorted=False)
-    return group_idx
+    assert KNN_BACKEND in KNN_BACKENDS, f'unexpected KNN_BACKEND {KNN_BACKEND}, expected one of {KNN_BACKENDS}'
+    if _use_kdtree(xyz, new_xyz):
+        try:
+            return _knn_kdtree(nsample, xyz, new_xyz, mask)
+        except ImportError:
+            pass
+    return _knn_blocks(nsample, xyz, new_xyz, mask)
 
 def square_distance(src, dst):
     """
@@ -43,11 +93,58 @@ def square_distance(src, dst):
     """
     B, N, _ = src.shape
     _, M, _ = dst.shape
-    dist = -2 * torch.matmul(src, dst.permute(0, 2, 1))
-    dist += torch.sum(src ** 2, -1).view(B, N, 1)
-    dist += torch.sum(dst ** 2, -1).view(B, 1, M)
+    # always in fp32: under bf16 / fp16 autocast the expansion cancels out and scrambles the neighbours
+    with torch.autocast(src.device.type, enabled=False):
+        src, dst = src.float(), dst.float()
+        dist = -2 * torch.matmul(src, dst.permute(0, 2, 1))
+        dist += torch.sum(src ** 2, -1).view(B, N, 1)
+        dist += torch.sum(dst ** 2, -1).view(B, 1, M)
     return dist   
 
+def attention_softmax(attn):
+    """
+    softmax over the last dim, computed in fp32 also under autocast and returned in the dtype of the scores
+    """
+    return attn.softmax(dim=-1, dtype=torch.float32).to(attn.dtype)
+
+def _has_fused_attention():
+    # F.scaled_dot_product_attention with the scale argument: torch >= 2.1
+    try:
+        q = torch.zeros(1, 1, 1, 1)
+        F.scaled_dot_product_attention(q, q, q, scale=1.)
+    except (AttributeError, TypeError):
+        return False
+    return True
+
+# Attention / CrossAttention go through the fused kernels of F.scaled_dot_product_attention (flash,
+# memory-efficient, fused CPU), which never build the B x h x N x M attention matrix. With
+# FUSED_ATTENTION = False (and on older torch versions) the explicit matmul / softmax / dropout ops are used.
+FUSED_ATTENTION = _has_fused_attention()
+
+def scaled_dot_product_attention(q, k, v, scale, attn_drop, mask=None):
+    """
+    Input:
+        q: queries, [B, h, N, d]
+        k, v: keys and values, [B, h, M, d]
+        scale: factor of the scores
+        attn_drop: dropout module on the attention weights
+        mask: [N, M], 1 (> 0) where the query must not attend to the key
+    Return:
+        x: attention output, [B, h, N, d]
+    """
+    if FUSED_ATTENTION:
+        attn_mask = None if mask is None else ~(mask > 0)
+        dropout_p = attn_drop.p if attn_drop.training else 0.
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p, scale=scale)
+
+    attn = (q @ k.transpose(-2, -1)) * scale
+    if mask is not None:
+        mask_value = -torch.finfo(attn.dtype).max
+        attn = attn.masked_fill(mask > 0, mask_value) # B h N M
+    attn = attention_softmax(attn)
+    attn = attn_drop(attn)
+    return attn @ v
+
 def index_points(points, idx):
     """
     Input:
@@ -102,19 +199,10 @@ class Attention(nn.Module):
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]   # make torchscript happy (cannot use tensor as tuple)
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-
-        if mask is not None:
-            # 1 for mask, 0 for not mask
-            # mask shape N, N
-            mask_value = -torch.finfo(attn.dtype).max
-            mask = (mask > 0)  # convert to boolen, shape torch.BoolTensor[N, N]
-            attn = attn.masked_fill(mask, mask_value) # B h N N
+        # mask shape N, N: 1 for mask, 0 for not mask
+        x = scaled_dot_product_attention(q, k, v, self.scale, self.attn_drop, mask=mask)
 
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -147,11 +235,9 @@ class CrossAttention(nn.Module):
         k = self.k_map(k).view(B, NK, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
         v = self.v_map(v).view(B, NK, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        x = scaled_dot_product_attention(q, k, v, self.scale, self.attn_drop)
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -250,7 +336,7 @@ class DeformableLocalAttention(nn.Module):
 
         attn = torch.einsum('b m c, b n c -> b m n', q, k) # BHN, k, k
         attn = attn.mul(self.scale)
-        attn = attn.softmax(dim=-1)
+        attn = attention_softmax(attn)
         attn = self.attn_drop(attn)
 
         out = torch.einsum('b m n, b n c -> b m c', attn, v) # BHN k c
@@ -373,7 +459,7 @@ class DeformableLocalCrossAttention(nn.Module):
 
             attn = torch.einsum('b m c, b n c -> b m n', q, k) # BHN, 1, k
             attn = attn.mul(self.scale)
-            attn = attn.softmax(dim=-1)
+            attn = attention_softmax(attn)
             attn = self.attn_drop(attn)
 
             out = torch.einsum('b m n, b n c -> b m c', attn, v) # BHN 1 c
@@ -474,7 +560,7 @@ class DeformableLocalCrossAttention(nn.Module):
 
             attn = torch.einsum('b m c, b n c -> b m n', q, k) # BHN, 1, k
             attn = attn.mul(self.scale)
-            attn = attn.softmax(dim=-1)
+            attn = attention_softmax(attn)
             attn = self.attn_drop(attn)
 
             out = torch.einsum('b m n, b n c -> b m c', attn, v) # BHN 1 c
@@ -604,7 +690,7 @@ class improvedDeformableLocalCrossAttention(nn.Module):
 
         attn = torch.einsum('b m c, b n c -> b m n', q, k) # BHN, 1, k
         attn = attn.mul(self.scale)
-        attn = attn.softmax(dim=-1)
+        attn = attention_softmax(attn)
         attn = self.attn_drop(attn)
 
         out = torch.einsum('b m n, b n c -> b m c', attn, v) # BHN 1 c
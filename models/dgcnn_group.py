@@ -1,6 +1,6 @@
 import torch
 from torch import nn
-from pointnet2_ops import pointnet2_utils
+from extensions.pointnet2 import pointnet2_utils
 # from knn_cuda import KNN
 # knn = KNN(k=16, transpose_mode=False)
 
@@ -0,0 +1,187 @@
+# Parity tests of the memory-saving paths of the models against the straightforward ones: the fused
+# attention (F.scaled_dot_product_attention) against the explicit matmul / softmax ops of
+# models/Transformer_utils.py and models/Transformer.py, the blockwise edge convolutions of the
+# AdaPoinTr DGCNN_Grouper against the full edge tensor, padded (masked) clouds against the clouds alone,
+# the AdaPoinTr coarse preview against the coarse points of the full forward
+
+import os
+import sys
+import torch
+import unittest
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+sys.path.append(ROOT_DIR)
+from models import AdaPoinTr, Transformer, Transformer_utils
+
+
+def explicit_and_fused(fn):
+    '''outputs of fn() with the explicit ops, then with the fused kernel'''
+    fused = Transformer_utils.FUSED_ATTENTION
+    try:
+        Transformer_utils.FUSED_ATTENTION = False
+        explicit_out = fn()
+        Transformer_utils.FUSED_ATTENTION = True
+        fused_out = fn()
+    finally:
+        Transformer_utils.FUSED_ATTENTION = fused
+    return explicit_out, fused_out
+
+
+@unittest.skipUnless(Transformer_utils.FUSED_ATTENTION, 'needs torch >= 2.1 (scaled_dot_product_attention)')
+class FusedAttentionTestCase(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def test_attention(self):
+        for module in [Transformer_utils.Attention, Transformer.Attention]:
+            attn = module(96, num_heads=6).eval()
+            x = torch.rand(2, 50, 96)
+            explicit, fused = explicit_and_fused(lambda: attn(x))
+            self.assertTrue(torch.allclose(explicit, fused, atol=1e-5))
+
+    def test_attention_mask(self):
+        # the denoise mask of AdaPoinTr: the first queries do not see the last ones
+        attn = Transformer_utils.Attention(96, num_heads=6).eval()
+        x = torch.rand(2, 50, 96)
+        mask = torch.zeros(50, 50)
+        mask[:-10, -10:] = 1.
+        explicit, fused = explicit_and_fused(lambda: attn(x, mask=mask))
+        self.assertTrue(torch.allclose(explicit, fused, atol=1e-5))
+        x[:, -10:] = torch.rand(2, 10, 96)
+        self.assertTrue(torch.allclose(attn(x, mask=mask)[:, :-10], fused[:, :-10], atol=1e-5))
+
+    def test_cross_attention(self):
+        for module in [Transformer_utils.CrossAttention, Transformer.CrossAttention]:
+            attn = module(96, 48, num_heads=6).eval()
+            q, v = torch.rand(2, 30, 96), torch.rand(2, 70, 96)
+            explicit, fused = explicit_and_fused(lambda: attn(q, v))
+            self.assertTrue(torch.allclose(explicit, fused, atol=1e-5))
+
+    def test_gradients(self):
+        attn = Transformer_utils.Attention(96, num_heads=6).train()
+        x = torch.rand(2, 50, 96, dtype=torch.double, requires_grad=True)
+        attn.double()
+
+        def grads():
+            x.grad = None
+            attn.zero_grad()
+            attn(x).pow(2).sum().backward()
+            return [x.grad.clone()] + [p.grad.clone() for p in attn.parameters()]
+        explicit, fused = explicit_and_fused(grads)
+        for g_explicit, g_fused in zip(explicit, fused):
+            self.assertTrue(torch.allclose(g_explicit, g_fused, rtol=1e-6, atol=1e-6))
+
+    def test_bf16_autocast(self):
+        attn = Transformer_utils.Attention(96, num_heads=6).eval()
+        x = torch.rand(2, 50, 96)
+        reference = attn(x)
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            explicit, fused = explicit_and_fused(lambda: attn(x))
+        self.assertTrue(torch.allclose(explicit.float(), reference, atol=2e-2))
+        self.assertTrue(torch.allclose(fused.float(), reference, atol=2e-2))
+
+    def test_traced(self):
+        attn = Transformer_utils.Attention(96, num_heads=6).eval()
+        traced = torch.jit.trace(attn, torch.rand(1, 50, 96))
+        x = torch.rand(3, 50, 96)
+        self.assertTrue(torch.allclose(traced(x), attn(x), atol=1e-6))
+
+
+class LowMemoryGrouperTestCase(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.grouper = AdaPoinTr.DGCNN_Grouper(k=16)
+        # GroupNorm scales of both signs (the max over the neighbours turns into a min)
+        for layer in [self.grouper.layer1, self.grouper.layer2, self.grouper.layer3, self.grouper.layer4]:
+            torch.nn.init.normal_(layer[1].weight)
+            torch.nn.init.normal_(layer[1].bias)
+
+    def full_and_low_memory(self, fn):
+        low_memory, max_block_edges = AdaPoinTr.LOW_MEMORY_GROUPER, AdaPoinTr.GROUPER_MAX_BLOCK_EDGES
+        try:
+            AdaPoinTr.LOW_MEMORY_GROUPER = False
+            full = fn()
+            # small blocks: several per layer
+            AdaPoinTr.LOW_MEMORY_GROUPER, AdaPoinTr.GROUPER_MAX_BLOCK_EDGES = True, 2000
+            return full, fn()
+        finally:
+            AdaPoinTr.LOW_MEMORY_GROUPER, AdaPoinTr.GROUPER_MAX_BLOCK_EDGES = low_memory, max_block_edges
+
+    def test_edge_conv(self):
+        coor = torch.rand(2, 3, 300)
+        f = self.grouper.input_trans(coor)
+        coor_q, f_q = coor[:, :, :100], f[:, :, :100]
+        full, low_memory = self.full_and_low_memory(lambda: self.grouper.graph_layer(self.grouper.layer1, coor_q, f_q, coor, f))
+        self.assertEqual(low_memory.shape, (2, 32, 100))
+        self.assertTrue(torch.allclose(full, low_memory, atol=1e-5))
+
+    def test_forward_backward(self):
+        x = torch.rand(2, 512, 3)
+
+        def run():
+            self.grouper.zero_grad()
+            coor, f = self.grouper(x, [128, 64])
+            f.sin().sum().backward()
+            return [coor, f] + [p.grad.clone() for p in self.grouper.parameters()]
+        full, low_memory = self.full_and_low_memory(run)
+        self.assertTrue(torch.equal(full[0], low_memory[0]))
+        for t_full, t_low_memory in zip(full[1:], low_memory[1:]):
+            self.assertLess((t_full - t_low_memory).abs().max(), 1e-5 * t_full.abs().max())
+
+
+class RaggedInputTestCase(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.small, self.large = torch.rand(1, 300, 3) - 0.5, torch.rand(1, 500, 3) - 0.5
+        self.padded = torch.zeros(2, 500, 3)
+        self.padded[0, :300], self.padded[1] = self.small[0], self.large[0]
+        self.mask = torch.zeros(2, 500, dtype=torch.bool)
+        self.mask[0, :300], self.mask[1] = True, True
+
+    def test_knn_mask(self):
+        backend = Transformer_utils.KNN_BACKEND
+        try:
+            for knn_backend in ['blocks', 'kdtree']:
+                Transformer_utils.KNN_BACKEND = knn_backend
+                idx = Transformer_utils.knn_point(8, self.padded, self.padded, mask=self.mask)
+                self.assertLess(idx[0].max(), 300)
+                self.assertTrue(torch.equal(idx[0].sort(-1)[0][:300], Transformer_utils.knn_point(8, self.small, self.small)[0].sort(-1)[0]))
+                # fewer real points than neighbours: every neighbourhood holds all of them
+                mask = self.mask.clone()
+                mask[0, 5:] = False
+                idx = Transformer_utils.knn_point(8, self.padded, self.padded, mask=mask)
+                self.assertEqual(idx.shape, (2, 500, 8))
+                self.assertTrue(all(set(range(5)) <= set(row.tolist()) for row in idx[0]))
+        finally:
+            Transformer_utils.KNN_BACKEND = backend
+
+    def test_grouper(self):
+        grouper = AdaPoinTr.DGCNN_Grouper(k=16)
+        coor, f = grouper(self.padded, [128, 64], self.mask)
+        for i, cloud in enumerate([self.small, self.large]):
+            coor_alone, f_alone = grouper(cloud, [128, 64])
+            self.assertTrue(torch.equal(coor[i], coor_alone[0]))
+            self.assertTrue(torch.allclose(f[i], f_alone[0], atol=1e-5))
+
+
+class CoarsePreviewTestCase(unittest.TestCase):
+    def test_coarse_only(self):
+        from models import build_model_from_cfg
+        from utils.config import cfg_from_yaml_file
+        torch.manual_seed(0)
+        config = cfg_from_yaml_file(os.path.join(ROOT_DIR, 'cfgs', 'predefhull_models', 'AdaPoinTr.yaml'))
+        model = build_model_from_cfg(config.model).eval()
+        xyz = torch.rand(2, 2048, 3) - 0.5
+        with torch.no_grad():
+            coarse, dense = model(xyz)
+            model.coarse_only = True
+            preview = model(xyz)
+        self.assertEqual(preview[-1].shape, (2, model.num_query, 3))
+        self.assertTrue(torch.equal(preview[-1], coarse))
+        # training ignores it
+        model.train()
+        self.assertEqual(len(model(xyz)), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -81,7 +81,7 @@ def test_pointnet2():
         
         return True
     except ImportError:
-        print(f"  ⚠️  PointNet++ not installed (optional)")
+        print(f"  ⚠️  PointNet++ not installed (optional, the PyTorch fallback in extensions/pointnet2 is used)")
         print(f"    To install: bash install_pointnet2.sh")
         return True  # PointNet++ is optional
     except Exception as e:
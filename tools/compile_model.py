@@ -0,0 +1,143 @@
+##############################################################
+# Frozen / compiled inference graphs of the completion models
+#
+#   python tools/compile_model.py <config> <checkpoint> --mode script --device cpu
+# traces the model in eval mode, caches the frozen graph next to the checkpoint
+# and prints the eager vs compiled latency.
+###############################################################
+import argparse
+import hashlib
+import os
+import sys
+import time
+import warnings
+import torch
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, '../'))
+
+from tools import builder
+from utils.config import cfg_from_yaml_file
+
+# eager     : the nn.Module as is
+# script    : TorchScript trace of the eval forward, frozen (weights folded in, asserts and
+#             einops / shape branches gone), cached as <checkpoint>.<key>.ts
+# compile   : torch.compile (inductor), kernels cached under <checkpoint>.inductor/
+COMPILE_MODES = ['eager', 'script', 'compile']
+ARTIFACT_SUFFIX = '.ts'
+
+def artifact_path(model_config, model_checkpoint, n_points=2048, device='cpu', variant=''):
+    '''
+        Path of the cached frozen graph, next to the checkpoint. The key covers the config,
+        the checkpoint (size and modification time), the torch version, the number of input
+        points, the device type and the model variant (e.g. 'int8' for the quantized model),
+        a change of any of them traces a new graph.
+    '''
+    sha = hashlib.sha1()
+    with open(model_config, 'rb') as f:
+        sha.update(f.read())
+    stat = os.stat(model_checkpoint)
+    device_type = torch.device(device).type
+    sha.update(f'{stat.st_size}:{stat.st_mtime_ns}:{torch.__version__}:{n_points}:{device_type}'.encode())
+    if variant:
+        sha.update(f':{variant}'.encode())
+    return f'{os.path.splitext(model_checkpoint)[0]}.{sha.hexdigest()[:12]}{ARTIFACT_SUFFIX}'
+
+def example_input(batch_size=1, n_points=2048, device='cpu'):
+    # normalized cloud like the ones of TreeCompletionEngine.preprocess
+    generator = torch.Generator().manual_seed(0)
+    return (torch.rand(batch_size, n_points, 3, generator=generator) - 0.5).to(device)
+
+def trace_model(model, example):
+    '''
+        Frozen TorchScript graph of the eval forward. The graph is not tied to the batch size of
+        the example, the number of points is fixed. The pointnet2 ops take their PyTorch path while
+        tracing (see extensions/pointnet2), so no kernel output is baked into the graph as a constant.
+    '''
+    model.eval()
+    with torch.no_grad(), warnings.catch_warnings():
+        # the shape asserts of the forward are evaluated once while tracing and dropped
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        traced = torch.jit.trace(model, example, check_trace=False)
+        return torch.jit.freeze(traced)
+
+def optimize_model(model, mode, model_config=None, model_checkpoint=None, n_points=2048, device='cpu', variant=''):
+    '''
+        model in eval mode -> callable with the same outputs for B n_points 3 inputs.
+        With a config and checkpoint the traced graph is loaded from / saved to its artifact_path.
+    '''
+    assert mode in COMPILE_MODES, f'unexpected compile mode {mode}'
+    if mode == 'eager':
+        return model
+    if mode == 'compile':
+        if model_checkpoint is not None:
+            os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.splitext(model_checkpoint)[0] + '.inductor')
+        return torch.compile(model.eval(), dynamic=False)
+
+    path = None
+    if model_config is not None and model_checkpoint is not None:
+        path = artifact_path(model_config, model_checkpoint, n_points, device, variant)
+        if os.path.exists(path):
+            print(f'Loading frozen graph from {path}')
+            return torch.jit.load(path, map_location=device)
+    print('Tracing the model (once per checkpoint) ...')
+    traced = trace_model(model, example_input(1, n_points, device))
+    if path is not None:
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        torch.jit.save(traced, tmp_path)
+        os.replace(tmp_path, path)
+        print(f'Saved frozen graph to {path}')
+    return traced
+
+def benchmark(models, example, warmup=2, repeats=10):
+    '''
+        models : dict name -> callable, example : input tensor
+        ----------------------
+        dict name -> mean latency in seconds of one forward pass
+    '''
+    sync = torch.cuda.synchronize if example.is_cuda else (lambda: None)
+    latency = {}
+    with torch.no_grad():
+        for name, model in models.items():
+            for _ in range(warmup):
+                model(example)
+            sync()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                model(example)
+            sync()
+            latency[name] = (time.perf_counter() - start) / repeats
+    return latency
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model_config', help='yaml config file')
+    parser.add_argument('model_checkpoint', help='pretrained weight')
+    parser.add_argument('--mode', choices=COMPILE_MODES[1:], default='script', help='compiled variant to build')
+    parser.add_argument('--device', default='cpu', help='Device used for the benchmark')
+    parser.add_argument('--batch_size', type=int, default=1, help='clouds per forward pass in the benchmark')
+    parser.add_argument('--n_points', type=int, default=2048, help='points per input cloud')
+    parser.add_argument('--repeats', type=int, default=10, help='timed forward passes per variant')
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    config = cfg_from_yaml_file(args.model_config)
+    model = builder.model_builder(config.model)
+    builder.load_model(model, args.model_checkpoint)
+    model.to(args.device.lower())
+    model.eval()
+
+    optimized = optimize_model(model, args.mode, args.model_config, args.model_checkpoint,
+                               n_points=args.n_points, device=args.device.lower())
+    example = example_input(args.batch_size, args.n_points, args.device.lower())
+    with torch.no_grad():
+        drift = max((a - b).abs().max().item() for a, b in zip(model(example), optimized(example)))
+    latency = benchmark({'eager': model, args.mode: optimized}, example, repeats=args.repeats)
+
+    print(f'batch {args.batch_size} x {args.n_points} points on {args.device}:')
+    for name, seconds in latency.items():
+        print(f'   {name:8s} {seconds * 1000:8.1f} ms / forward')
+    print(f'   speedup  {latency["eager"] / latency[args.mode]:8.2f}x, max abs difference {drift:.2e}')
+
+if __name__ == '__main__':
+    main()
@@ -4,18 +4,29 @@
 ###############################################################
 import argparse
 import os
+import queue
+import threading
 import numpy as np
+import torch
 import cv2
 import sys
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(BASE_DIR, '../'))
 
 from tools import builder
+from tools.compile_model import optimize_model, COMPILE_MODES
+from tools.onnx_export import load_onnx_model
+from tools.quantize_model import quantize_model
 from utils.config import cfg_from_yaml_file
+from utils.precision import PRECISIONS, autocast_model
 from utils import misc
 from datasets.io import IO
+from utils.cube_shard import find_shards, SHARD_EXTENSION, FLIP_SUFFIX
 from datasets.data_transforms import Compose
 
+# model backends of TreeCompletionEngine: the compile modes plus onnxruntime on CPU
+ENGINE_BACKENDS = COMPILE_MODES + ['onnx']
+
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -25,8 +36,8 @@ def get_args():
     parser.add_argument(
         'model_checkpoint', 
         help = 'pretrained weight')
-    parser.add_argument('--pc_root', type=str, default='', help='Pc root')
-    parser.add_argument('--pc', type=str, default='', help='Pc file')   
+    parser.add_argument('--pc_root', type=str, default='', help='Pc root (if it holds cube shards, only the shards are used)')
+    parser.add_argument('--pc', type=str, default='', help='Pc file or cube shard (.shard)')   
     parser.add_argument(
         '--save_vis_img',
         action='store_true',
@@ -55,15 +66,417 @@ def get_args():
         'Default not saving the visualization images.')
     parser.add_argument(
         '--device', default='cuda:0', help='Device used for inference')
+    parser.add_argument(
+        '--batch_size', type=int, default=1, help='number of point clouds per forward pass (--pc_root only)')
+    parser.add_argument(
+        '--prefetch', type=int, default=2, 
+        help='batches read and prepared in the background while the model runs (0 = serial)')
+    parser.add_argument(
+        '--compile', choices=ENGINE_BACKENDS, default='eager',
+        help='script: frozen TorchScript graph cached next to the checkpoint, compile: torch.compile, '
+        'onnx: exported ONNX graph run by onnxruntime on CPU')
+    parser.add_argument(
+        '--threads', type=int, default=0, help='intra-op threads of the onnx backend (0 = all cores)')
+    parser.add_argument(
+        '--int8', action='store_true', default=False,
+        help='int8 dynamic quantized linear layers, CPU only')
+    parser.add_argument(
+        '--precision', choices=list(PRECISIONS), default='fp32',
+        help='autocast precision of the forward, bf16 on CPU / recent GPUs, fp16 on GPUs')
+    parser.add_argument(
+        '--ragged', action='store_true', default=False,
+        help='keep the cubes at their own size (padded batches with a mask) instead of upsampling them '
+        'to 2048 points, AdaPoinTr eager model')
+    parser.add_argument(
+        '--coarse_only', action='store_true', default=False,
+        help='fast preview: the 512 coarse points of AdaPoinTr per cube, no dense decoding')
     args = parser.parse_args()
 
     assert args.save_vis_img or args.save_xyz or args.save_ply or args.save_npy or (args.out_pc_root != '')
     assert args.model_config is not None
     assert args.model_checkpoint is not None
     assert (args.pc != '') or (args.pc_root != '')
+    assert args.batch_size >= 1
+    assert not (args.batch_size > 1 and args.save_vis_img), 'save_vis_img is only supported with batch_size 1'
+    assert not (engine_options(args) and args.save_vis_img), \
+        'save_vis_img is only supported with the eager fp32 model (no --compile, --int8, --precision, --ragged, --coarse_only)'
 
     return args
 
+def engine_options(args):
+    '''whether an option only TreeCompletionEngine supports is set (the model is then always run by the engine)'''
+    return args.compile != 'eager' or args.int8 or args.precision != 'fp32' or args.ragged or args.coarse_only
+
+PC_NORM_DATASETS = ['ShapeNet', 'PCN', 'ShapeNetHull', 'PCNHull']
+
+# flip test-time augmentation: x and z swapped, results are yielded as <name>_flip (FLIP_SUFFIX)
+FLIP_AXES = [2, 1, 0]
+
+def use_pc_norm(config):
+    return config.dataset.train._base_['NAME'] in PC_NORM_DATASETS
+
+def pc_norm(pc_ndarray):
+    """ normalize it to fit the model on ShapeNet-55/34, returns the values needed to undo it """
+    centroid = np.mean(pc_ndarray, axis=0)
+    pc_ndarray = pc_ndarray - centroid
+    m = np.max(np.sqrt(np.sum(pc_ndarray**2, axis=1)))
+    pc_ndarray = pc_ndarray / m
+    return pc_ndarray.astype(np.float32), centroid, m
+
+def build_transform(n_points=2048):
+    return Compose([{
+        'callback': 'UpSamplePoints',
+        'parameters': {
+            'n_points': n_points # tried changing to: 4048
+        },
+        'objects': ['input']
+    }, {
+        'callback': 'ToTensor',
+        'objects': ['input']
+    }])
+
+def pad_clouds(clouds):
+    '''
+        list of n_i 3 tensors -> B max(n_i) 3 tensor, every cloud padded with zeros at its end
+    '''
+    padded = clouds[0].new_zeros(len(clouds), max(len(x) for x in clouds), 3)
+    for i, x in enumerate(clouds):
+        padded[i, :len(x)] = x
+    return padded
+
+def save_outputs(dense_points, out_pc_root, name, save_npy=False, save_xyz=False, save_ply=False):
+    target_path = os.path.join(out_pc_root, name)
+    os.makedirs(target_path, exist_ok=True)
+
+    if save_npy:
+        np.save(os.path.join(target_path, 'fine.npy'), dense_points)
+
+    if save_xyz:
+        np.savetxt(os.path.join(out_pc_root, name + '_pred.xyz'), dense_points, fmt="%.6f", delimiter=' ')
+
+    if save_ply:
+        import open3d as o3d
+        # Create Open3D point cloud
+        pcd = o3d.geometry.PointCloud()
+        pcd.points = o3d.utility.Vector3dVector(dense_points)
+        # Save as PLY file
+        o3d.io.write_point_cloud(os.path.join(out_pc_root, name + '_pred.ply'), pcd)
+    return target_path
+
+# item of a cube stream that ends the current batch: it is completed with the cubes it has so far
+FLUSH_BATCH = object()
+
+def batched(items, batch_size):
+    '''
+        yields (names, arrays) chunks of at most batch_size from (name, array) pairs,
+        a FLUSH_BATCH item yields the chunk right away
+    '''
+    names, arrays = [], []
+    for item in items:
+        if item is not FLUSH_BATCH:
+            names.append(item[0])
+            arrays.append(item[1])
+        if len(arrays) == batch_size or (item is FLUSH_BATCH and len(arrays) > 0):
+            yield names, arrays
+            names, arrays = [], []
+    if len(arrays) > 0:
+        yield names, arrays
+
+def _put(q, item, stop):
+    '''blocking put that gives up once stop is set, returns whether the item was queued'''
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def prefetch(items, depth=2):
+    '''
+        Iterates `items` in a background thread, at most `depth` items ahead of the consumer
+        (bounded queue), so reading / cutting / preprocessing overlaps with the forward passes.
+        Errors of the producer are raised in the consumer. depth 0 iterates in the calling thread.
+    '''
+    if depth <= 0:
+        yield from items
+        return
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    end = object()
+
+    def produce():
+        try:
+            for item in items:
+                if not _put(q, (item, None), stop):
+                    return
+            _put(q, (end, None), stop)
+        except BaseException as e:
+            _put(q, (end, e), stop)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = q.get()
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        # consumer done or closed early: let the producer stop after its current item
+        stop.set()
+        thread.join()
+
+class BackgroundWriter(object):
+    '''
+        Runs write jobs in one background thread so the forward passes do not wait on the disk.
+        At most max_pending jobs are queued, submit() blocks beyond that (bounded memory).
+        close() waits for the queued jobs and raises the first error of a job.
+        Usage:
+            with BackgroundWriter() as writer:
+                writer.submit(save_outputs, dense_points, out_pc_root, name, save_npy=True)
+    '''
+    def __init__(self, max_pending=16):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            if self.error is not None:
+                continue
+            fn, args, kwargs = job
+            try:
+                fn(*args, **kwargs)
+            except BaseException as e:
+                self.error = e
+
+    def submit(self, fn, *args, **kwargs):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((fn, args, kwargs))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # do not hide the original error behind a failed write
+            try:
+                self.close()
+            except BaseException:
+                pass
+
+class TreeCompletionEngine(object):
+    '''
+        Keeps one model resident so that many cubes (and many trees) can be completed
+        without rebuilding the model or going through files.
+        Cubes are pushed through the model in batches of `batch_size` (B x n_points x 3),
+        while the next `prefetch_batches` batches are prepared in a background thread.
+        compile_mode 'script' / 'compile' replaces the model by a frozen graph (see tools/compile_model.py),
+        'onnx' by an onnxruntime CPU session with num_threads intra-op threads (see tools/onnx_export.py).
+        quantize runs the int8 dynamic quantized model on CPU (see tools/quantize_model.py),
+        precision 'bf16' / 'fp16' the forward under autocast (see utils/precision.py).
+        ragged keeps the cubes at their own size (between min_points and n_points) instead of upsampling
+        them to n_points by duplicating points: the batches are padded to their largest cube and the model
+        gets the mask of the real points (AdaPoinTr with the graph encoder, PyTorch model only).
+        coarse_only is the fast preview of AdaPoinTr: the num_query coarse points (512) of every cube,
+        without the query decoder and the dense decoding.
+        Usage:
+            engine = TreeCompletionEngine(model_config, model_checkpoint, device='cuda:0', batch_size=16)
+            dense_points = engine.complete(cube)  # cube: N 3 ndarray, dense_points: M 3 ndarray
+            dense_points_list = engine.complete_batch([cube_1, cube_2, ...])
+    '''
+    FLUSH_BATCH = FLUSH_BATCH
+
+    def __init__(self, model_config, model_checkpoint, device='cuda:0', n_points=2048, batch_size=1, 
+                 prefetch_batches=2, compile_mode='eager', num_threads=0, quantize=False, precision='fp32',
+                 ragged=False, coarse_only=False):
+        assert batch_size >= 1, f'batch_size has to be positive, got {batch_size}'
+        assert compile_mode in ENGINE_BACKENDS, f'unexpected compile mode {compile_mode}'
+        assert not (quantize and compile_mode == 'onnx'), 'the onnx backend runs the fp32 graph'
+        assert precision == 'fp32' or not (quantize or compile_mode == 'onnx'), \
+            f'precision {precision} only applies to the PyTorch fp32 model'
+        assert not ragged or compile_mode == 'eager', 'ragged batches need the eager PyTorch model (the graphs take one input)'
+        # onnxruntime and the quantized kernels run on the CPU whatever the device
+        self.device = 'cpu' if compile_mode == 'onnx' or quantize else device.lower()
+        self.quantize = quantize
+        self.precision = precision
+        self.batch_size = batch_size
+        self.n_points = n_points
+        self.prefetch_batches = prefetch_batches
+        # page-locked batches can be copied to the GPU asynchronously
+        self.pin_memory = self.device.startswith('cuda') and torch.cuda.is_available()
+        # init config
+        self.config = cfg_from_yaml_file(model_config)
+        self.ragged = ragged
+        self.coarse_only = coarse_only
+        assert not coarse_only or self.config.model.NAME == 'AdaPoinTr', 'the coarse preview needs AdaPoinTr'
+        if ragged:
+            assert self.config.model.NAME == 'AdaPoinTr' and self.config.model.encoder_type == 'graph', \
+                'ragged batches need AdaPoinTr with the graph encoder'
+            # the grouper samples center_num[0] centers and the query generator num_query / 2 input points
+            self.min_points = min(max(self.config.model.center_num[0], self.config.model.num_query // 2), n_points)
+        self.compile_mode = compile_mode
+        if compile_mode == 'onnx':
+            # the PyTorch model is only built when the graph has not been exported yet
+            self.model = load_onnx_model(model_config, model_checkpoint, n_points, num_threads,
+                                         build_model=lambda: self.build_model(model_checkpoint),
+                                         variant=self.model_variant())
+        else:
+            self.model = optimize_model(self.build_model(model_checkpoint), compile_mode,
+                                        model_config, model_checkpoint, n_points=n_points, device=self.device,
+                                        variant=self.model_variant())
+
+        self.normalize = use_pc_norm(self.config)
+        self.transform = build_transform(n_points)
+
+    def build_model(self, model_checkpoint):
+        model = builder.model_builder(self.config.model)
+        builder.load_model(model, model_checkpoint)
+        model.to(self.device)
+        model.eval()
+        if self.coarse_only:
+            model.coarse_only = True
+        if self.quantize:
+            model = quantize_model(model)
+        return autocast_model(model, self.precision, torch.device(self.device).type)
+
+    def model_variant(self):
+        '''int8 / bf16 / fp16, plus coarse for the preview (e.g. int8-coarse), empty for the full fp32 model'''
+        variant = 'int8' if self.quantize else ('' if self.precision == 'fp32' else self.precision)
+        if self.coarse_only:
+            variant = f'{variant}-coarse' if variant else 'coarse'
+        return variant
+
+    def result_settings(self):
+        '''inference settings that change the completed points (part of the result cache fingerprint)'''
+        settings = dict(normalize=self.normalize, n_points=self.n_points)
+        if self.model_variant():
+            settings['variant'] = self.model_variant()
+        if self.ragged:
+            settings['ragged'] = True
+        return settings
+
+    def preprocess(self, pc_ndarray):
+        '''
+            N 3 ndarray -> n_points 3 tensor (ragged: min(max(N, min_points), n_points) 3),
+            plus what is needed to undo the normalization
+        '''
+        centroid, m = None, None
+        if self.normalize:
+            pc_ndarray, centroid, m = pc_norm(pc_ndarray)
+        transform = self.transform
+        if self.ragged and len(pc_ndarray) < self.n_points:
+            transform = build_transform(max(len(pc_ndarray), self.min_points))
+        return transform({'input': pc_ndarray})['input'], centroid, m
+
+    def postprocess(self, dense_points, centroid, m):
+        if self.normalize:
+            # denormalize it to adapt for the original input
+            dense_points = dense_points * m + centroid
+        return dense_points
+
+    def forward(self, partial, flip=False, lengths=None):
+        '''
+            partial : B n_points 3 tensor
+            flip : also complete every cloud with x and z swapped, in the same forward pass
+            lengths : ragged batches, number of real points of every cloud of partial (padded at the end)
+            ----------------------
+            dense_points : B M 3 ndarray (2B M 3 with flip, the flipped half already swapped back)
+        '''
+        partial = partial.to(self.device, non_blocking=True)
+        if flip:
+            partial = torch.cat([partial, partial[:, :, FLIP_AXES]], dim=0)
+        inputs = [partial]
+        if lengths is not None:
+            lengths = torch.as_tensor(lengths, device=partial.device).repeat(2 if flip else 1)
+            inputs.append(torch.arange(partial.size(1), device=partial.device) < lengths.unsqueeze(-1)) # mask
+        with torch.no_grad():
+            dense_points = self.model(*inputs)[-1]
+        if flip:
+            B = dense_points.shape[0] // 2
+            dense_points = torch.cat([dense_points[:B], dense_points[B:, :, FLIP_AXES]], dim=0)
+        return dense_points.detach().cpu().numpy()
+
+    def complete_batch(self, pc_ndarrays):
+        '''
+            Stack the cubes into a single B x n_points x 3 tensor and split the output back per cube
+        '''
+        inputs, norms = [], []
+        for pc_ndarray in pc_ndarrays:
+            x, centroid, m = self.preprocess(pc_ndarray)
+            inputs.append(x)
+            norms.append((centroid, m))
+        dense_points = self.forward(self.stack(inputs), lengths=self.lengths(inputs))
+        return [self.postprocess(dense_points[i], *norms[i]) for i in range(len(inputs))]
+
+    def stack(self, inputs):
+        '''preprocessed clouds -> B n 3 batch tensor, padded to the largest cloud for ragged batches'''
+        return pad_clouds(inputs) if self.ragged else torch.stack(inputs, dim=0)
+
+    def lengths(self, inputs):
+        '''real points of the preprocessed clouds for ragged batches, None otherwise'''
+        return [len(x) for x in inputs] if self.ragged else None
+
+    def complete(self, pc_ndarray):
+        return self.complete_batch([pc_ndarray])[0]
+
+    def prepare_batches(self, cubes):
+        '''
+            yields (names, [(tensor, centroid, m), ...], B n_points 3 tensor) per batch of cubes
+        '''
+        prepared = (cube if cube is FLUSH_BATCH else (cube[0], self.preprocess(cube[1])) for cube in cubes)
+        for names, batch in batched(prepared, self.batch_size):
+            partial = self.stack([x for x, _, _ in batch])
+            if self.pin_memory:
+                partial = partial.pin_memory()
+            yield names, batch, partial
+
+    def complete_stream(self, cubes, flip=False):
+        '''
+            cubes : iterable of (name, N 3 ndarray) pairs, e.g. a generator straight from the cube cutter,
+                    an engine.FLUSH_BATCH item completes the pending cubes without waiting for a full batch
+            flip : test-time augmentation, every cube is also completed with x and z swapped
+            ----------------------
+            yields (name, M 3 ndarray) pairs, one batch at a time
+            Cubes are pulled (read, normalized, upsampled) by a background thread at most
+            prefetch_batches batches ahead of the model, so at most that many batches are held in memory.
+            With flip the flipped variants ride in the same batch tensor (2 x batch_size clouds)
+            and their result, already swapped back, follows each cube as (name + FLIP_SUFFIX, M 3 ndarray).
+        '''
+        for names, batch, partial in prefetch(self.prepare_batches(cubes), self.prefetch_batches):
+            dense_points = self.forward(partial, flip=flip, lengths=self.lengths([x for x, _, _ in batch]))
+            for i, (name, (_, centroid, m)) in enumerate(zip(names, batch)):
+                yield name, self.postprocess(dense_points[i], centroid, m)
+                if flip:
+                    # the normalization commutes with the axis swap, so the same centroid / scale apply
+                    yield name + FLIP_SUFFIX, self.postprocess(dense_points[len(batch) + i], centroid, m)
+
+    def complete_many(self, cubes):
+        '''
+            cubes : dict name -> N 3 ndarray (or an iterable of (name, ndarray) pairs)
+            ----------------------
+            returns dict name -> M 3 ndarray
+        '''
+        items = cubes.items() if isinstance(cubes, dict) else cubes
+        return dict(self.complete_stream(items))
+
 def inference_single(model, pc_path, args, config, root=None):
     if root is not None:
         pc_file = os.path.join(root, pc_path)
@@ -72,55 +485,26 @@ def inference_single(model, pc_path, args, config, root=None):
     # read single point cloud
     pc_ndarray = IO.get(pc_file)  #.astype(np.float32)
     # transform it according to the model 
-    if config.dataset.train._base_['NAME'] == 'ShapeNet' or config.dataset.train._base_['NAME'] == 'PCN' or config.dataset.train._base_['NAME'] == 'ShapeNetHull' or config.dataset.train._base_['NAME'] == 'PCNHull':
+    if use_pc_norm(config):
         # normalize it to fit the model on ShapeNet-55/34
-        #print("doing pc_norm")
-        centroid = np.mean(pc_ndarray, axis=0)
-        pc_ndarray = pc_ndarray - centroid
-        m = np.max(np.sqrt(np.sum(pc_ndarray**2, axis=1)))
-        pc_ndarray = pc_ndarray / m
-        pc_ndarray = pc_ndarray.astype(np.float32)
-
-    transform = Compose([{
-        'callback': 'UpSamplePoints',
-        'parameters': {
-            'n_points': 2048 # tried changing to: 4048
-        },
-        'objects': ['input']
-    }, {
-        'callback': 'ToTensor',
-        'objects': ['input']
-    }])
+        pc_ndarray, centroid, m = pc_norm(pc_ndarray)
+
+    transform = build_transform()
     
     pc_ndarray_normalized = transform({'input': pc_ndarray})
     # inference
-    ret = model(pc_ndarray_normalized['input'].unsqueeze(0).to(args.device.lower()))
+    with torch.no_grad():
+        ret = model(pc_ndarray_normalized['input'].unsqueeze(0).to(args.device.lower()))
     dense_points = ret[-1].squeeze(0).detach().cpu().numpy()
 
-    if config.dataset.train._base_['NAME'] == 'ShapeNet' or config.dataset.train._base_['NAME'] == 'PCN' or config.dataset.train._base_['NAME'] == 'ShapeNetHull' or config.dataset.train._base_['NAME'] == 'PCNHull':
+    if use_pc_norm(config):
         # denormalize it to adapt for the original input
-        #print("undoing pc_norm")
         dense_points = dense_points * m
         dense_points = dense_points + centroid
 
     if args.out_pc_root != '':
-        target_path = os.path.join(args.out_pc_root, os.path.splitext(pc_path)[0])
-        os.makedirs(target_path, exist_ok=True)
-
-        if args.save_npy:
-            np.save(os.path.join(target_path, 'fine.npy'), dense_points)
-        #np.savetxt(os.path.join(args.out_pc_root, os.path.splitext(pc_path)[0] + '_normed.xyz'), pc_ndarray, fmt="%.6f", delimiter=' ')
-        
-        if args.save_xyz:
-           np.savetxt(os.path.join(args.out_pc_root, os.path.splitext(pc_path)[0] + '_pred.xyz'), dense_points, fmt="%.6f", delimiter=' ') 
-        
-        if args.save_ply:
-            import open3d as o3d
-            # Create Open3D point cloud
-            pcd = o3d.geometry.PointCloud()
-            pcd.points = o3d.utility.Vector3dVector(dense_points)
-            # Save as PLY file  
-            o3d.io.write_point_cloud(os.path.join(args.out_pc_root, os.path.splitext(pc_path)[0] + '_pred.ply'), pcd)
+        target_path = save_outputs(dense_points, args.out_pc_root, os.path.splitext(pc_path)[0],
+                                   save_npy=args.save_npy, save_xyz=args.save_xyz, save_ply=args.save_ply)
         
         if args.save_vis_img:
             input_img = misc.get_ptcloud_img(pc_ndarray_normalized['input'].numpy())
@@ -130,9 +514,57 @@ def inference_single(model, pc_path, args, config, root=None):
     
     return
 
+def write_stream(completed, args):
+    # outputs are written by a background thread while the next batches run
+    with BackgroundWriter() as writer:
+        for name, dense_points in completed:
+            if args.out_pc_root != '':
+                writer.submit(save_outputs, dense_points, args.out_pc_root, name,
+                              save_npy=args.save_npy, save_xyz=args.save_xyz, save_ply=args.save_ply)
+
+def inference_batch(engine, pc_paths, args, root=None):
+    pc_files = [os.path.join(root, pc_path) if root is not None else pc_path for pc_path in pc_paths]
+    # the files are read by the prefetch thread of the engine, batch_size clouds per forward pass
+    clouds = ((os.path.splitext(pc_path)[0], IO.get(pc_file)) for pc_path, pc_file in zip(pc_paths, pc_files))
+    write_stream(engine.complete_stream(clouds), args)
+    return
+
+def inference_shard(engine, shard_path, args):
+    # every cube of the shard is a memory-mapped view, nothing is parsed
+    shard = IO.get(shard_path)
+    write_stream(engine.complete_stream(shard.items()), args)
+    return
+
+def build_engine(args):
+    return TreeCompletionEngine(args.model_config, args.model_checkpoint,
+                                device=args.device, batch_size=args.batch_size,
+                                prefetch_batches=args.prefetch, compile_mode=args.compile,
+                                num_threads=args.threads, quantize=args.int8,
+                                precision=args.precision, ragged=args.ragged,
+                                coarse_only=args.coarse_only)
+
 def main():
     args = get_args()
 
+    shard_paths = find_shards(args.pc_root) if args.pc_root != '' else []
+    if args.pc.endswith(SHARD_EXTENSION):
+        shard_paths = [args.pc]
+    if len(shard_paths) > 0:
+        assert not args.save_vis_img, 'save_vis_img is not supported for cube shards'
+        engine = build_engine(args)
+        for shard_path in shard_paths:
+            inference_shard(engine, shard_path, args)
+        return
+
+    # batches, and the compiled / quantized / mixed precision / ragged / preview models, need the engine
+    if args.batch_size > 1 or engine_options(args):
+        engine = build_engine(args)
+        if args.pc_root != '':
+            inference_batch(engine, os.listdir(args.pc_root), args, root=args.pc_root)
+        else:
+            inference_batch(engine, [args.pc], args)
+        return
+
     # init config
     config = cfg_from_yaml_file(args.model_config)
     # build model
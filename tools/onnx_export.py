@@ -0,0 +1,122 @@
+##############################################################
+# ONNX export of the completion models and onnxruntime CPU backend
+#
+#   python tools/onnx_export.py <config> <checkpoint> [--out model.onnx] [--threads 8]
+# exports the model (dynamic batch, fixed number of input points), checks the
+# onnxruntime outputs against PyTorch and prints both latencies.
+###############################################################
+import argparse
+import os
+import sys
+import warnings
+import numpy as np
+import torch
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, '../'))
+
+from tools.compile_model import artifact_path, example_input, benchmark
+
+ONNX_SUFFIX = '.onnx'
+ONNX_OPSET = 17
+INPUT_NAME = 'partial'
+OUTPUT_NAMES = ['coarse', 'dense']
+
+def onnx_path(model_config, model_checkpoint, n_points=2048, variant=''):
+    '''<checkpoint>.<key>.onnx next to the checkpoint, see compile_model.artifact_path'''
+    return os.path.splitext(artifact_path(model_config, model_checkpoint, n_points, 'cpu', variant))[0] + ONNX_SUFFIX
+
+def export_onnx(model, path, n_points=2048, opset=ONNX_OPSET):
+    '''
+        Export the eval forward to ONNX with a dynamic batch axis. The model is exported through
+        the tracer, so the pointnet2 ops take their PyTorch implementations (FPS as a Loop of argmax
+        steps, kNN / three_nn via TopK, gather / grouping via Gather) instead of the CUDA kernels.
+    '''
+    model.eval()
+    example = example_input(1, n_points, 'cpu')
+    dynamic_axes = {name: {0: 'batch'} for name in [INPUT_NAME] + OUTPUT_NAMES}
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        torch.onnx.export(model.cpu(), (example,), tmp_path, input_names=[INPUT_NAME], output_names=OUTPUT_NAMES,
+                          dynamic_axes=dynamic_axes, opset_version=opset, dynamo=False)
+    os.replace(tmp_path, path)
+    return path
+
+class OnnxCompletionModel(object):
+    '''
+        onnxruntime CPU session with the call convention of the PyTorch models:
+            coarse, dense = model(partial)   # B n_points 3 tensor -> tensors
+        num_threads : intra-op threads of the session (0 = onnxruntime default, one per core)
+    '''
+    def __init__(self, path, num_threads=0):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, partial):
+        partial = np.ascontiguousarray(partial.detach().cpu().numpy(), dtype=np.float32)
+        outputs = self.session.run(OUTPUT_NAMES, {INPUT_NAME: partial})
+        return tuple(torch.from_numpy(output) for output in outputs)
+
+def point_set_drift(a, b):
+    '''
+        a, b : B N 3 tensors
+        ----------------------
+        largest distance of a point of one cloud to the other cloud. The outputs are compared as
+        point sets, the backends may order them differently (ties of the query ranking).
+    '''
+    distance = torch.cdist(a, b)
+    return max(distance.min(-1)[0].max().item(), distance.min(-2)[0].max().item())
+
+def load_onnx_model(model_config, model_checkpoint, n_points=2048, num_threads=0, build_model=None, variant=''):
+    '''
+        onnxruntime model of the checkpoint. The exported graph is cached next to the checkpoint,
+        build_model() (returning the PyTorch model) is only called when it has to be exported,
+        so later runs need neither the model code nor its CUDA extensions.
+    '''
+    path = onnx_path(model_config, model_checkpoint, n_points, variant)
+    if not os.path.exists(path):
+        assert build_model is not None, f'no exported graph at {path}'
+        print(f'Exporting the model to {path} (once per checkpoint) ...')
+        export_onnx(build_model(), path, n_points)
+    print(f'Loading ONNX graph from {path}')
+    return OnnxCompletionModel(path, num_threads)
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model_config', help='yaml config file')
+    parser.add_argument('model_checkpoint', help='pretrained weight')
+    parser.add_argument('--out', type=str, default='', help='ONNX file (default: cached next to the checkpoint)')
+    parser.add_argument('--n_points', type=int, default=2048, help='points per input cloud')
+    parser.add_argument('--threads', type=int, default=0, help='onnxruntime intra-op threads (0 = all cores)')
+    parser.add_argument('--batch_size', type=int, default=1, help='clouds per forward pass in the benchmark')
+    parser.add_argument('--repeats', type=int, default=5, help='timed forward passes per backend')
+    return parser.parse_args()
+
+def main():
+    from tools import builder
+    from utils.config import cfg_from_yaml_file
+    args = get_args()
+    config = cfg_from_yaml_file(args.model_config)
+    model = builder.model_builder(config.model)
+    builder.load_model(model, args.model_checkpoint)
+    model.eval()
+
+    path = args.out if args.out != '' else onnx_path(args.model_config, args.model_checkpoint, args.n_points)
+    export_onnx(model, path, args.n_points)
+    print(f'Exported {path} ({os.path.getsize(path) / 1024 ** 2:.1f} MB)')
+
+    onnx_model = OnnxCompletionModel(path, args.threads)
+    example = example_input(args.batch_size, args.n_points, 'cpu')
+    with torch.no_grad():
+        drift = max(point_set_drift(a, b) for a, b in zip(model(example), onnx_model(example)))
+    latency = benchmark({'pytorch': model, 'onnxruntime': onnx_model}, example, repeats=args.repeats)
+    print(f'batch {args.batch_size} x {args.n_points} points on cpu:')
+    for name, seconds in latency.items():
+        print(f'   {name:12s} {seconds * 1000:8.1f} ms / forward')
+    print(f'   max point distance {drift:.2e}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+##############################################################
+# int8 dynamic quantization of the completion models for CPU inference,
+# and quality report of the reduced precision variants
+#
+#   python tools/quantize_model.py <config> <checkpoint> --pc_root <held-out cubes> --batch_size 4
+#   python tools/quantize_model.py <config> <checkpoint> --pc_root <held-out cubes> --variants bf16 fp16 --device cuda
+# int8 quantizes the nn.Linear layers (attention qkv / proj, Mlp, mlp_query, coarse_pred,
+# reduce_map, ...), bf16 / fp16 run the forward under autocast (utils/precision.py), coarse is the
+# AdaPoinTr preview (the num_query coarse points only, see AdaPoinTr.coarse_only).
+# Reports latency, memory and the CDL1 / CDL2 / F-Score drift of every variant against fp32.
+###############################################################
+import argparse
+import copy
+import io
+import itertools
+import os
+import sys
+import warnings
+import torch
+from torch import nn
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, '../'))
+
+from tools.compile_model import benchmark
+from utils.precision import AutocastModel
+
+# int8 weights, activations quantized on the fly per batch. The 1x1 Conv1d / Conv2d layers
+# (increase_dim, the grouper) have no dynamic quantized kernel and stay in fp32.
+QUANTIZED_LAYERS = {nn.Linear}
+QUANTIZED_DTYPE = torch.qint8
+
+def quantize_model(model):
+    '''
+        fp32 model in eval mode -> int8 dynamic quantized copy (CPU only), the model itself is left as is
+    '''
+    with warnings.catch_warnings():
+        # recent torch versions flag torch.ao.quantization and the quantized tensors as deprecated
+        # (in favour of torchao), the eager dynamic path still works
+        warnings.simplefilter('ignore')
+        return torch.ao.quantization.quantize_dynamic(model.cpu().eval(), QUANTIZED_LAYERS, dtype=QUANTIZED_DTYPE)
+
+def build_variants(model, variants, device_type='cpu'):
+    '''
+        fp32 model -> dict name -> model, 'fp32' (the model itself) and the requested variants
+    '''
+    models = {'fp32': model}
+    for variant in variants:
+        if variant == 'int8':
+            assert device_type == 'cpu', 'the int8 model runs on CPU only'
+            models[variant] = quantize_model(model)
+        elif variant == 'coarse':
+            # same weights, the attribute only switches the forward
+            models[variant] = copy.copy(model)
+            models[variant].coarse_only = True
+        else:
+            models[variant] = AutocastModel(model, variant, device_type)
+    return models
+
+def peak_memory(model, example):
+    '''peak GPU memory of one forward pass in bytes (weights included)'''
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    with torch.no_grad():
+        model(example)
+    torch.cuda.synchronize()
+    return torch.cuda.max_memory_allocated()
+
+def model_bytes(model):
+    '''size of the serialized state dict, i.e. the memory taken by the weights'''
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+def iter_cubes(pc_root, max_cubes=None):
+    '''
+        (name, N 3 ndarray) pairs of the cube shards under pc_root, or of its point cloud files
+    '''
+    from datasets.io import IO
+    from utils.cube_shard import find_shards
+    shard_paths = find_shards(pc_root)
+    if shard_paths:
+        cubes = (item for shard_path in shard_paths for item in IO.get(shard_path).items())
+    else:
+        cubes = ((os.path.splitext(pc_path)[0], IO.get(os.path.join(pc_root, pc_path)))
+                 for pc_path in sorted(os.listdir(pc_root)))
+    return itertools.islice(cubes, max_cubes)
+
+def completion_drift(models, reference, batches):
+    '''
+        models : dict name -> model, reference : name of the model the others are compared to,
+        batches : B n_points 3 tensors
+        ----------------------
+        dict name -> dict metric -> mean over the clouds (F-Score, CDL1, CDL2 of utils.metrics)
+    '''
+    from utils.metrics import Metrics
+    names = [name for name in Metrics.names() if name != 'EMDistance']
+    sums = {name: {metric: 0. for metric in names} for name in models if name != reference}
+    count = 0
+    with torch.no_grad():
+        for partial in batches:
+            target = models[reference](partial)[-1]
+            for name in sums:
+                dense = models[name](partial)[-1]
+                # metrics of one cloud at a time, the chamfer distances ignore_zeros only for batch 1
+                for i in range(len(partial)):
+                    values = dict(zip(Metrics.names(), Metrics.get(dense[i:i + 1], target[i:i + 1])))
+                    for metric in names:
+                        sums[name][metric] += float(values[metric])
+            count += len(partial)
+    return {name: {metric: value / max(count, 1) for metric, value in metrics.items()} for name, metrics in sums.items()}
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model_config', help='yaml config file')
+    parser.add_argument('model_checkpoint', help='pretrained weight')
+    parser.add_argument('--pc_root', type=str, required=True, help='held-out cubes (point cloud files or cube shards)')
+    parser.add_argument('--max_cubes', type=int, default=64, help='cubes of pc_root used for the drift')
+    parser.add_argument('--variants', nargs='+', choices=['int8', 'bf16', 'fp16', 'coarse'], default=['int8'],
+                        help='variants compared with the fp32 model')
+    parser.add_argument('--device', default='cpu', help='device of the comparison (int8 needs cpu)')
+    parser.add_argument('--batch_size', type=int, default=4, help='clouds per forward pass')
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads (0 = torch default)')
+    parser.add_argument('--repeats', type=int, default=5, help='timed forward passes per variant')
+    return parser.parse_args()
+
+def main():
+    from tools.inference import TreeCompletionEngine
+    args = get_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    device = args.device.lower()
+    # the engine normalizes / upsamples the cubes exactly like a completion run
+    engine = TreeCompletionEngine(args.model_config, args.model_checkpoint, device=device,
+                                  batch_size=args.batch_size, prefetch_batches=0)
+    models = build_variants(engine.model, args.variants, torch.device(device).type)
+    batches = [partial.to(device) for _, _, partial in engine.prepare_batches(iter_cubes(args.pc_root, args.max_cubes))]
+    assert len(batches) > 0, f'no cubes found in {args.pc_root}'
+
+    latency = benchmark(models, batches[0], repeats=args.repeats)
+    drift = completion_drift(models, 'fp32', batches)
+    print(f'{sum(len(partial) for partial in batches)} cubes, batch {len(batches[0])} x {engine.n_points} points on {device}:')
+    for name, model in models.items():
+        memory = f'weights {model_bytes(model) / 1024 ** 2:7.1f} MB'
+        if batches[0].is_cuda:
+            memory += f', peak {peak_memory(model, batches[0]) / 1024 ** 2:7.1f} MB'
+        print(f'   {name:6s} {latency[name] * 1000:8.1f} ms / forward ({latency["fp32"] / latency[name]:.2f}x), {memory}')
+    for name, metrics in drift.items():
+        print(f'   {name} drift against fp32: ' + ', '.join(f'{metric} {value:.4f}' for metric, value in metrics.items()))
+
+if __name__ == '__main__':
+    main()
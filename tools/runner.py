@@ -8,6 +8,7 @@ import time
 from utils.logger import *
 from utils.AverageMeter import AverageMeter
 from utils.metrics import Metrics
+from utils.precision import autocast, autocast_model, grad_scaler
 from extensions.chamfer_dist import ChamferDistanceL1, ChamferDistanceL2
 
 # Optional R integration - only needed for specific dataset processing
@@ -73,6 +74,10 @@ def run_net(args, config, train_writer=None, val_writer=None):
         base_model = nn.DataParallel(base_model).cuda()
     # optimizer & scheduler
     optimizer = builder.build_optimizer(base_model, config)
+    # mixed precision: fp32 (default), bf16 or fp16 autocast of the forward and the losses
+    precision = getattr(config, 'precision', 'fp32')
+    scaler = grad_scaler(precision)
+    print_log(f'Training precision: {precision}', logger = logger)
     
     # Criterion
     ChamferDisL1 = ChamferDistanceL1()
@@ -172,20 +177,24 @@ def run_net(args, config, train_writer=None, val_writer=None):
             num_iter += 1
            
            
-            ret = base_model(partial)
-            print("partial.size(1): " + str(partial.size(1)))
-            print(gt.size(1))           
-            
-            sparse_loss, dense_loss = base_model.module.get_loss(ret, gt, epoch)
+            with autocast(precision):
+                ret = base_model(partial)
+                print("partial.size(1): " + str(partial.size(1)))
+                print(gt.size(1))           
+                
+                sparse_loss, dense_loss = base_model.module.get_loss(ret, gt, epoch)
          
             _loss = sparse_loss + dense_loss 
-            _loss.backward()
+            scaler.scale(_loss).backward()
 
             # forward
             if num_iter == config.step_per_update:
+                # the gradients are clipped at their real scale
+                scaler.unscale_(optimizer)
                 torch.nn.utils.clip_grad_norm_(base_model.parameters(), getattr(config, 'grad_norm_clip', 10), norm_type=2)
                 num_iter = 0
-                optimizer.step()
+                scaler.step(optimizer)
+                scaler.update()
                 base_model.zero_grad()
 
             if args.distributed:
@@ -231,7 +240,7 @@ def run_net(args, config, train_writer=None, val_writer=None):
 
         if epoch % args.val_freq == 0:
             # Validate the current model
-            metrics = validate(base_model, test_dataloader, epoch, ChamferDisL1, ChamferDisL2, val_writer, args, config, logger=logger)
+            metrics = validate(autocast_model(base_model, precision), test_dataloader, epoch, ChamferDisL1, ChamferDisL2, val_writer, args, config, logger=logger)
 
             # Save ckeckpoints
             if  metrics.better_than(best_metrics):
@@ -399,6 +408,8 @@ def test_net(args, config):
     #  DDP    
     if args.distributed:
         raise NotImplementedError()
+    # same precision as in training (fp32 unless the config sets bf16 / fp16)
+    base_model = autocast_model(base_model, getattr(config, 'precision', 'fp32'))
 
     # Criterion
     ChamferDisL1 = ChamferDistanceL1()
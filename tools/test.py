@@ -0,0 +1,97 @@
+# Tests of the TreeCompletionEngine of tools/inference.py: ragged (padded + masked) batches against
+# completing every cube alone, with and without the flip augmentation, flushed batches
+
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+import torch
+import unittest
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+sys.path.append(ROOT_DIR)
+from models import build_model_from_cfg
+from tools.inference import TreeCompletionEngine
+from utils.config import cfg_from_yaml_file
+
+MODEL_CONFIG = os.path.join(ROOT_DIR, 'cfgs', 'predefhull_models', 'AdaPoinTr.yaml')
+
+
+class RaggedBatchTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        torch.manual_seed(0)
+        cls.ckpt_dir = tempfile.mkdtemp()
+        checkpoint = os.path.join(cls.ckpt_dir, 'AdaPoinTr.pth')
+        torch.save({'base_model': build_model_from_cfg(cfg_from_yaml_file(MODEL_CONFIG).model).state_dict()}, checkpoint)
+        cls.engine = TreeCompletionEngine(MODEL_CONFIG, checkpoint, device='cpu', batch_size=3, prefetch_batches=0,
+                                          ragged=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.ckpt_dir)
+
+    def setUp(self):
+        # between min_points and n_points the cubes are taken as they are (no random upsampling)
+        rng = np.random.default_rng(0)
+        self.cubes = [(f'cube_{n}', rng.random((n, 3)) + [10., 20., 0.]) for n in [600, 2048, 1100, 900]]
+
+    def complete_alone(self, flip):
+        batch_size = self.engine.batch_size
+        try:
+            self.engine.batch_size = 1
+            return dict(self.engine.complete_stream(self.cubes, flip=flip))
+        finally:
+            self.engine.batch_size = batch_size
+
+    def test_preprocess(self):
+        self.assertEqual(self.engine.min_points, 512)
+        for n, expected in [(100, 512), (900, 900), (2048, 2048), (3000, 2048)]:
+            x, _, _ = self.engine.preprocess(np.random.rand(n, 3))
+            self.assertEqual(x.shape, (expected, 3))
+
+    def test_padded_batches(self):
+        for flip in [False, True]:
+            alone = self.complete_alone(flip)
+            batched = list(self.engine.complete_stream(self.cubes, flip=flip))
+            self.assertEqual([name for name, _ in batched], list(alone.keys()))
+            self.assertEqual(len(batched), len(self.cubes) * (2 if flip else 1))
+            for name, dense_points in batched:
+                self.assertTrue(np.allclose(dense_points, alone[name], atol=1e-4), name)
+
+    def test_flush_batch(self):
+        # a FLUSH_BATCH item completes the pending cubes right away, the results stay the same
+        batch_sizes = []
+        forward = self.engine.forward
+
+        def counting_forward(partial, **kwargs):
+            batch_sizes.append(len(partial))
+            return forward(partial, **kwargs)
+
+        try:
+            self.engine.forward = counting_forward
+            cubes = [self.cubes[0], self.engine.FLUSH_BATCH, self.engine.FLUSH_BATCH] + self.cubes[1:]
+            flushed = list(self.engine.complete_stream(cubes))
+        finally:
+            del self.engine.forward
+        self.assertEqual(batch_sizes, [1, 3])
+        alone = self.complete_alone(flip=False)
+        self.assertEqual([name for name, _ in flushed], list(alone.keys()))
+        for name, dense_points in flushed:
+            self.assertTrue(np.allclose(dense_points, alone[name], atol=1e-4), name)
+
+    def test_flip_lengths(self):
+        # the flipped half of the batch gets the lengths of the clouds again: same mask as the normal half
+        x = [self.engine.preprocess(points)[0] for _, points in self.cubes[:2]]
+        partial = self.engine.stack(x)
+        dense_points = self.engine.forward(partial, flip=True, lengths=self.engine.lengths(x))
+        self.assertEqual(dense_points.shape[0], 4)
+        for i, cloud in enumerate(x):
+            alone = self.engine.forward(cloud[None], flip=True)
+            self.assertTrue(np.allclose(dense_points[i], alone[0], atol=1e-4))
+            self.assertTrue(np.allclose(dense_points[2 + i], alone[1], atol=1e-4))
+
+
+if __name__ == '__main__':
+    unittest.main()
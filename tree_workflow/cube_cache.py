@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Persistent, content-addressed cache of completed cubes
+"""
+
+import collections
+import hashlib
+import os
+import queue
+import sys
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.cube_shard import FLIP_SUFFIX
+
+CACHE_EXTENSION = '.npy'
+
+def file_digest(path, chunk_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def model_fingerprint(model_config, model_checkpoint, **settings):
+    """
+    Hash of everything that changes the completion of a cube besides its points:
+    the config file, the checkpoint file (by content) and the inference settings
+    (normalization, number of input points, ...).
+    """
+    sha = hashlib.sha1()
+    sha.update(file_digest(model_config).encode())
+    sha.update(file_digest(model_checkpoint).encode())
+    for name in sorted(settings):
+        sha.update(f'{name}={settings[name]!r};'.encode())
+    return sha.hexdigest()
+
+class CubeResultCache(object):
+    """
+    Completed cubes stored as <cache_dir>/<key[:2]>/<key>.npy, with
+    key = sha1(model fingerprint, cube points). Identical cubes of later runs
+    (or of an interrupted run started again) skip inference.
+    Entries are written atomically as soon as a cube is completed. The cache is
+    kept under max_bytes by evicting the least recently used entries
+    (the modification time of an entry is refreshed on every hit).
+    """
+    def __init__(self, cache_dir, fingerprint, max_bytes=20 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.fingerprint = fingerprint
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = sum(size for _, _, size in self._entries())
+
+    def key(self, points):
+        sha = hashlib.sha1(self.fingerprint.encode())
+        sha.update(np.ascontiguousarray(points[:, 0:3], dtype=np.float64).tobytes())
+        return sha.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + CACHE_EXTENSION)
+
+    def _entries(self):
+        """(path, mtime, size) of every entry"""
+        for sub in os.scandir(self.cache_dir):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith(CACHE_EXTENSION):
+                    stat = entry.stat()
+                    yield entry.path, stat.st_mtime, stat.st_size
+
+    def get(self, key):
+        """Cached result for the key, None on a miss"""
+        path = self._path(key)
+        try:
+            points = np.load(path)
+        except (FileNotFoundError, ValueError, EOFError):
+            # missing or partially written entry
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted by the writer thread in the meantime
+            pass
+        self.hits += 1
+        return points
+
+    def put(self, key, points):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, points)
+        if os.path.exists(path):
+            self.total_bytes -= os.path.getsize(path)
+        os.replace(tmp_path, path)
+        self.total_bytes += os.path.getsize(path)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self, target_ratio=0.9):
+        """Remove least recently used entries until the cache is below target_ratio * max_bytes"""
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        self.total_bytes = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if self.total_bytes <= target_ratio * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= size
+
+def lookup_cached(cubes, cache, flip=False):
+    """
+    Producer stage of complete_with_cache: hashes every (name, points) cube and loads its cached results,
+    so it can run in the prefetch thread next to the cutter instead of in the inference loop.
+    Yields (name, points, key, results), results being the cached [(name, points)] of the cube
+    (and of its flipped version with flip), None on a miss.
+    """
+    for name, points in cubes:
+        key = cache.key(points)
+        dense_points = cache.get(key)
+        flip_points = cache.get(key + FLIP_SUFFIX) if (flip and dense_points is not None) else None
+        if dense_points is None or (flip and flip_points is None):
+            yield name, points, key, None
+        else:
+            yield name, points, key, [(name, dense_points)] + ([(name + FLIP_SUFFIX, flip_points)] if flip else [])
+
+def complete_with_cache(engine, looked_up, cache, flip=False, writer=None):
+    """
+    Same stream as engine.complete_stream, for the cubes of lookup_cached: cubes found in the result cache
+    skip inference and every new completion is cached as soon as it is done (so an interrupted run resumes).
+    The misses go through a single engine.complete_stream, fed at most prefetch_batches + 1 batches ahead.
+    The results come out in the order of the cubes, cached or not: the merge of the trees relies on it,
+    so cached results wait behind the misses before them. At most prefetch_batches + 1 batches of cubes
+    wait: beyond that the batch of the oldest miss is completed with the misses it has (engine.FLUSH_BATCH).
+    With a BackgroundWriter the cache entries are written by its thread.
+    """
+    put = cache.put if writer is None else (lambda key, points: writer.submit(cache.put, key, points))
+    results_per_cube = 2 if flip else 1
+    max_in_flight = engine.batch_size * (engine.prefetch_batches + 1)
+    misses = queue.Queue()
+    end = object()
+    completed = engine.complete_stream(iter(misses.get, end), flip=flip)
+    in_flight = collections.deque()  # (key, results) of the misses fed to the engine, in order
+    waiting = collections.deque()    # results of every cube in order, a miss is done once they are all in
+    open_misses = 0                  # misses in the batch the engine is still filling
+
+    def complete_next():
+        # only called when the oldest miss is in a full or flushed batch, so the engine never waits for more
+        key, results = in_flight[0]
+        results.append(next(completed))
+        if len(results) == results_per_cube:
+            in_flight.popleft()
+            for suffix, (_, dense_points) in zip(['', FLIP_SUFFIX], results):
+                put(key + suffix, dense_points)
+
+    try:
+        for name, points, key, results in looked_up:
+            if results is None:
+                results = []
+                misses.put((name, points))
+                in_flight.append((key, results))
+                open_misses = (open_misses + 1) % engine.batch_size
+            waiting.append(results)
+            while len(in_flight) >= max_in_flight:
+                complete_next()
+            if len(waiting) >= max_in_flight:
+                # cached results pile up behind a miss: complete it now, flushing its batch if it is not full
+                if len(in_flight) <= open_misses:
+                    misses.put(engine.FLUSH_BATCH)
+                    open_misses = 0
+                while len(waiting[0]) < results_per_cube:
+                    complete_next()
+            while waiting and len(waiting[0]) == results_per_cube:
+                yield from waiting.popleft()
+        misses.put(end)
+        while in_flight:
+            complete_next()
+        while waiting:
+            yield from waiting.popleft()
+    finally:
+        # lets the producer of the engine stop when the consumer stopped early
+        misses.put(end)
+        completed.close()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Incremental merging of completed cubes into whole trees
+"""
+
+import os
+import sys
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.cube_shard import FLIP_SUFFIX
+
+MERGE_MODES = ['centroid', 'center']
+
+def reduce_voxels(voxels, sums, counts):
+    """
+    Fuse the rows that fall into the same voxel.
+    voxels : N 3 int64 voxel coordinates, sums : N 3 point sums, counts : N point counts
+    Returns the unique voxels with their summed sums and counts (sorted by voxel).
+    The voxel coordinates are packed into one int64 key per row, so a single np.unique does the hashing.
+    """
+    low = voxels.min(axis=0)
+    dims = voxels.max(axis=0) - low + 1
+    local = voxels - low
+    keys = (local[:, 0] * dims[1] + local[:, 1]) * dims[2] + local[:, 2]
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    fused_counts = np.bincount(inverse, weights=counts)
+    fused_sums = np.stack([np.bincount(inverse, weights=sums[:, axis]) for axis in range(3)], axis=1)
+    return voxels[first], fused_sums, fused_counts
+
+class VoxelFusion(object):
+    """
+    Streaming voxel deduplication of overlapping point clouds.
+    Points are hashed into a global grid of voxel_size cubes and every voxel keeps
+    the sum and the count of its points, so the fusion is count-weighted across cubes
+    (a voxel seen by four overlapping cubes ends up at the mean of all their points).
+    Incoming points are buffered and reduced every `buffer_points` points,
+    memory then grows with the number of occupied voxels instead of the number of points.
+        mode 'centroid' : one point per voxel at the mean of its points
+        mode 'center'   : one point per voxel at the voxel center
+        min_count       : voxels with fewer points are dropped (isolated noise)
+    """
+    def __init__(self, voxel_size, mode='centroid', min_count=1, buffer_points=2000000):
+        assert voxel_size > 0, f'voxel_size has to be positive, got {voxel_size}'
+        assert mode in MERGE_MODES, f'unexpected merge mode {mode}'
+        self.voxel_size = voxel_size
+        self.mode = mode
+        self.min_count = min_count
+        self.buffer_points = buffer_points
+        self.voxels = np.zeros((0, 3), dtype=np.int64)
+        self.sums = np.zeros((0, 3))
+        self.counts = np.zeros(0)
+        self.num_points = 0
+        self._pending = []
+        self._pending_points = 0
+
+    def add(self, points):
+        self._pending.append(points[:, 0:3])
+        self._pending_points += len(points)
+        self.num_points += len(points)
+        if self._pending_points >= self.buffer_points:
+            self.flush()
+
+    def update(self, other):
+        """Fuse the voxels of another VoxelFusion (same voxel_size) into this one"""
+        assert other.voxel_size == self.voxel_size, 'can only fuse grids with the same voxel_size'
+        self.flush()
+        other.flush()
+        self.num_points += other.num_points
+        self._reduce(other.voxels, other.sums, other.counts)
+
+    def flush(self):
+        if not self._pending:
+            return
+        points = np.vstack(self._pending).astype(np.float64)
+        self._pending = []
+        self._pending_points = 0
+        voxels = np.floor(points / self.voxel_size).astype(np.int64)
+        self._reduce(voxels, points, np.ones(len(points)))
+
+    def _reduce(self, voxels, sums, counts):
+        if len(voxels) == 0:
+            return
+        self.voxels, self.sums, self.counts = reduce_voxels(np.vstack([self.voxels, voxels]),
+                                                            np.vstack([self.sums, sums]),
+                                                            np.concatenate([self.counts, counts]))
+
+    def __len__(self):
+        self.flush()
+        return len(self.voxels)
+
+    def points(self):
+        self.flush()
+        keep = self.counts >= self.min_count
+        if self.mode == 'center':
+            return (self.voxels[keep] + 0.5) * self.voxel_size
+        return self.sums[keep] / self.counts[keep, None]
+
+class CubeMerger(object):
+    """
+    Accumulates completed cubes as they come out of inference, so the merge stage
+    can run while later cubes are still being cut and completed.
+    Flipped results (name ending in FLIP_SUFFIX) come back from inference already
+    swapped back to the original axes and are kept apart from the normal cubes.
+    With a voxel_size the overlapping cubes are fused on the fly (see VoxelFusion),
+    otherwise every completed point is kept.
+    With core_bounds = (xy min, xy max) only the completed points inside these x/y bounds
+    are kept (tiles of a large scan, the halo around the tile belongs to the neighbours).
+    """
+    def __init__(self, voxel_size=None, mode='centroid', min_count=1, core_bounds=None):
+        self.voxel_size = voxel_size
+        self.core_bounds = core_bounds
+        self.mode = mode
+        self.min_count = min_count
+        self.num_cubes = 0
+        self.num_flip_cubes = 0
+        if voxel_size is not None:
+            self.fusion = VoxelFusion(voxel_size, mode=mode, min_count=min_count)
+            self.flip_fusion = VoxelFusion(voxel_size, mode=mode, min_count=min_count)
+        else:
+            self.cubes = []
+            self.flip_cubes = []
+
+    def add(self, name, cube_points):
+        if self.core_bounds is not None:
+            lo, hi = self.core_bounds
+            cube_points = cube_points[np.all((cube_points[:, 0:2] >= lo) & (cube_points[:, 0:2] < hi), axis=1)]
+        flipped = name.endswith(FLIP_SUFFIX)
+        if flipped:
+            self.num_flip_cubes += 1
+        else:
+            self.num_cubes += 1
+
+        if self.voxel_size is not None:
+            (self.flip_fusion if flipped else self.fusion).add(cube_points)
+        elif flipped:
+            self.flip_cubes.append(cube_points)
+        else:
+            self.cubes.append(cube_points)
+
+    def __len__(self):
+        return self.num_cubes + self.num_flip_cubes
+
+    def points(self):
+        """Merged points of the normal cubes, None if there are none"""
+        if self.num_cubes == 0:
+            return None
+        if self.voxel_size is not None:
+            return self.fusion.points()
+        return np.vstack(self.cubes)
+
+    def flip_points(self):
+        """Merged points of the flipped cubes, None if there are none"""
+        if self.num_flip_cubes == 0:
+            return None
+        if self.voxel_size is not None:
+            return self.flip_fusion.points()
+        return np.vstack(self.flip_cubes)
+
+    def combined_points(self):
+        """Normal and flipped cubes merged together, None if there are none"""
+        if len(self) == 0:
+            return None
+        if self.voxel_size is not None:
+            combined = VoxelFusion(self.voxel_size, mode=self.mode, min_count=self.min_count)
+            combined.update(self.fusion)
+            combined.update(self.flip_fusion)
+            return combined.points()
+        return np.vstack(self.cubes + self.flip_cubes)
+
+    def num_points(self):
+        """Number of completed points that went into the merge (before any fusion)"""
+        if self.voxel_size is not None:
+            return self.fusion.num_points + self.flip_fusion.num_points
+        return sum(len(cube) for cube in self.cubes + self.flip_cubes)
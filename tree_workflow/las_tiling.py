@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Out-of-core tiling of large LAS/LAZ plot scans
+"""
+
+import os
+import numpy as np
+
+LAS_EXTENSIONS = ('.las', '.laz')
+TILE_INDEX_NAME = 'tiles.npz'
+TILE_EXTENSION = '.bin'
+
+def is_las_file(path):
+    return path.lower().endswith(LAS_EXTENSIONS)
+
+def iter_las_chunks(las_path, chunk_points=5000000, origin=None):
+    """
+    Yield the xyz of a LAS/LAZ file chunk by chunk (laspy chunk iterator), so at most
+    chunk_points points are decoded at once. Coordinates are float32 relative to `origin`
+    (default: floor of the header minimum), which keeps millimetres for georeferenced scans.
+    """
+    import laspy
+    with laspy.open(las_path) as reader:
+        header = reader.header
+        if origin is None:
+            origin = np.floor(header.mins)
+        shift = header.offsets - origin
+        for chunk in reader.chunk_iterator(chunk_points):
+            xyz = np.empty((len(chunk), 3), dtype=np.float32)
+            xyz[:, 0] = np.asarray(chunk.X) * header.scales[0] + shift[0]
+            xyz[:, 1] = np.asarray(chunk.Y) * header.scales[1] + shift[1]
+            xyz[:, 2] = np.asarray(chunk.Z) * header.scales[2] + shift[2]
+            yield xyz
+
+def tile_name(ix, iy):
+    return f'tile_{ix}_{iy}'
+
+def tile_las(las_path, out_folder, tile_size=20.0, halo=2.0, chunk_points=5000000):
+    """
+    Split a LAS/LAZ scan into square x/y tiles on disk without loading it.
+    Every tile file holds the float32 xyz (relative to the stored origin) of the points of the tile
+    and of a `halo` margin around it, so cubes at the tile border still see their neighbourhood.
+    Points are streamed chunk by chunk, RAM is bounded by chunk_points.
+    Returns the LasTiles of out_folder.
+    """
+    import laspy
+    assert 0 <= 2 * halo < tile_size, f'halo ({halo}) has to be smaller than half the tile size ({tile_size})'
+    with laspy.open(las_path) as reader:
+        mins, maxs = np.array(reader.header.mins), np.array(reader.header.maxs)
+    origin = np.floor(mins)
+    low = (mins - origin)[0:2]
+    num_tiles = np.maximum(np.ceil((maxs - mins)[0:2] / tile_size).astype(np.int64), 1)
+
+    os.makedirs(out_folder, exist_ok=True)
+    for f in os.listdir(out_folder):
+        if f.endswith(TILE_EXTENSION):
+            os.remove(os.path.join(out_folder, f))
+    counts = np.zeros(num_tiles, dtype=np.int64)
+
+    for xyz in iter_las_chunks(las_path, chunk_points, origin=origin):
+        # first and last tile touched by the halo box of every point (at most 2 per axis)
+        first = np.clip(np.floor((xyz[:, 0:2] - halo - low) / tile_size).astype(np.int64), 0, num_tiles - 1)
+        last = np.clip(np.floor((xyz[:, 0:2] + halo - low) / tile_size).astype(np.int64), 0, num_tiles - 1)
+        for use_last_x in (False, True):
+            for use_last_y in (False, True):
+                ix = last[:, 0] if use_last_x else first[:, 0]
+                iy = last[:, 1] if use_last_y else first[:, 1]
+                mask = np.ones(len(xyz), dtype=bool)
+                if use_last_x:
+                    mask &= last[:, 0] != first[:, 0]
+                if use_last_y:
+                    mask &= last[:, 1] != first[:, 1]
+                keys = ix[mask] * num_tiles[1] + iy[mask]
+                points = xyz[mask]
+                order = np.argsort(keys, kind='stable')
+                unique_keys, starts, sizes = np.unique(keys[order], return_index=True, return_counts=True)
+                for key, start, size in zip(unique_keys, starts, sizes):
+                    tx, ty = divmod(int(key), int(num_tiles[1]))
+                    with open(os.path.join(out_folder, tile_name(tx, ty) + TILE_EXTENSION), 'ab') as f:
+                        f.write(np.ascontiguousarray(points[order[start:start + size]]).tobytes())
+                    counts[tx, ty] += size
+
+    np.savez(os.path.join(out_folder, TILE_INDEX_NAME), origin=origin, low=low, tile_size=tile_size,
+             halo=halo, num_tiles=num_tiles, counts=counts, source=os.path.abspath(las_path))
+    return LasTiles(out_folder)
+
+class LasTiles(object):
+    """
+    Read-only view of the tiles written by tile_las. Tile files are memory-mapped.
+        tiles.names()            -> non-empty tiles, e.g. tile_3_1
+        tiles.local_points(name) -> float32 xyz relative to tiles.origin (core + halo)
+        tiles.points(name)       -> float64 world coordinates (core + halo)
+        tiles.core_bounds(name)  -> (xy min, xy max) of the points owned by the tile,
+                                    open (+-inf) towards the outside of the scan
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        with np.load(os.path.join(folder, TILE_INDEX_NAME)) as f:
+            self.origin = f['origin']
+            self.low = f['low']
+            self.tile_size = float(f['tile_size'])
+            self.halo = float(f['halo'])
+            self.num_tiles = f['num_tiles']
+            self.counts = f['counts']
+        self._tiles = {tile_name(ix, iy): (ix, iy) for ix, iy in zip(*np.nonzero(self.counts))}
+
+    def names(self):
+        return list(self._tiles.keys())
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def local_points(self, name):
+        ix, iy = self._tiles[name]
+        return np.memmap(os.path.join(self.folder, name + TILE_EXTENSION), dtype=np.float32, mode='r',
+                         shape=(int(self.counts[ix, iy]), 3))
+
+    def points(self, name):
+        return self.local_points(name) + self.origin
+
+    def core_bounds(self, name):
+        ix, iy = self._tiles[name]
+        index = np.array([ix, iy])
+        lo = self.origin[0:2] + self.low + index * self.tile_size
+        hi = lo + self.tile_size
+        lo[index == 0] = -np.inf
+        hi[index == self.num_tiles - 1] = np.inf
+        return lo, hi
@@ -0,0 +1,466 @@
+# Tests of the cube workflow modules: the single pass cube binning against the per-cell loop of the
+# original cutter (serial and parallel, txt files and cube shard), the leaves of the octree cutting,
+# the voxel fusion of the merge against a brute-force grouping, the cube result cache (hits, resuming an
+# interrupted run, eviction, cube order, bounded waiting), the halo and core bounds of the LAS tiles
+
+import os
+import sys
+import shutil
+import tempfile
+import itertools
+import numpy as np
+import unittest
+try:
+    import laspy
+except ImportError:
+    laspy = None
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+import tree2cubes_improved
+from cube_merge import VoxelFusion, CubeMerger
+from cube_cache import CubeResultCache, model_fingerprint, lookup_cached, complete_with_cache
+from las_tiling import tile_las
+from utils.cube_shard import CubeShard, FLIP_SUFFIX
+
+# spatial shifts of the 4 grid versions
+SHIFTS = [(0.0, 0.0, 0.0), (0.5, 0.5, 0.5), (-0.3, -0.3, -0.3), (0.3, 0.3, 0.2)]
+
+
+def reference_cut(point_cloud, cube_sizes, min_points):
+    '''the cell loop of the original cut_point_cloud_improved (one full-cloud mask per cube, no downsampling)'''
+    cubes, skipped_empty, skipped_sparse = {}, 0, 0
+    mins, maxs = point_cloud.min(axis=0), point_cloud.max(axis=0)
+    for version, (cube_size, shift) in enumerate(zip(cube_sizes, SHIFTS)):
+        shifted_min, shifted_max = mins + shift, maxs + shift
+        num_cubes = [int(np.ceil((hi - lo) / cube_size)) for lo, hi in zip(shifted_min, shifted_max)]
+        for i in range(num_cubes[0]):
+            for j in range(num_cubes[1]):
+                for k in range(num_cubes[2]):
+                    cube_min = shifted_min + np.array([i, j, k]) * cube_size
+                    cube_max = cube_min + cube_size
+                    mask = np.all((point_cloud >= cube_min) & (point_cloud < cube_max), axis=1)
+                    if mask.sum() == 0:
+                        skipped_empty += 1
+                    elif mask.sum() < min_points:
+                        skipped_sparse += 1
+                    else:
+                        cubes[f'cube_{i}_{j}_{k}_v{version + 1}'] = point_cloud[mask]
+    return cubes, skipped_empty, skipped_sparse
+
+
+class CubeCuttingTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        # a quarter of the points on a 0.25m lattice, many of them exactly on cube borders
+        self.point_cloud = np.vstack([rng.rand(3000, 3) * [3., 2., 4.],
+                                      rng.randint(0, 12, (1000, 3)) * 0.25])
+        self.cube_sizes = [1.0, 0.5, 1.25, 0.75]
+        self.reference, self.skipped_empty, self.skipped_sparse = reference_cut(self.point_cloud, self.cube_sizes, 20)
+
+    def test_binning(self):
+        for workers in [1, 2]:
+            stats = {}
+            cubes = list(tree2cubes_improved.iter_cut_cubes(self.point_cloud, self.cube_sizes, min_points=20,
+                                                            stats=stats, workers=workers))
+            # same cubes in the order of the cell loop, points in their original order
+            self.assertEqual([name for name, _, _, _ in cubes], list(self.reference.keys()))
+            for name, points, _, _ in cubes:
+                self.assertTrue(np.array_equal(points, self.reference[name]), name)
+            self.assertEqual(stats['skipped_empty'], self.skipped_empty)
+            self.assertEqual(stats['skipped_sparse'], self.skipped_sparse)
+
+    def test_txt_files(self):
+        outpath = tempfile.mkdtemp()
+        try:
+            saved = tree2cubes_improved.cut_point_cloud_improved(self.point_cloud, outpath, *self.cube_sizes,
+                                                                 min_points=20, cube_format='txt')
+            self.assertEqual(saved, len(self.reference))
+            self.assertEqual(sorted(os.listdir(outpath)), sorted(name + '.txt' for name in self.reference))
+            for name, points in self.reference.items():
+                self.assertTrue(np.allclose(np.loadtxt(os.path.join(outpath, name + '.txt')), points, atol=1e-6))
+        finally:
+            shutil.rmtree(outpath)
+
+    def test_shard(self):
+        outpath = tempfile.mkdtemp()
+        try:
+            tree2cubes_improved.cut_point_cloud_improved(self.point_cloud, outpath, *self.cube_sizes, min_points=20)
+            shard = CubeShard(os.path.join(outpath, tree2cubes_improved.CUBE_SHARD_NAME))
+            self.assertEqual(shard.names(), list(self.reference.keys()))
+            for name, points in self.reference.items():
+                self.assertLess(np.abs(shard[name] - points).max(), 1e-6)
+        finally:
+            shutil.rmtree(outpath)
+
+    def test_seeded_downsampling(self):
+        dense = np.random.RandomState(1).rand(20000, 3)
+        cut = lambda workers: list(tree2cubes_improved.iter_cut_cubes(dense, [1.0, 1.0, 1.0, 1.0], max_points=5000,
+                                                                      target_points=3000, seed=0, workers=workers))
+        cubes = cut(1)
+        self.assertTrue(all(len(points) <= 5000 for _, points, _, _ in cubes))
+        for (name, points, _, _), (other_name, other_points, _, _) in zip(cubes, cut(2)):
+            self.assertEqual(name, other_name)
+            self.assertTrue(np.array_equal(points, other_points))
+
+
+class OctreeCuttingTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        # a sparse 8m cube around a dense 0.5m cluster
+        self.point_cloud = np.vstack([rng.rand(3000, 3) * 8., rng.rand(20000, 3) * 0.5 + 1.])
+
+    def cut(self, **kwargs):
+        stats = {}
+        settings = dict(leaf_points=2000, min_points=1, overlap=0., min_size=0.1, max_points=10 ** 6)
+        settings.update(kwargs)
+        cubes = list(tree2cubes_improved.iter_octree_cubes(self.point_cloud, stats=stats, **settings))
+        return cubes, stats
+
+    def test_partition(self):
+        # without overlap the leaves split the cloud
+        cubes, stats = self.cut()
+        self.assertEqual(sum(len(points) for _, points, _, _ in cubes), len(self.point_cloud))
+        leaves = np.vstack([points for _, points, _, _ in cubes])
+        self.assertTrue(np.array_equal(np.unique(leaves, axis=0), np.unique(self.point_cloud, axis=0)))
+        self.assertEqual(stats['saved_cubes'], len(cubes))
+        self.assertEqual(stats['total_points_saved'], len(self.point_cloud))
+        for name, _, depth, (i, j, k) in cubes:
+            self.assertEqual(name, f'cube_{i}_{j}_{k}_d{depth}')
+
+    def test_leaf_sizes(self):
+        # no lower bound: every leaf fits leaf_points
+        cubes, _ = self.cut(min_leaf_points=0)
+        self.assertTrue(all(len(points) <= 2000 for _, points, _, _ in cubes))
+        # the dense cluster ends up in deeper (smaller) cubes than the sparse part
+        dense = lambda cubes: [(points, depth) for _, points, depth, _ in cubes if np.all((points >= 1.) & (points < 1.5))]
+        sparse_depth = min(depth for _, points, depth, _ in cubes if np.all(points >= 4.))
+        self.assertGreater(min(depth for _, depth in dense(cubes)), sparse_depth)
+        # with the lower bound, fewer and fuller leaves in the cluster: a leaf above leaf_points
+        # is not split into children of a few hundred points
+        bounded, _ = self.cut()
+        self.assertLess(len(bounded), len(cubes))
+        self.assertGreater(np.median([len(points) for points, _ in dense(bounded)]),
+                           np.median([len(points) for points, _ in dense(cubes)]))
+        self.assertTrue(any(len(points) > 2000 for points, _ in dense(bounded)))
+        # min_size: no leaf smaller than it
+        root_size = np.max(np.ptp(self.point_cloud, axis=0)) * (1 + 1e-6) + 1e-6
+        cubes, _ = self.cut(min_size=1.0, min_leaf_points=0)
+        self.assertTrue(all(root_size / 2 ** depth >= 1.0 for _, _, depth, _ in cubes))
+        self.assertTrue(any(len(points) > 2000 for _, points, _, _ in cubes))
+
+    def test_duplicated_points(self):
+        # more than max_points at one location: min_size ends the splitting
+        self.point_cloud = np.vstack([self.point_cloud, np.ones((6000, 3))])
+        cubes, stats = self.cut(max_points=5000, target_points=3000)
+        self.assertEqual(stats['downsampled_cubes'], 1)
+        for min_size in [0, -1.]:
+            with self.assertRaises(AssertionError):
+                self.cut(min_size=min_size)
+
+    def test_downsampling(self):
+        cut = lambda: self.cut(min_size=1.0, max_points=5000, target_points=3000, seed=0, overlap=0.15)
+        cubes, stats = cut()
+        self.assertGreater(stats['downsampled_cubes'], 0)
+        self.assertTrue(all(len(points) <= 5000 for _, points, _, _ in cubes))
+        self.assertEqual(sum(len(points) == 3000 for _, points, _, _ in cubes), stats['downsampled_cubes'])
+        for (name, points, _, _), (other_name, other_points, _, _) in zip(cubes, cut()[0]):
+            self.assertEqual(name, other_name)
+            self.assertTrue(np.array_equal(points, other_points))
+
+
+def reference_fusion(points, voxel_size):
+    '''voxel -> (mean of its points, number of points)'''
+    voxels = np.floor(points / voxel_size).astype(np.int64)
+    return {tuple(voxel): (points[np.all(voxels == voxel, axis=1)].mean(axis=0), np.all(voxels == voxel, axis=1).sum())
+            for voxel in np.unique(voxels, axis=0)}
+
+
+class VoxelFusionTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        # overlapping cubes, the same region is completed several times
+        self.cubes = [rng.rand(500, 3) * 0.5 + offset for offset in [0., 0.2, 0.3, 0.25]]
+        self.reference = reference_fusion(np.vstack(self.cubes), 0.1)
+
+    def fuse(self, cubes, **kwargs):
+        fusion = VoxelFusion(0.1, **kwargs)
+        for cube in cubes:
+            fusion.add(cube)
+        return fusion
+
+    def test_centroid(self):
+        # flushed after every cube or all at once: the fusion is count-weighted either way
+        for buffer_points in [100, 10 ** 6]:
+            fusion = self.fuse(self.cubes, buffer_points=buffer_points)
+            self.assertEqual(len(fusion), len(self.reference))
+            self.assertEqual(fusion.num_points, 2000)
+            points = fusion.points()
+            for voxel, point in zip(fusion.voxels, points):
+                self.assertTrue(np.allclose(point, self.reference[tuple(voxel)][0]))
+
+    def test_center_and_min_count(self):
+        fusion = self.fuse(self.cubes, mode='center', min_count=3)
+        kept = [voxel for voxel, (_, count) in self.reference.items() if count >= 3]
+        self.assertLess(len(kept), len(self.reference))
+        # the voxels come out sorted
+        self.assertTrue(np.allclose(fusion.points(), (np.array(sorted(kept)) + 0.5) * 0.1))
+
+    def test_update(self):
+        fusion = self.fuse(self.cubes[:2])
+        fusion.update(self.fuse(self.cubes[2:]))
+        self.assertTrue(np.allclose(fusion.points(), self.fuse(self.cubes).points()))
+        self.assertEqual(fusion.num_points, 2000)
+
+
+class CubeMergerTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.cubes = [(f'cube_{i}', rng.rand(200, 3) + i * 0.5) for i in range(3)]
+
+    def add(self, merger):
+        for name, points in self.cubes:
+            merger.add(name, points)
+            merger.add(name + FLIP_SUFFIX, points[:50])
+        return merger
+
+    def test_keep_all(self):
+        merger = self.add(CubeMerger())
+        self.assertEqual(len(merger), 6)
+        self.assertEqual(merger.num_points(), 750)
+        self.assertTrue(np.array_equal(merger.points(), np.vstack([points for _, points in self.cubes])))
+        self.assertTrue(np.array_equal(merger.flip_points(), np.vstack([points[:50] for _, points in self.cubes])))
+        self.assertEqual(len(merger.combined_points()), 750)
+
+    def test_voxel_fusion(self):
+        merger = self.add(CubeMerger(voxel_size=0.1))
+        self.assertEqual(merger.num_points(), 750)
+        fusion = VoxelFusion(0.1)
+        for _, points in self.cubes:
+            fusion.add(points)
+        self.assertTrue(np.allclose(merger.points(), fusion.points()))
+        combined = np.vstack([points for _, points in self.cubes] + [points[:50] for _, points in self.cubes])
+        self.assertEqual(len(merger.combined_points()), len(reference_fusion(combined, 0.1)))
+
+    def test_core_bounds(self):
+        lo, hi = np.array([0.5, -np.inf]), np.array([1.0, np.inf])
+        merger = self.add(CubeMerger(core_bounds=(lo, hi)))
+        points = merger.points()
+        self.assertTrue(np.all((points[:, 0] >= 0.5) & (points[:, 0] < 1.0)))
+        expected = np.vstack([points[(points[:, 0] >= 0.5) & (points[:, 0] < 1.0)] for _, points in self.cubes])
+        self.assertTrue(np.array_equal(points, expected))
+
+    def test_no_flipped_cubes(self):
+        merger = CubeMerger(voxel_size=0.1)
+        self.assertIsNone(merger.points())
+        merger.add('cube_0', self.cubes[0][1])
+        self.assertIsNone(merger.flip_points())
+        self.assertEqual(len(merger.combined_points()), len(merger.points()))
+
+
+class FakeEngine(object):
+    '''stands in for TreeCompletionEngine: the completion of a cube is the cube shifted by 1 (flipped: by 2)'''
+    FLUSH_BATCH = object()
+
+    def __init__(self, batch_size, prefetch_batches=0, fail_after=None):
+        self.batch_size = batch_size
+        self.prefetch_batches = prefetch_batches
+        self.fail_after = fail_after
+        self.completed = []
+        self.batch_sizes = []
+        self.streams = 0
+
+    def complete_stream(self, cubes, flip=False):
+        # pulls a whole batch of cubes (or up to a FLUSH_BATCH) before it yields their results, like the engine
+        self.streams += 1
+        batch = []
+        for cube in itertools.chain(cubes, [self.FLUSH_BATCH]):
+            if cube is not self.FLUSH_BATCH:
+                batch.append(cube)
+            if len(batch) < self.batch_size and not (cube is self.FLUSH_BATCH and batch):
+                continue
+            self.batch_sizes.append(len(batch))
+            batch, completing = [], batch
+            for name, points in completing:
+                if len(self.completed) == self.fail_after:
+                    raise RuntimeError('interrupted')
+                self.completed.append(name)
+                yield name, points + 1
+                if flip:
+                    yield name + FLIP_SUFFIX, points + 2
+
+
+class CubeResultCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = CubeResultCache(self.cache_dir, 'model')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def cubes(self, names):
+        return [(name, np.full((5, 3), float(i))) for i, name in enumerate(names)]
+
+    def complete(self, engine, cubes, flip=False):
+        return list(complete_with_cache(engine, lookup_cached(cubes, self.cache, flip=flip), self.cache, flip=flip))
+
+    def test_hit(self):
+        points = np.random.rand(100, 3)
+        key = self.cache.key(points)
+        self.assertIsNone(self.cache.get(key))
+        self.cache.put(key, points * 2)
+        self.assertTrue(np.array_equal(self.cache.get(key), points * 2))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        # the key depends on the points and on the model fingerprint
+        self.assertNotEqual(self.cache.key(points + 1e-9), key)
+        self.assertNotEqual(CubeResultCache(self.cache_dir, 'other model').key(points), key)
+        # partially written entries are misses
+        with open(self.cache._path(key), 'wb') as f:
+            f.write(b'\x93NUMPY')
+        self.assertIsNone(self.cache.get(key))
+
+    def test_fingerprint(self):
+        config, checkpoint = os.path.join(self.cache_dir, 'model.yaml'), os.path.join(self.cache_dir, 'model.pth')
+        for path in [config, checkpoint]:
+            with open(path, 'w') as f:
+                f.write('a')
+        fingerprint = model_fingerprint(config, checkpoint, normalize=True, n_points=2048)
+        self.assertEqual(model_fingerprint(config, checkpoint, n_points=2048, normalize=True), fingerprint)
+        self.assertNotEqual(model_fingerprint(config, checkpoint, normalize=True, n_points=4096), fingerprint)
+        with open(checkpoint, 'w') as f:
+            f.write('b')
+        self.assertNotEqual(model_fingerprint(config, checkpoint, normalize=True, n_points=2048), fingerprint)
+
+    def test_eviction(self):
+        entries = [np.random.rand(1000, 3) for _ in range(10)]
+        for i, points in enumerate(entries):
+            self.cache.put(str(i), points)
+            os.utime(self.cache._path(str(i)), (1000 + i, 1000 + i))
+        entry_bytes = os.path.getsize(self.cache._path('0'))
+        self.assertEqual(self.cache.total_bytes, 10 * entry_bytes)
+        # a hit refreshes the entry
+        self.cache.get('0')
+        self.cache.max_bytes = 8 * entry_bytes
+        self.cache.put('10', entries[0])
+        kept = [str(i) for i in range(11) if os.path.exists(self.cache._path(str(i)))]
+        self.assertEqual(kept, ['0', '5', '6', '7', '8', '9', '10'])
+        self.assertLessEqual(self.cache.total_bytes, 0.9 * self.cache.max_bytes)
+        # a new cache on the same folder sees the entries
+        self.assertEqual(CubeResultCache(self.cache_dir, 'model').total_bytes, self.cache.total_bytes)
+
+    def test_resume(self):
+        cubes = self.cubes([f'A/{i}' for i in range(7)])
+        engine = FakeEngine(batch_size=2, fail_after=5)
+        with self.assertRaises(RuntimeError):
+            self.complete(engine, cubes, flip=True)
+        # the cubes completed before the interruption are cached, the run resumes after them
+        engine = FakeEngine(batch_size=2)
+        completed = self.complete(engine, cubes, flip=True)
+        self.assertEqual(engine.completed, ['A/5', 'A/6'])
+        expected = list(FakeEngine(batch_size=2).complete_stream(cubes, flip=True))
+        self.assertEqual([name for name, _ in completed], [name for name, _ in expected])
+        for (_, points), (_, expected_points) in zip(completed, expected):
+            self.assertTrue(np.array_equal(points, expected_points))
+
+    def test_cached_results_stream(self):
+        # one miss followed by many cached cubes: the cached results are not all held back until the end
+        cubes = self.cubes([f'A/{i}' for i in range(200)])
+        for _, points in cubes[1:]:
+            self.cache.put(self.cache.key(points), points + 1)
+        pulled = []
+        looked_up = lookup_cached(cubes, self.cache)
+        engine = FakeEngine(batch_size=16, prefetch_batches=2)
+        completed = complete_with_cache(engine, (pulled.append(cube) or cube for cube in looked_up), self.cache)
+        name, points = next(completed)
+        self.assertEqual(name, 'A/0')
+        self.assertTrue(np.array_equal(points, cubes[0][1] + 1))
+        # no more than prefetch_batches + 1 batches of cubes are pulled ahead
+        self.assertLessEqual(len(pulled), 16 * 3)
+        rest = list(completed)
+        self.assertEqual([name for name, _ in rest], [name for name, _ in cubes[1:]])
+        # the batch of the miss was flushed with the miss alone
+        self.assertEqual((engine.completed, engine.batch_sizes), (['A/0'], [1]))
+
+    def test_partly_cached_order(self):
+        # cubes of several trees share the batches, the first cube of B was completed by an earlier run:
+        # its cached result must not overtake the last cube of A, or B would be merged (and saved) twice
+        cubes = self.cubes(['A/1', 'A/2', 'A/3', 'B/1', 'B/2'])
+        for flip, prefetch_batches in [(False, 0), (True, 0), (True, 1)]:
+            self.cache.put(self.cache.key(cubes[3][1]), cubes[3][1] + 1)
+            self.cache.put(self.cache.key(cubes[3][1]) + FLIP_SUFFIX, cubes[3][1] + 2)
+            engine = FakeEngine(batch_size=2, prefetch_batches=prefetch_batches)
+            completed = self.complete(engine, cubes, flip=flip)
+            expected = list(FakeEngine(batch_size=2).complete_stream(cubes, flip=flip))
+            self.assertEqual([name for name, _ in completed], [name for name, _ in expected])
+            for (_, points), (_, expected_points) in zip(completed, expected):
+                self.assertTrue(np.array_equal(points, expected_points))
+            # the misses of the whole run go through one stream
+            self.assertEqual(engine.completed, ['A/1', 'A/2', 'A/3', 'B/2'])
+            self.assertEqual(engine.streams, 1)
+            # the completed cubes are cached: a second run completes nothing
+            engine = FakeEngine(batch_size=2, prefetch_batches=prefetch_batches)
+            self.assertEqual(len(self.complete(engine, cubes, flip=flip)), len(expected))
+            self.assertEqual(engine.completed, [])
+            shutil.rmtree(self.cache_dir)
+            self.cache = CubeResultCache(self.cache_dir, 'model')
+
+
+@unittest.skipUnless(laspy is not None, 'needs laspy')
+class LasTilesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.las_path = os.path.join(self.folder, 'plot.las')
+        rng = np.random.RandomState(0)
+        # georeferenced millimetre grid over 5 x 3.5 m, the first point on the scan minimum
+        offset = np.array([512340.0, 5412340.0, 300.0])
+        grid = np.vstack([[0, 0, 0], rng.randint(0, [5000, 3500, 8000], (5000, 3))])
+        header = laspy.LasHeader(point_format=0, version='1.2')
+        header.offsets, header.scales = offset, np.full(3, 0.001)
+        las = laspy.LasData(header)
+        las.X, las.Y, las.Z = grid[:, 0], grid[:, 1], grid[:, 2]
+        las.write(self.las_path)
+        self.points = grid * 0.001 + offset
+        self.tiles = tile_las(self.las_path, os.path.join(self.folder, 'tiles'), tile_size=2.0, halo=0.5,
+                              chunk_points=1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def in_box(self, points, lo, hi):
+        return np.all((points[:, 0:2] >= lo) & (points[:, 0:2] < hi), axis=1)
+
+    def test_core_bounds(self):
+        self.assertEqual(len(self.tiles), 6)
+        self.assertTrue(np.array_equal(self.tiles.num_tiles, [3, 2]))
+        lo, hi = self.tiles.core_bounds('tile_0_1')
+        self.assertTrue(np.array_equal(lo, [-np.inf, self.tiles.origin[1] + 2.0]))
+        self.assertTrue(np.array_equal(hi, [self.tiles.origin[0] + 2.0, np.inf]))
+        lo, hi = self.tiles.core_bounds('tile_1_0')
+        self.assertTrue(np.array_equal(lo, [self.tiles.origin[0] + 2.0, -np.inf]))
+        # every point is in the core of exactly one tile
+        owners = np.zeros(len(self.points), dtype=np.int64)
+        for name in self.tiles.names():
+            owners += self.in_box(self.points, *self.tiles.core_bounds(name))
+            core = self.tiles.points(name)[self.in_box(self.tiles.points(name), *self.tiles.core_bounds(name))]
+            self.assertEqual(len(core), self.in_box(self.points, *self.tiles.core_bounds(name)).sum())
+        self.assertTrue(np.all(owners == 1))
+
+    def test_halo(self):
+        total = 0
+        for name in self.tiles.names():
+            lo, hi = self.tiles.core_bounds(name)
+            points = self.tiles.points(name)
+            # the core and the points within the halo, no more
+            expected = self.points[self.in_box(self.points, lo - 0.5, hi + 0.5)]
+            self.assertEqual(len(points), len(expected))
+            self.assertTrue(np.all(self.in_box(points, lo - 0.5, hi + 0.5)))
+            # float32 relative to the origin: the millimetre grid survives
+            order = lambda xyz: np.lexsort(np.round((xyz - self.tiles.origin) * 1000).T)
+            self.assertLess(np.abs(points[order(points)] - expected[order(expected)]).max(), 1e-5)
+            total += len(points)
+        self.assertGreater(total, len(self.points))
+        self.assertEqual(self.tiles.counts.sum(), total)
+
+
+if __name__ == '__main__':
+    unittest.main()
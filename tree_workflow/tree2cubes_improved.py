@@ -4,11 +4,395 @@ Improved Tree Cube Cutting Function
 Fixes point count filtering issues to ensure complete tree coverage
 """
 
+import collections
+import multiprocessing
 import numpy as np
 import os
+import sys
+from multiprocessing import shared_memory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.cube_shard import CubeShardWriter
+
+CUBE_SHARD_NAME = 'cubes.shard'
+
+def grid_cell_indices(point_cloud, origin, cube_size):
+    """
+    Integer cell index (i, j, k) of every point for a grid of cubes starting at `origin`.
+    Matches the `cube_min <= p < cube_min + cube_size` test of the original cell loop,
+    including points sitting exactly on a cube border.
+    """
+    xyz = point_cloud[:, 0:3]
+    cells = np.floor((xyz - origin) / cube_size).astype(np.int64)
+    # floor() can disagree with the explicit bounds by one cell because of rounding
+    cells -= (xyz < origin + cells * cube_size)
+    cells += (xyz >= (origin + cells * cube_size) + cube_size)
+    return cells
+
+def iter_grid_cubes(point_cloud, origin, cube_size, num_cubes, i_range=None):
+    """
+    Single pass binning of a point cloud into a grid of num_cubes = (nx, ny, nz) cubes.
+    Yields (i, j, k, points_in_cube) for every non-empty cube in the same (i, j, k) order
+    as the nested cell loop, with points kept in their original order.
+    O(N log N) instead of one full-cloud mask per cell.
+    With i_range = (i_start, i_stop) only the slab of cubes with i_start <= i < i_stop is binned.
+    """
+    num_cubes = np.asarray(num_cubes, dtype=np.int64)
+    cells = grid_cell_indices(point_cloud, origin, cube_size)
+    inside = np.all((cells >= 0) & (cells < num_cubes), axis=1)
+    if i_range is not None:
+        inside &= (cells[:, 0] >= i_range[0]) & (cells[:, 0] < i_range[1])
+    point_idx = np.flatnonzero(inside)
+    cells = cells[inside]
+
+    keys = (cells[:, 0] * num_cubes[1] + cells[:, 1]) * num_cubes[2] + cells[:, 2]
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    point_idx = point_idx[order]
+
+    unique_keys, starts, counts = np.unique(keys, return_index=True, return_counts=True)
+    for key, start, count in zip(unique_keys, starts, counts):
+        i, j, k = np.unravel_index(key, tuple(num_cubes))
+        yield int(i), int(j), int(k), point_cloud[point_idx[start:start + count]]
+
+# Spatial shifts of the grid versions for better coverage
+GRID_SHIFTS = [
+    (0.0, 0.0, 0.0),      # Original position
+    (0.5, 0.5, 0.5),      # Half-cube shift
+    (-0.3, -0.3, -0.3),   # Negative shift
+    (0.3, 0.3, 0.2),      # Smaller positive shift
+]
+
+def grid_versions(point_cloud, cube_sizes):
+    """(version, cube_size, shift, grid origin, (nx, ny, nz)) of every shifted cube grid"""
+    mins = np.min(point_cloud[:, 0:3], axis=0)
+    maxs = np.max(point_cloud[:, 0:3], axis=0)
+    for version, (cube_size, shift) in enumerate(zip(cube_sizes, GRID_SHIFTS)):
+        # Apply spatial shift
+        shifted_min = mins + np.array(shift)
+        shifted_max = maxs + np.array(shift)
+        # Calculate the number of cubes in each dimension
+        num_cubes = tuple(int(np.ceil((hi - lo) / cube_size)) for lo, hi in zip(shifted_min, shifted_max))
+        yield version + 1, cube_size, shift, shifted_min, num_cubes
+
+def new_cut_stats():
+    return dict(saved_cubes=0, total_points_saved=0, skipped_empty=0, skipped_sparse=0, downsampled_cubes=0)
+
+def merge_cut_stats(stats, other):
+    for key, value in other.items():
+        stats[key] = stats.get(key, 0) + value
+
+def cut_grid_cubes(point_cloud, version, cube_size, origin, num_cubes, min_points, max_points, target_points, 
+                   stats, seed=None, i_range=None):
+    """
+    Yields (name, points, version, (i, j, k)) for the kept cubes of one grid version
+    (or of the slab i_range of it) and counts them in stats.
+    With a seed every dense cube is downsampled with its own generator seeded by
+    (seed, version, i, j, k), so the cubes do not depend on how the grid is split into slabs.
+    """
+    if i_range is None:
+        i_range = (0, num_cubes[0])
+    non_empty_cubes = 0
+    for i, j, k, points_in_cube in iter_grid_cubes(point_cloud, origin, cube_size, num_cubes, i_range):
+        non_empty_cubes += 1
+        
+        # Process cube based on point count
+        if len(points_in_cube) < min_points:
+            stats['skipped_sparse'] += 1
+            continue
+        elif len(points_in_cube) > max_points:
+            # Smart downsampling: try to preserve structure
+            if len(points_in_cube) > target_points:
+                # Use stratified sampling to preserve spatial distribution
+                rng = np.random if seed is None else np.random.RandomState([seed, version, i, j, k])
+                random_indices = rng.choice(len(points_in_cube), 
+                                            size=target_points, replace=False)
+                points_in_cube = points_in_cube[random_indices, :]
+            stats['downsampled_cubes'] += 1
+        
+        stats['saved_cubes'] += 1
+        stats['total_points_saved'] += len(points_in_cube)
+        yield f'cube_{i}_{j}_{k}_v{version}', points_in_cube, version, (i, j, k)
+    
+    stats['skipped_empty'] += (i_range[1] - i_range[0]) * num_cubes[1] * num_cubes[2] - non_empty_cubes
+
+def iter_cut_cubes(point_cloud, cube_sizes, min_points=100, max_points=8192, target_points=3000, stats=None, 
+                   seed=None, workers=1, pool=None):
+    """
+    Generator version of the improved cube cutting, nothing is written to disk.
+    Yields (name, points, version, (i, j, k)) for every kept cube, one grid version after the other.
+    If a dict is passed as `stats` it is filled with the counters of the cutting summary.
+    With a seed the downsampling of dense cubes is reproducible (same cloud -> same cubes).
+    With workers > 1 the grid versions are split into x slabs that are cut by a process pool
+    (see iter_cut_cubes_parallel), the cubes and their order are the same.
+    Pass a cutting_pool(workers) as `pool` to reuse the same processes for many clouds.
+    """
+    if stats is None:
+        stats = {}
+    stats.update(new_cut_stats())
+    
+    if workers > 1:
+        yield from iter_cut_cubes_parallel(point_cloud, cube_sizes, workers, min_points, max_points, 
+                                           target_points, stats, seed, pool=pool)
+        return
+    
+    for version, cube_size, shift, origin, num_cubes in grid_versions(point_cloud, cube_sizes):
+        print(f"📦 Processing cube size {cube_size}m (v{version}) with shift {shift}")
+        saved_before = stats['saved_cubes']
+        yield from cut_grid_cubes(point_cloud, version, cube_size, origin, num_cubes, 
+                                  min_points, max_points, target_points, stats, seed=seed)
+        print(f"   Saved {stats['saved_cubes'] - saved_before} cubes for this size")
+
+# slabs per worker and grid version: smaller slabs balance the pool and bound the cubes held in memory
+SLABS_PER_WORKER = 4
+
+def cutting_pool(workers):
+    """
+    Process pool for iter_cut_cubes_parallel. The workers are started by a fork server (spawned on Windows)
+    instead of forking the calling process, which may run other threads (prefetch, writer, CUDA).
+    Create it once and pass it to every call, the point clouds are handed over through shared memory.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn').Pool(workers)
+
+# point cloud of a pool worker, attached to the shared memory block of iter_cut_cubes_parallel
+_worker_cloud = {}
+
+def _attach_cloud(shm_name, shape, dtype):
+    if _worker_cloud.get('name') != shm_name:
+        if 'shm' in _worker_cloud:
+            # cloud of an earlier call
+            _worker_cloud.pop('points')
+            _worker_cloud.pop('shm').close()
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _worker_cloud.update(name=shm_name, shm=shm, points=np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    return _worker_cloud['points']
+
+def _cut_slab(task):
+    cloud, version, cube_size, origin, num_cubes, i_range, settings = task
+    stats = new_cut_stats()
+    cubes = list(cut_grid_cubes(_attach_cloud(*cloud), version, cube_size, origin, num_cubes, 
+                                stats=stats, i_range=i_range, **settings))
+    return cubes, stats
+
+def iter_cut_cubes_parallel(point_cloud, cube_sizes, workers, min_points=100, max_points=8192, 
+                            target_points=3000, stats=None, seed=None, pool=None):
+    """
+    Cut the grid versions with a pool of `workers` processes (`pool`, a cutting_pool, or one for this call).
+    The point cloud is copied once into a shared memory block that every worker maps, each task cuts
+    one slab of x cells of one version. At most `workers` slabs are submitted ahead of the consumer, so
+    only their cubes are held in memory, and the cubes are yielded in the same order as the serial cutter.
+    """
+    if stats is None:
+        stats = {}
+    if pool is None:
+        with cutting_pool(workers) as pool:
+            yield from iter_cut_cubes_parallel(point_cloud, cube_sizes, workers, min_points, max_points, 
+                                               target_points, stats, seed, pool=pool)
+        return
+    
+    point_cloud = np.ascontiguousarray(point_cloud)
+    shm = shared_memory.SharedMemory(create=True, size=max(point_cloud.nbytes, 1))
+    pending = collections.deque()
+    try:
+        np.ndarray(point_cloud.shape, dtype=point_cloud.dtype, buffer=shm.buf)[:] = point_cloud
+        cloud = (shm.name, point_cloud.shape, point_cloud.dtype)
+        tasks = []
+        settings = dict(min_points=min_points, max_points=max_points, target_points=target_points, seed=seed)
+        for version, cube_size, shift, origin, num_cubes in grid_versions(point_cloud, cube_sizes):
+            bounds = np.linspace(0, num_cubes[0], min(SLABS_PER_WORKER * workers, num_cubes[0]) + 1).astype(int)
+            for i_start, i_stop in zip(bounds[:-1], bounds[1:]):
+                tasks.append((cloud, version, cube_size, origin, num_cubes, (int(i_start), int(i_stop)), settings))
+        print(f"📦 Cutting {len(set(task[1] for task in tasks))} cube grids in {len(tasks)} slabs with {workers} workers")
+        
+        version_cubes = {}
+        next_tasks = iter(tasks)
+        for task in next_tasks:
+            pending.append((task, pool.apply_async(_cut_slab, (task,))))
+            if len(pending) == workers:
+                break
+        while pending:
+            task, result = pending.popleft()
+            cubes, slab_stats = result.get()
+            # keep the workers busy while the cubes of this slab are consumed
+            for next_task in next_tasks:
+                pending.append((next_task, pool.apply_async(_cut_slab, (next_task,))))
+                break
+            merge_cut_stats(stats, slab_stats)
+            version_cubes[task[1]] = version_cubes.get(task[1], 0) + len(cubes)
+            yield from cubes
+        for version, count in version_cubes.items():
+            print(f"   Saved {count} cubes for v{version}")
+    finally:
+        # slabs still running (consumer stopped early) read the shared memory until they are done
+        for _, result in pending:
+            result.wait()
+        shm.close()
+        shm.unlink()
+
+def iter_octree_cubes(point_cloud, leaf_points=4000, min_points=100, overlap=0.15, min_size=0.25, 
+                      max_points=8192, target_points=3000, stats=None, seed=None, min_leaf_points=None):
+    """
+    Density-adaptive alternative to the fixed cube grids: the bounding cube of the cloud is split
+    as an octree until a cube holds at most `leaf_points` points (or is smaller than 2 * min_size),
+    so dense parts end up in small cubes and sparse parts in large ones, and no grid versions are needed.
+    A cube is not split either when its non-empty children would hold fewer than `min_leaf_points`
+    points on average (default leaf_points / 4): splitting a cube just above leaf_points would otherwise
+    give mostly sparse leaves. Such a cube stays one leaf above leaf_points, unless it holds more than
+    max_points (splitting it loses fewer points than downsampling it).
+    Every leaf is extended by `overlap` times its size on each side, the points of that margin
+    give the completion context across leaf borders (the merge fuses the overlap).
+    Yields (name, points, depth, (i, j, k)) in depth-first order, (i, j, k) being the cell of the leaf
+    at its depth. Leaves with fewer than min_points points of their own are skipped, leaves of
+    min_size that still hold more than max_points points are downsampled to target_points.
+    """
+    # min_size is what ends the splitting of duplicated points (more than max_points at one location)
+    assert min_size > 0, f'min_size has to be positive, got {min_size}'
+    assert leaf_points > 0 and max_points > 0, f'leaf_points ({leaf_points}) and max_points ({max_points}) have to be positive'
+    if stats is None:
+        stats = {}
+    stats.update(new_cut_stats())
+    if min_leaf_points is None:
+        min_leaf_points = leaf_points // 4
+    
+    xyz = point_cloud[:, 0:3]
+    mins = np.min(xyz, axis=0)
+    # slightly larger than the extent, so the points on the maximum are inside the root cube
+    root_size = float(np.max(np.max(xyz, axis=0) - mins)) * (1 + 1e-6) + 1e-6
+    print(f"🌲 Octree cube cutting: root {root_size:.2f}m, leaves up to {leaf_points} points "
+          f"(no split into children under {min_leaf_points} points on average), overlap {overlap:.0%}, min size {min_size}m")
+    
+    # (depth, cell, indices of the points in the cube, indices of the points in the extended cube)
+    everything = np.arange(len(point_cloud))
+    stack = [(0, (0, 0, 0), everything, everything)]
+    depth_cubes = {}
+    while stack:
+        depth, cell, core, context = stack.pop()
+        size = root_size / 2 ** depth
+        
+        split = len(context) > leaf_points and size / 2 >= min_size
+        if split:
+            origin = mins + np.array(cell) * size
+            child_size = size / 2
+            child_keys = np.clip(grid_cell_indices(xyz[core], origin, child_size), 0, 1) @ np.array([4, 2, 1])
+            # the cube stays one leaf when its points would be spread too thin over the children
+            # (and it does not have to be downsampled)
+            split = len(context) > max_points or len(core) >= min_leaf_points * len(np.unique(child_keys))
+        if split:
+            # split into the 8 children, a child sees the points of its extended cube,
+            # which lies inside the extended cube of the parent
+            context_xyz = xyz[context]
+            # inside the lower / upper extended half of the parent, per axis
+            lo = origin - overlap * child_size
+            hi = lo + child_size * (1 + 2 * overlap)
+            halves = [(context_xyz >= lo) & (context_xyz < hi),
+                      (context_xyz >= lo + child_size) & (context_xyz < hi + child_size)]
+            children = []
+            for key, offset in enumerate(np.ndindex(2, 2, 2)):
+                child_core = core[child_keys == key]
+                if len(child_core) == 0:
+                    stats['skipped_empty'] += 1
+                    continue
+                inside = halves[offset[0]][:, 0] & halves[offset[1]][:, 1] & halves[offset[2]][:, 2]
+                child_context = context[inside]
+                child_cell = tuple(2 * c + o for c, o in zip(cell, offset))
+                children.append((depth + 1, child_cell, child_core, child_context))
+            stack.extend(reversed(children))
+            continue
+        
+        if len(core) < min_points:
+            stats['skipped_sparse'] += 1
+            continue
+        points_in_cube = point_cloud[np.union1d(core, context)]
+        i, j, k = cell
+        if len(points_in_cube) > max_points:
+            rng = np.random if seed is None else np.random.RandomState([seed, depth, i, j, k])
+            random_indices = rng.choice(len(points_in_cube), size=target_points, replace=False)
+            points_in_cube = points_in_cube[np.sort(random_indices), :]
+            stats['downsampled_cubes'] += 1
+        
+        stats['saved_cubes'] += 1
+        stats['total_points_saved'] += len(points_in_cube)
+        depth_cubes[depth] = depth_cubes.get(depth, 0) + 1
+        yield f'cube_{i}_{j}_{k}_d{depth}', points_in_cube, depth, cell
+    
+    for depth in sorted(depth_cubes):
+        print(f"   Saved {depth_cubes[depth]} cubes of {root_size / 2 ** depth:.2f}m (depth {depth})")
+
+CUBE_TABLE_DTYPE = np.dtype([
+    ('name', 'S64'),          # cube id, e.g. cube_3_0_7_v2
+    ('version', '<i2'),       # grid version (octree depth for octree cubes), 0 if unknown
+    ('cell', '<i4', (3,)),    # (i, j, k) of the cube in its grid, -1 if unknown
+    ('count', '<i8'),         # number of points
+    ('min', '<f8', (3,)),     # bounds of the points
+    ('max', '<f8', (3,)),
+    ('centroid', '<f8', (3,)),
+])
+
+class CubeTable(object):
+    """
+    Metadata of the cut cubes (one CUBE_TABLE_DTYPE row per cube), collected while the cubes
+    stream out of the cutter, so the cube statistics need no second pass over the cubes.
+        table.add(name, points, version, cell)
+        table.array()                         -> structured array of all rows
+        table.vertical_coverage(point_cloud)  -> z range of the cube centroids / z range of the cloud
+    """
+    def __init__(self):
+        self._rows = []
+
+    def add(self, name, points, version=0, cell=(-1, -1, -1)):
+        xyz = points[:, 0:3]
+        self._rows.append((name.encode(), version, cell, len(xyz), 
+                           xyz.min(axis=0), xyz.max(axis=0), xyz.mean(axis=0)))
+
+    def __len__(self):
+        return len(self._rows)
+
+    def array(self):
+        return np.array(self._rows, dtype=CUBE_TABLE_DTYPE)
+
+    def save(self, path):
+        np.save(path, self.array())
+
+    def vertical_coverage(self, point_cloud):
+        if len(self) == 0:
+            return 0.0
+        z = self.array()['centroid'][:, 2]
+        tree_z_range = np.max(point_cloud[:, 2]) - np.min(point_cloud[:, 2])
+        return float((z.max() - z.min()) / tree_z_range) if tree_z_range > 0 else 0.0
+
+def save_cubes(cubes, outpath, origin=None, cube_format='shard'):
+    """
+    Pass-through generator that writes every (name, points, version, cell) cube it sees
+    to `outpath` (one cube shard, or one .txt file per cube) before yielding it on.
+    """
+    assert cube_format in ['shard', 'txt'], f'unexpected cube_format {cube_format}'
+    os.makedirs(outpath, exist_ok=True)
+    
+    shard_writer = None
+    if cube_format == 'shard':
+        shard_writer = CubeShardWriter(os.path.join(outpath, CUBE_SHARD_NAME), origin=origin)
+    try:
+        for name, points_in_cube, version, cell in cubes:
+            if shard_writer is not None:
+                shard_writer.add(name, points_in_cube, version=version, cell=cell)
+            else:
+                np.savetxt(os.path.join(outpath, name + '.txt'), points_in_cube[:, 0:3], fmt='%.6f', delimiter=' ')
+            yield name, points_in_cube, version, cell
+    finally:
+        if shard_writer is not None:
+            shard_writer.close()
+
+def print_cut_summary(stats, num_points, min_points):
+    print(f"📊 Cube cutting summary:")
+    print(f"   Total cubes saved: {stats['saved_cubes']}")
+    print(f"   Total points in cubes: {stats['total_points_saved']:,}")
+    print(f"   Coverage: {(stats['total_points_saved'] / num_points):.1%} of original points")
+    print(f"   Skipped empty cubes: {stats['skipped_empty']}")
+    print(f"   Skipped sparse cubes (<{min_points} points): {stats['skipped_sparse']}")
+    print(f"   Downsampled dense cubes: {stats['downsampled_cubes']}")
 
 def cut_point_cloud_improved(point_cloud, outpath, size1, size2, size3, size4, 
-                           min_points=100, max_points=8192, target_points=3000):
+                           min_points=100, max_points=8192, target_points=3000, cube_format='shard', workers=1):
     """
     Improved cube cutting that preserves more tree parts
     
@@ -20,114 +404,29 @@ def cut_point_cloud_improved(point_cloud, outpath, size1, size2, size3, size4,
         Maximum points to keep per cube (matches model training)
     target_points : int (default 3000)
         Target points when downsampling dense cubes
+    cube_format : str (default 'shard')
+        'shard' writes all cubes into one binary cube shard (outpath/cubes.shard, see utils/cube_shard.py),
+        'txt' writes one cube_i_j_k_vX.txt text file per cube
+    workers : int (default 1)
+        Number of processes cutting the grids in parallel (1 = in-process)
     """
-    
-    # Create a directory to save the .txt files if it doesn't exist
-    if not os.path.exists(outpath):
-        os.makedirs(outpath)
-    
-    saved_cubes = 0
-    total_points_saved = 0
-    skipped_empty = 0
-    skipped_sparse = 0
-    downsampled_cubes = 0
-    
     print(f"🔧 Using improved cube cutting with:")
     print(f"   Min points per cube: {min_points}")
     print(f"   Max points per cube: {max_points}")
     print(f"   Target points (downsampling): {target_points}")
     
-    # Find the minimum and maximum coordinates
-    min_x = np.min(point_cloud[:, 0])
-    max_x = np.max(point_cloud[:, 0])
-    min_y = np.min(point_cloud[:, 1])
-    max_y = np.max(point_cloud[:, 1])
-    min_z = np.min(point_cloud[:, 2])
-    max_z = np.max(point_cloud[:, 2])
-    
-    # Define spatial shifts for better coverage
-    shifts = [
-        (0.0, 0.0, 0.0),      # Original position
-        (0.5, 0.5, 0.5),      # Half-cube shift
-        (-0.3, -0.3, -0.3),   # Negative shift
-        (0.3, 0.3, 0.2),      # Smaller positive shift
-    ]
-    
-    cube_sizes = [size1, size2, size3, size4]
+    stats = {}
+    cubes = iter_cut_cubes(point_cloud, [size1, size2, size3, size4], 
+                           min_points=min_points, max_points=max_points, 
+                           target_points=target_points, stats=stats, workers=workers)
+    # floor of the minimum keeps the float32 coordinates of the shard small
+    for _ in save_cubes(cubes, outpath, origin=np.floor(np.min(point_cloud[:, 0:3], axis=0)), 
+                        cube_format=cube_format):
+        pass
     
-    for version, (cube_size, (shift_x, shift_y, shift_z)) in enumerate(zip(cube_sizes, shifts)):
-        print(f"📦 Processing cube size {cube_size}m (v{version+1}) with shift ({shift_x}, {shift_y}, {shift_z})")
-        
-        # Apply spatial shift
-        shifted_min_x = min_x + shift_x
-        shifted_max_x = max_x + shift_x
-        shifted_min_y = min_y + shift_y
-        shifted_max_y = max_y + shift_y
-        shifted_min_z = min_z + shift_z
-        shifted_max_z = max_z + shift_z
-        
-        # Calculate the number of cubes in each dimension
-        num_cubes_x = int(np.ceil((shifted_max_x - shifted_min_x) / cube_size))
-        num_cubes_y = int(np.ceil((shifted_max_y - shifted_min_y) / cube_size))
-        num_cubes_z = int(np.ceil((shifted_max_z - shifted_min_z) / cube_size))
-        
-        version_cubes = 0
-        
-        # Iterate over the cubes
-        for i in range(num_cubes_x):
-            for j in range(num_cubes_y):
-                for k in range(num_cubes_z):
-                    # Define the cube boundaries
-                    cube_min_x = shifted_min_x + i * cube_size
-                    cube_max_x = cube_min_x + cube_size
-                    cube_min_y = shifted_min_y + j * cube_size
-                    cube_max_y = cube_min_y + cube_size
-                    cube_min_z = shifted_min_z + k * cube_size
-                    cube_max_z = cube_min_z + cube_size
-                    
-                    # Select the points within the current cube
-                    mask = (
-                        (point_cloud[:, 0] >= cube_min_x) & (point_cloud[:, 0] < cube_max_x) &
-                        (point_cloud[:, 1] >= cube_min_y) & (point_cloud[:, 1] < cube_max_y) &
-                        (point_cloud[:, 2] >= cube_min_z) & (point_cloud[:, 2] < cube_max_z)
-                    )
-                    points_in_cube = point_cloud[mask]
-                    
-                    # Process cube based on point count
-                    if len(points_in_cube) == 0:
-                        skipped_empty += 1
-                        continue
-                    elif len(points_in_cube) < min_points:
-                        skipped_sparse += 1
-                        continue
-                    elif len(points_in_cube) > max_points:
-                        # Smart downsampling: try to preserve structure
-                        if len(points_in_cube) > target_points:
-                            # Use stratified sampling to preserve spatial distribution
-                            random_indices = np.random.choice(len(points_in_cube), 
-                                                             size=target_points, replace=False)
-                            points_in_cube = points_in_cube[random_indices, :]
-                        downsampled_cubes += 1
-                    
-                    # Save the cube
-                    filename = f'/cube_{i}_{j}_{k}_v{version+1}.txt'
-                    np.savetxt(outpath + filename, points_in_cube[:, 0:3], fmt='%.6f', delimiter=' ')
-                    
-                    saved_cubes += 1
-                    version_cubes += 1
-                    total_points_saved += len(points_in_cube)
-        
-        print(f"   Saved {version_cubes} cubes for this size")
-    
-    print(f"📊 Cube cutting summary:")
-    print(f"   Total cubes saved: {saved_cubes}")
-    print(f"   Total points in cubes: {total_points_saved:,}")
-    print(f"   Coverage: {(total_points_saved / len(point_cloud)):.1%} of original points")
-    print(f"   Skipped empty cubes: {skipped_empty}")
-    print(f"   Skipped sparse cubes (<{min_points} points): {skipped_sparse}")
-    print(f"   Downsampled dense cubes: {downsampled_cubes}")
+    print_cut_summary(stats, len(point_cloud), min_points)
     
-    return saved_cubes
+    return stats['saved_cubes']
 
 
 # Keep original function as backup
@@ -130,15 +130,22 @@ def remove_points_in_sphere(data, percrad = 0.1, centerpos=0.02):
 
     
 # Read point cloud from .laz file and convert to numpy array, including the 'Deviation' attribute if it exists
-def read_laz_to_numpy(filepath):
+# The file is decoded chunk by chunk into the preallocated output, so the full LasData is never held in memory
+def read_laz_to_numpy(filepath, chunk_size=5000000):
     with laspy.open(filepath) as f:
-        las = f.read()
-        if 'Deviation' in las.point_format.dimension_names:
-            points = np.vstack((las.x, las.y, las.z, las.Deviation)).transpose()
-        else:    
-            points = np.vstack((las.x, las.y, las.z)).transpose()
+        with_deviation = 'Deviation' in f.header.point_format.dimension_names
+        points = np.empty((f.header.point_count, 4 if with_deviation else 3))
+        start = 0
+        for chunk in f.chunk_iterator(chunk_size):
+            end = start + len(chunk)
+            points[start:end, 0] = chunk.x
+            points[start:end, 1] = chunk.y
+            points[start:end, 2] = chunk.z
+            if with_deviation:
+                points[start:end, 3] = chunk.Deviation
+            start = end
                
-    return points
+    return points[:start]
 
 
 
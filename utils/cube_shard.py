@@ -0,0 +1,117 @@
+import os
+import numpy as np
+
+# A cube shard stores many cubes in two files:
+#   <name>.shard      float32 xyz of all cubes back to back (C order, memory-mappable)
+#   <name>.shard.npz  index (one row per cube) and the float64 origin of the coordinates
+# Coordinates are stored relative to the origin so float32 keeps sub-millimetre precision
+# even for georeferenced clouds.
+
+SHARD_EXTENSION = '.shard'
+INDEX_SUFFIX = '.npz'
+
+# name suffix of the flipped completion of a cube (flip test-time augmentation of tools/inference.py,
+# kept apart from the normal completions by tree_workflow/cube_merge.py)
+FLIP_SUFFIX = '_flip'
+
+CUBE_INDEX_DTYPE = np.dtype([
+    ('name', 'S64'),        # cube id, e.g. cube_3_0_7_v2
+    ('version', '<i2'),     # grid version (1-4), 0 if unknown
+    ('cell', '<i4', (3,)),  # (i, j, k) of the cube in its grid, -1 if unknown
+    ('offset', '<i8'),      # first point of the cube in the point file
+    ('count', '<i8'),       # number of points
+    ('min', '<f8', (3,)),   # bounds of the points (world coordinates)
+    ('max', '<f8', (3,)),
+])
+
+
+class CubeShardWriter(object):
+    '''
+        Append cubes one by one, the index is written on close()
+        Usage:
+            with CubeShardWriter('cubes/cubes.shard', origin=np.floor(pc.min(0))) as writer:
+                writer.add('cube_0_0_0_v1', points, version=1, cell=(0, 0, 0))
+    '''
+    def __init__(self, path, origin=None):
+        self.path = path
+        self.origin = np.zeros(3) if origin is None else np.asarray(origin, dtype=np.float64)
+        self._file = open(path, 'wb')
+        self._rows = []
+        self._offset = 0
+
+    def add(self, name, points, version=0, cell=(-1, -1, -1)):
+        # longer names would be cut silently by the index (and could collide)
+        assert len(name.encode()) <= CUBE_INDEX_DTYPE['name'].itemsize, \
+            f'cube name {name!r} longer than {CUBE_INDEX_DTYPE["name"].itemsize} bytes'
+        xyz = points[:, 0:3]
+        local = np.ascontiguousarray(xyz - self.origin, dtype=np.float32)
+        self._file.write(local.tobytes())
+        self._rows.append((name.encode(), version, cell, self._offset, len(local),
+                           xyz.min(axis=0), xyz.max(axis=0)))
+        self._offset += len(local)
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        index = np.array(self._rows, dtype=CUBE_INDEX_DTYPE)
+        np.savez(self.path + INDEX_SUFFIX, index=index, origin=self.origin)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CubeShard(object):
+    '''
+        Read-only view of a cube shard. The point file is memory-mapped, nothing is parsed.
+            shard.local_points(name) -> float32 view relative to shard.origin (zero-copy)
+            shard[name]              -> world coordinates (zero-copy when the origin is 0)
+    '''
+    def __init__(self, path):
+        self.path = path
+        with np.load(path + INDEX_SUFFIX) as f:
+            self.index = f['index']
+            self.origin = f['origin']
+        total = int(self.index['count'].sum()) if len(self.index) > 0 else 0
+        if total > 0:
+            self.data = np.memmap(path, dtype=np.float32, mode='r', shape=(total, 3))
+        else:
+            self.data = np.zeros((0, 3), dtype=np.float32)
+        self._rows = {name.decode(): row for row, name in enumerate(self.index['name'])}
+
+    def names(self):
+        return list(self._rows.keys())
+
+    def local_points(self, name):
+        row = self.index[self._rows[name]]
+        return self.data[row['offset']:row['offset'] + row['count']]
+
+    def __getitem__(self, name):
+        points = self.local_points(name)
+        if np.any(self.origin != 0):
+            return points + self.origin
+        return points
+
+    def items(self):
+        for name in self._rows:
+            yield name, self[name]
+
+    def __contains__(self, name):
+        return name in self._rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+
+def find_shards(folder):
+    return sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.endswith(SHARD_EXTENSION))
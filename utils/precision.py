@@ -0,0 +1,57 @@
+import contextlib
+import torch
+from torch import nn
+
+# Mixed precision of the model forward, shared by training / testing (tools/runner.py, `precision`
+# key of the config) and inference (tools/inference.py). The reduced precisions run the forward
+# under torch.autocast: matmuls / linear / conv layers in bf16 or fp16, while the numerically
+# sensitive parts stay in fp32 (square_distance and the attention softmax in models/Transformer_utils.py,
+# the chamfer distances in extensions/chamfer_dist).
+#   fp32 : no autocast
+#   bf16 : CPU, and GPUs with bfloat16 support (Ampere and newer)
+#   fp16 : GPUs, training needs a GradScaler (see grad_scaler)
+PRECISIONS = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def check_precision(precision, device_type):
+    assert precision in PRECISIONS, f'unexpected precision {precision}, expected one of {list(PRECISIONS)}'
+    if precision == 'bf16' and device_type == 'cuda':
+        assert torch.cuda.is_bf16_supported(), 'this GPU has no bfloat16 support, use fp16'
+
+
+def autocast(precision, device_type='cuda'):
+    '''context manager running the forward in the given precision, does nothing for fp32'''
+    check_precision(precision, device_type)
+    if PRECISIONS[precision] is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type, dtype=PRECISIONS[precision])
+
+
+def grad_scaler(precision, device_type='cuda'):
+    '''loss scaling against fp16 gradient underflow, a pass-through for the other precisions'''
+    return torch.amp.GradScaler(device_type, enabled=precision == 'fp16')
+
+
+class AutocastModel(nn.Module):
+    '''
+        Runs model under autocast and returns its outputs in fp32, so callers (metrics, numpy
+        conversion, writers) see the same dtypes as with the fp32 model.
+    '''
+    def __init__(self, model, precision, device_type='cuda'):
+        super().__init__()
+        check_precision(precision, device_type)
+        self.model = model
+        self.precision = precision
+        self.device_type = device_type
+
+    def forward(self, *inputs):
+        with autocast(self.precision, self.device_type):
+            outputs = self.model(*inputs)
+        return tuple(output.float() for output in outputs)
+
+
+def autocast_model(model, precision, device_type='cuda'):
+    '''model wrapped into an AutocastModel, the model itself for fp32'''
+    if precision == 'fp32':
+        return model
+    return AutocastModel(model, precision, device_type)
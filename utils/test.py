@@ -0,0 +1,78 @@
+# Tests of the cube shard format of utils/cube_shard.py: cubes written by CubeShardWriter
+# read back through CubeShard
+
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+import unittest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from utils.cube_shard import CubeShardWriter, CubeShard, find_shards, SHARD_EXTENSION
+
+
+class CubeShardTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'cubes' + SHARD_EXTENSION)
+        rng = np.random.RandomState(0)
+        # georeferenced coordinates, far from 0
+        offset = np.array([512345.0, 5412345.0, 310.0])
+        self.cubes = [(f'cube_{i}_0_{i}_v{i % 4 + 1}', rng.rand(n, 3) * 2 + offset, i % 4 + 1, (i, 0, i))
+                      for i, n in enumerate([10, 1, 300, 2048])]
+        self.origin = np.floor(np.min(np.vstack([points for _, points, _, _ in self.cubes]), axis=0))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_round_trip(self):
+        with CubeShardWriter(self.path, origin=self.origin) as writer:
+            for name, points, version, cell in self.cubes:
+                writer.add(name, points, version=version, cell=cell)
+        shard = CubeShard(self.path)
+        self.assertEqual(len(shard), len(self.cubes))
+        self.assertEqual(shard.names(), [name for name, _, _, _ in self.cubes])
+        self.assertTrue(np.array_equal(shard.origin, self.origin))
+        for row, (name, points, version, cell) in zip(shard.index, self.cubes):
+            self.assertIn(name, shard)
+            self.assertEqual(shard.local_points(name).dtype, np.float32)
+            # float32 relative to the origin keeps sub-millimetre precision
+            self.assertLess(np.abs(shard[name] - points).max(), 1e-4)
+            self.assertEqual(row['version'], version)
+            self.assertEqual(tuple(row['cell']), cell)
+            self.assertEqual(row['count'], len(points))
+            self.assertTrue(np.array_equal(row['min'], points.min(axis=0)))
+            self.assertTrue(np.array_equal(row['max'], points.max(axis=0)))
+        self.assertEqual([name for name, _ in shard.items()], shard.names())
+
+    def test_zero_origin(self):
+        points = np.random.rand(100, 4)  # extra columns are dropped
+        with CubeShardWriter(self.path) as writer:
+            writer.add('cube_0_0_0_v1', points)
+        shard = CubeShard(self.path)
+        self.assertTrue(np.array_equal(shard['cube_0_0_0_v1'], points[:, 0:3].astype(np.float32)))
+        self.assertEqual(shard.index['version'][0], 0)
+        self.assertEqual(tuple(shard.index['cell'][0]), (-1, -1, -1))
+
+    def test_empty(self):
+        CubeShardWriter(self.path).close()
+        shard = CubeShard(self.path)
+        self.assertEqual(len(shard), 0)
+        self.assertEqual(list(shard.items()), [])
+
+    def test_long_name(self):
+        with CubeShardWriter(self.path) as writer:
+            writer.add('c' * 64, np.zeros((1, 3)))
+            with self.assertRaises(AssertionError):
+                writer.add('c' * 65, np.zeros((1, 3)))
+        self.assertEqual(CubeShard(self.path).names(), ['c' * 64])
+
+    def test_find_shards(self):
+        for name in ['b', 'a']:
+            CubeShardWriter(os.path.join(self.folder, name + SHARD_EXTENSION)).close()
+        self.assertEqual(find_shards(self.folder), [os.path.join(self.folder, name + SHARD_EXTENSION) for name in ['a', 'b']])
+
+
+if __name__ == '__main__':
+    unittest.main()